@@ -15,7 +15,16 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import codecs
+from contextlib import nullcontext
+import csv
+import json
+from logging import ERROR, WARNING, INFO
+from tempfile import TemporaryFile
+
 from django.contrib.admin.views.decorators import staff_member_required
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_protect
@@ -25,7 +34,8 @@ from rest_framework_bulk import ListBulkCreateUpdateDestroyAPIView
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import permissions
 
-from freppledb.common.models import User
+from freppledb.common.dataload import parseCSVdata, parseJSONdata
+from freppledb.common.models import AuditModel, User
 from freppledb.common.auth import getWebserviceAuthorization
 
 
@@ -82,6 +92,7 @@ class frePPleListCreateAPIView(ListBulkCreateUpdateDestroyAPIView):
   Customized API view for the REST framework.:
      - support for request-specific scenario database
      - add 'title' to the context of the html view
+     - streaming bulk load of NDJSON and CSV request bodies
   """
 
     filter_backends = (DjangoFilterBackend,)
@@ -95,6 +106,98 @@ class frePPleListCreateAPIView(ListBulkCreateUpdateDestroyAPIView):
         kwargs["partial"] = True
         return super().get_serializer(*args, **kwargs)
 
+    def bulkUpdate(self):
+        # Postpone the processing of the individual saves till the end of the request
+        model = self.get_queryset().model
+        if issubclass(model, AuditModel):
+            return model.bulkUpdate(self.request.database)
+        else:
+            return nullcontext()
+
+    def post(self, request, *args, **kwargs):
+        content_type = request.content_type.split(";")[0].strip().lower()
+        if content_type in ("application/x-ndjson", "text/csv"):
+            return self.bulkLoad(request, content_type)
+        with self.bulkUpdate():
+            return super().post(request, *args, **kwargs)
+
+    def bulkLoad(self, request, content_type):
+        """
+        Creates or updates records from a NDJSON or CSV request body with the
+        same logic as the data upload of the grid reports.
+        The body is first copied to a temporary file, so the request is never
+        kept in memory, and the results are streamed back as NDJSON: one line
+        per error or warning and a summary line at the end.
+        """
+        model = self.get_queryset().model
+        body = TemporaryFile()
+        for chunk in iter(lambda: request._request.read(65536), b""):
+            body.write(chunk)
+        body.seek(0)
+
+        def results():
+            errors = 0
+            warnings = 0
+            summary = []
+            try:
+                lines = codecs.iterdecode(body, "utf-8-sig")
+                with transaction.atomic(using=request.database):
+                    if content_type == "text/csv":
+                        messages = parseCSVdata(
+                            model,
+                            csv.reader(lines),
+                            user=request.user,
+                            database=request.database,
+                            bulk=True,
+                        )
+                    else:
+                        messages = parseJSONdata(
+                            model,
+                            lines,
+                            user=request.user,
+                            database=request.database,
+                            bulk=True,
+                        )
+                    for level, row, field, value, message in messages:
+                        if level == INFO:
+                            summary.append(str(message))
+                            continue
+                        elif level == ERROR:
+                            errors += 1
+                        elif level == WARNING:
+                            warnings += 1
+                        else:
+                            continue
+                        yield "%s\n" % json.dumps(
+                            {
+                                "level": "error" if level == ERROR else "warning",
+                                "row": row,
+                                "field": field,
+                                "value": value,
+                                "message": str(message),
+                            },
+                            default=str,
+                        )
+            except Exception as e:
+                # The transaction is rolled back
+                errors += 1
+                summary.append("Exception during upload: %s" % e)
+            finally:
+                body.close()
+            yield "%s\n" % json.dumps(
+                {"errors": errors, "warnings": warnings, "summary": summary}
+            )
+
+        return StreamingHttpResponse(results(), content_type="application/x-ndjson")
+
+    def put(self, request, *args, **kwargs):
+        with self.bulkUpdate():
+            return super().put(request, *args, **kwargs)
+
+    def patch(self, request, *args, **kwargs):
+        with self.bulkUpdate():
+            return super().patch(request, *args, **kwargs)
+
     def allow_bulk_destroy(self, qs, filtered):
         # Safety check to prevent deleting all records in the database table
         if qs.count() > filtered.count():
@@ -23,13 +23,14 @@ from django.conf import settings
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import Permission
+from django.core.cache import cache
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 from django.db import DEFAULT_DB_ALIAS
 from django.db.models import Q
 from django.http import HttpResponse
 
-from freppledb.common.models import User, Scenario
+from freppledb.common.models import User, Scenario, getCacheKey
 
 import logging
 
@@ -52,6 +53,10 @@ class MultiDBBackend(ModelBackend):
     def getScenarios(user):
         # Populate a dictionary with scenarios in which the user is active, and
         # whether he's a superuser in them.
+        key = getCacheKey("scenarios", "user_%s" % user.username)
+        user.scenarios = cache.get(key)
+        if user.scenarios is not None:
+            return
         user.scenarios = []
         for db in Scenario.objects.using(DEFAULT_DB_ALIAS).filter(
             Q(status="In use") | Q(name=DEFAULT_DB_ALIAS)
@@ -71,6 +76,7 @@ class MultiDBBackend(ModelBackend):
                 except Exception:
                     # Silently ignore errors. Eg user doesn't exist in scenario
                     pass
+        cache.set(key, user.scenarios, timeout=settings.REQUEST_CACHE_TIMEOUT)
 
     def authenticate(self, request, username=None, password=None):
         try:
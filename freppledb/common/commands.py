@@ -18,11 +18,14 @@
 from datetime import datetime
 import io
 from importlib import import_module
+import multiprocessing
 from operator import attrgetter
 import os
+import pickle
 import sys
 import logging
 from threading import Thread
+from time import time
 
 
 if __name__ == "__main__":
@@ -67,25 +70,45 @@ class CopyFromGenerator(io.TextIOBase):
     File-like object to handle exporting data to PostgreSQL over
     a copy command.
 
+    When a chunksize is passed, the lines produced by the iterator are
+    joined in buffers of that many lines. This reduces the number of calls
+    between the database driver and this object.
+
     Inspired on and copied from:
       https://hakibenita.com/fast-load-data-python-postgresql
     """
 
-    def __init__(self, itr):
-        self._iter = itr
+    def __init__(self, itr, chunksize=None):
+        self._iter = self._chunks(itr, chunksize) if chunksize else itr
         self._buff = ""
+        self._pos = 0
+
+    @staticmethod
+    def _chunks(itr, chunksize):
+        buff = []
+        for line in itr:
+            buff.append(line)
+            if len(buff) >= chunksize:
+                yield "".join(buff)
+                buff = []
+        if buff:
+            yield "".join(buff)
 
     def readable(self):
         return True
 
     def _read1(self, n=None):
-        while not self._buff:
+        while self._pos >= len(self._buff):
             try:
                 self._buff = next(self._iter)
+                self._pos = 0
             except StopIteration:
-                break
-        ret = self._buff[:n]
-        self._buff = self._buff[len(ret) :]
+                return ""
+        if n is None:
+            ret = self._buff[self._pos :]
+        else:
+            ret = self._buff[self._pos : self._pos + n]
+        self._pos += len(ret)
         return ret
 
     def read(self, n=None):
@@ -292,13 +315,70 @@ class PlanTaskParallel(PlanTask):
             self.name = name
             self.kwargs = kwargs
             self.exception = None
+            self.duration = None
 
         def run(self):
+            start = time()
             try:
                 self.seq.run(**self.kwargs)
             except Exception as e:
                 self.exception = e
             connections.close_all()
+            self.duration = time() - start
+
+    class _PlanTaskProcess:
+        """
+        Runs a group in a forked worker process, which gives it its own python
+        interpreter lock. The worker reports its duration and exception back
+        to the parent process over a pipe.
+        """
+
+        def __init__(self, seq, name, **kwargs):
+            self.seq = seq
+            self.name = name
+            self.kwargs = kwargs
+            self.exception = None
+            self.duration = None
+
+        def start(self):
+            ctx = multiprocessing.get_context("fork")
+            self.receiver, self.sender = ctx.Pipe(duplex=False)
+            self.process = ctx.Process(target=self.run, name=self.name)
+            self.process.start()
+            self.sender.close()
+
+        def run(self):
+            self.receiver.close()
+            start = time()
+            exception = None
+            try:
+                self.seq.run(**self.kwargs)
+            except Exception as e:
+                exception = e
+            connections.close_all()
+            try:
+                pickle.dumps(exception)
+            except Exception:
+                exception = Exception(str(exception))
+            self.sender.send((time() - start, exception))
+            self.sender.close()
+
+        def join(self):
+            # The report is read before joining: a worker can't exit while
+            # it's blocked on sending a report that doesn't fit in the pipe.
+            try:
+                report = self.receiver.recv()
+            except EOFError:
+                # The worker exited without reporting
+                report = None
+            self.receiver.close()
+            self.process.join()
+            if report:
+                self.duration, self.exception = report
+            else:
+                self.exception = Exception(
+                    "Process exited with code %s" % self.process.exitcode
+                )
 
     def __init__(self):
         self.groups = {}
@@ -316,20 +396,55 @@ class PlanTaskParallel(PlanTask):
                 longest = g.weight
         return longest
 
+    @staticmethod
+    def useProcess(threadname):
+        """
+        Returns true when a group needs to run in a separate process rather
+        than in a thread. Processes are only available on platforms that support
+        forking.
+        """
+        return (
+            threadname in settings.PLANTASK_PROCESSES
+            and "fork" in multiprocessing.get_all_start_methods()
+        )
+
     def run(self, **kwargs):
         threads = []
         for threadname, g in self.groups.items():
             g.timestamp = self.timestamp
             if g.weight is not None and g.weight >= 0:
                 threads.append(
-                    self._PlanTaskThread(
-                        g, name=threadname, **PlanTaskRegistry.getArguments()
-                    )
+                    (
+                        self._PlanTaskProcess
+                        if self.useProcess(threadname)
+                        else self._PlanTaskThread
+                    )(g, name=threadname, **PlanTaskRegistry.getArguments())
                 )
-        for t in threads:
+        # The processes are forked before any thread starts: a child process
+        # inheriting a lock that a thread holds could deadlock on it.
+        processes = [t for t in threads if isinstance(t, self._PlanTaskProcess)]
+        if processes:
+            # Forked processes can't share the database connections of this process
+            connections.close_all()
+        for t in processes:
             t.start()
+        for t in threads:
+            if t not in processes:
+                t.start()
         for t in threads:
             t.join()
+            if t.duration is not None:
+                logger.info(
+                    "Finished %s %s in %.1f seconds"
+                    % (
+                        "process"
+                        if isinstance(t, self._PlanTaskProcess)
+                        else "thread",
+                        t.name,
+                        t.duration,
+                    )
+                )
+        for t in threads:
             # Catch the exception from the worker thread
             if t.exception:
                 logger.error("Exception caught on thread %s" % t.name)
@@ -15,17 +15,30 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from copy import copy
+import hashlib
 from importlib import import_module
 import logging
+from threading import Lock
+from time import time
 
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.http import (
+    HttpResponse,
     HttpResponseNotAllowed,
     HttpResponseForbidden,
     HttpResponseServerError,
+    JsonResponse,
+    QueryDict,
 )
+from django.test.client import RequestFactory
+from django.utils import translation
+
+from freppledb.common.models import ReportCache, User
 
 logger = logging.getLogger(__name__)
 
@@ -50,11 +63,28 @@ class Dashboard:
       client browser.
       It should return HTML content for synchronous widgets.
       It should return a Django response object for asynchronous widgets.
+    - Class attribute 'cacheable' specifies whether the response of an
+      asynchronous widget is kept in the report cache, until the data changes.
   """
 
     __registry__ = {}
     __ready__ = False
 
+    # Number of widgets rendered concurrently by dispatchAll.
+    # The threads are shared by all requests, and each has a database connection.
+    renderThreads = 8
+    _executor = None
+
+    # Widgets being rendered, which other requests for them wait for
+    _rendering = {}
+    _renderingLock = Lock()
+
+    # Number of seconds dispatchAll waits for a widget
+    renderTimeout = 20
+
+    # Widgets taking longer than this number of seconds are logged
+    slowWidget = 5
+
     @classmethod
     def register(cls, w):
         cls.__registry__[w.name] = w
@@ -91,11 +121,219 @@ class Dashboard:
                 return HttpResponseServerError("This widget is synchronous")
             if not w.has_permission(request.user):
                 return HttpResponseForbidden()
-            return w.render(request)
+            return cls.renderWidget(request, w)
         except Exception as e:
             logger.error("Exception rendering widget %s: %s" % (w.name, e))
             return HttpResponseServerError("Server error")
 
+    @classmethod
+    def dispatchAll(cls, request):
+        """
+    Renders all asynchronous widgets on the dashboard of the user concurrently,
+    and returns them in a single JSON response.
+    Each widget comes with its HTTP status, its content and its rendering time.
+    Widgets that aren't ready within the timeout get status 504, and are then
+    requested separately from their url.
+    The rendering times are also returned in a Server-Timing header.
+    """
+        from freppledb.common.middleware import _thread_locals
+
+        if request.method != "GET":
+            return HttpResponseNotAllowed(["get"])
+
+        def renderOne(idx, w, args):
+            start = started[idx] = time()
+            wrequest = copy(request)
+            wrequest.GET = QueryDict(args.lstrip("?"))
+            setattr(_thread_locals, "request", wrequest)
+            translation.activate(request.LANGUAGE_CODE)
+            try:
+                response = cls.renderWidget(wrequest, w)
+                return (
+                    response.status_code,
+                    response.content.decode(response.charset),
+                    time() - start,
+                )
+            except Exception as e:
+                logger.error("Exception rendering widget %s: %s" % (w.name, e))
+                return 500, "Server error", time() - start
+            finally:
+                setattr(_thread_locals, "request", None)
+                translation.deactivate()
+                connections.close_all()
+
+        with cls._renderingLock:
+            if not cls._executor:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.renderThreads)
+        requested = time()
+        todo = list(cls.getWidgets(request.user, request.database))
+        started = [None] * len(todo)
+        futures = [
+            (w, args, cls._executor.submit(renderOne, idx, w, args))
+            for idx, (w, args) in enumerate(todo)
+        ]
+        widgets = []
+        try:
+            for idx, (w, args, future) in enumerate(futures):
+                while True:
+                    # The timeout counts from the moment the widget starts, or
+                    # from the request while it is waiting for a thread.
+                    start = started[idx]
+                    timeout = (start or requested) + cls.renderTimeout - time()
+                    try:
+                        status, content, duration = future.result(
+                            timeout=max(0, timeout)
+                        )
+                        break
+                    except TimeoutError:
+                        # A widget that is still rendering isn't rendered again
+                        # for its separate request, which waits for it instead.
+                        if start or future.cancel():
+                            status, content, duration = 504, None, None
+                            break
+                if status == 504:
+                    logger.warning(
+                        "Widget %s not ready after %s seconds"
+                        % (w.name, cls.renderTimeout)
+                    )
+                elif duration > cls.slowWidget:
+                    logger.warning("Widget %s took %.2f seconds" % (w.name, duration))
+                widgets.append(
+                    {
+                        "name": w.name,
+                        "url": "%s/widget/%s/%s" % (request.prefix, w.name, args),
+                        "status": status,
+                        "content": content,
+                        "time": duration,
+                    }
+                )
+        finally:
+            for w, args, future in futures:
+                future.cancel()
+        response = JsonResponse(widgets, safe=False)
+        response["Cache-Control"] = "no-cache, no-store"
+        response["Server-Timing"] = ", ".join(
+            "%s;dur=%.1f" % (i["name"], i["time"] * 1000)
+            for i in widgets
+            if i["time"] is not None
+        )
+        return response
+
+    @classmethod
+    def getWidgets(cls, user, database=DEFAULT_DB_ALIAS):
+        """
+    Yields the asynchronous widgets on the dashboard of a user, together with
+    the arguments in their url.
+    """
+        reg = cls.buildList()
+        mydashboard = user.getPreference("freppledb.common.cockpit", database=database)
+        if not mydashboard:
+            mydashboard = settings.DEFAULT_DASHBOARD
+        for i in mydashboard:
+            for j in i["cols"]:
+                for k in j["widgets"]:
+                    w = reg.get(k[0], None)
+                    if w and w.asynchronous and w.has_permission(user):
+                        args = w(**k[1]).args
+                        yield w, args() if callable(args) else args
+
+    @classmethod
+    def renderWidget(cls, request, w):
+        """
+    Renders an asynchronous widget, or returns its cached response.
+    When the same widget is already being rendered for another request, we
+    wait for that result instead. A render that doesn't finish within the
+    renderTimeout returns status 504 to the waiting requests.
+    """
+        key = w.getCacheKey(request)
+        if key:
+            key = hashlib.sha1(repr(("widget", key)).encode("utf-8")).hexdigest()
+            cached = ReportCache.get(key, request.database)
+            if cached:
+                return HttpResponse(cached[0], content_type=cached[1])
+            version = ReportCache.getVersion(request.database)
+        rendering = key or (
+            w.name,
+            request.database,
+            request.user.pk,
+            tuple(sorted(request.GET.items())),
+        )
+        with cls._renderingLock:
+            future = cls._rendering.get(rendering, None)
+            if not future:
+                cls._rendering[rendering] = Future()
+        if future:
+            try:
+                result = future.result(timeout=cls.renderTimeout)
+            except TimeoutError:
+                return HttpResponse("Widget not ready", status=504)
+            if result:
+                return HttpResponse(
+                    result[1], status=result[0], content_type=result[2]
+                )
+            # A streaming response can't be shared
+            return w.render(request)
+        result = None
+        try:
+            response = w.render(request)
+            result = (
+                None
+                if response.streaming
+                else (response.status_code, response.content, response["Content-Type"])
+            )
+            if key and result and result[0] == 200:
+                ReportCache.store(
+                    key, [result[1], result[2]], version, request.database
+                )
+        except Exception as e:
+            with cls._renderingLock:
+                cls._rendering.pop(rendering).set_exception(e)
+            raise
+        finally:
+            # When the render is interrupted the waiting requests get no
+            # result, and render the widget themselves
+            with cls._renderingLock:
+                future = cls._rendering.pop(rendering, None)
+            if future:
+                future.set_result(result)
+        return response
+
+    @classmethod
+    def refreshCache(cls, database=DEFAULT_DB_ALIAS):
+        """
+    Renders the cacheable widgets on the dashboards of all active users.
+    This is called after the cache is emptied, such that the users find the
+    widgets of a new plan ready in the cache.
+    """
+        from freppledb.common.middleware import _thread_locals
+
+        factory = RequestFactory()
+        try:
+            for user in User.objects.using(database).filter(is_active=True):
+                for w, args in cls.getWidgets(user, database):
+                    if not w.cacheable:
+                        continue
+                    request = factory.get("/widget/%s/%s" % (w.name, args))
+                    request.user = user
+                    request.database = database
+                    request.prefix = (
+                        "" if database == DEFAULT_DB_ALIAS else "/%s" % database
+                    )
+                    request.LANGUAGE_CODE = (
+                        settings.LANGUAGE_CODE
+                        if user.language == "auto"
+                        else user.language
+                    )
+                    setattr(_thread_locals, "request", request)
+                    translation.activate(request.LANGUAGE_CODE)
+                    try:
+                        cls.renderWidget(request, w)
+                    except Exception as e:
+                        logger.warning("Can't refresh widget %s: %s" % (w.name, e))
+        finally:
+            setattr(_thread_locals, "request", None)
+            translation.deactivate()
+
     @classmethod
     def createWidgetPermissions(cls, app):
         # Registered all permissions defined by dashboard widgets
@@ -147,6 +385,7 @@ class Widget:
     asynchronous = False  # Asynchroneous widget
     url = None  # URL opened when the header is clicked
     exporturl = False  # Enable or disable a download icon
+    cacheable = False  # Cache the response of an asynchronous widget
     args = ""  # Arguments passed in the url for asynchronous widgets
     javascript = ""  # Javascript called for rendering the widget
 
@@ -158,6 +397,28 @@ class Widget:
     def render(self, request=None):
         return "Not implemented"
 
+    @classmethod
+    def getCacheKey(cls, request):
+        """
+    Returns the data that identifies the cached response of the widget, or
+    None when the widget isn't cached.
+    By default this covers the widget arguments, the language, the scenario
+    and the reporting horizon of the user.
+    """
+        if not cls.cacheable:
+            return None
+        from freppledb.common.report import getHorizon
+
+        return (
+            cls.name,
+            sorted(request.GET.items()),
+            request.LANGUAGE_CODE,
+            request.database,
+            request.prefix,
+            getHorizon(request)[1:],
+            request.user.horizonbuckets,
+        )
+
     @classmethod
     def has_permission(cls, user):
         for perm in cls.permissions:
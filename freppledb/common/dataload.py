@@ -15,16 +15,22 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from contextlib import nullcontext
 from datetime import timedelta, datetime
 from decimal import Decimal
+from itertools import chain, repeat
+import json
 from logging import INFO, ERROR, WARNING, DEBUG
+import re
 from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.worksheet._read_only import ReadOnlyWorksheet
 from openpyxl.worksheet.worksheet import Worksheet
 
 from django import forms
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.core.validators import EMPTY_VALUES
-from django.db import DEFAULT_DB_ALIAS
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, models
 from django.db.models.fields import (
     IntegerField,
     AutoField,
@@ -46,10 +52,58 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.encoding import force_text
 from django.utils.text import get_text_list
 
-from .models import Comment
+from .commands import CopyFromGenerator
+from .models import (
+    AuditModel,
+    Comment,
+    CommentBuffer,
+    HierarchyModel,
+    Parameter,
+    ReportCache,
+)
+
+# The auto-filter element in the XML of a worksheet
+autoFilterPattern = re.compile(rb'<(?:\w+:)?autoFilter\s[^>]*?\bref="([^"]+)"')
+
+
+def _getAutoFilter(worksheet):
+    """
+    Returns the range of the auto-filter of a worksheet, or None.
+    A read-only worksheet doesn't read the auto-filter. Its element comes after
+    the data rows, so we scan the XML of the worksheet for it.
+    """
+    if isinstance(worksheet, Worksheet):
+        return worksheet.auto_filter.ref
+    elif not isinstance(worksheet, ReadOnlyWorksheet):
+        return None
+    with worksheet._get_source() as src:
+        tail = b""
+        while True:
+            chunk = src.read(1048576)
+            if not chunk:
+                return None
+            chunk = tail + chunk
+            match = autoFilterPattern.search(chunk)
+            if match:
+                return match.group(1).decode("utf-8")
+            # An element can span two chunks
+            tail = chunk[-256:]
 
 
-def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
+def parseExcelWorksheet(
+    model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False, bulk=None
+):
+    """
+    This method:
+      - reads the rows of an Excel worksheet, or an iterator over rows of cell values
+      - creates or updates the database records
+      - yields a list of data validation errors
+
+    Only the cell values are read. With a worksheet of a workbook opened in
+    read-only mode the rows are streamed from the file, so the memory use
+    doesn't depend on the size of the workbook.
+    """
+
     class MappedRow:
         """
         A row of data is made to behave as a dictionary.
@@ -77,7 +131,7 @@ def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=
 
         def empty(self):
             for i in self.data:
-                if i.value:
+                if i:
                     return False
             return True
 
@@ -89,11 +143,7 @@ def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=
             else:
                 idx = None
                 field = None
-            data = (
-                self.data[idx].value
-                if idx is not None and idx < len(self.data)
-                else None
-            )
+            data = self.data[idx] if idx is not None and idx < len(self.data) else None
             if isinstance(field, (IntegerField, AutoField)):
                 if isinstance(data, (Decimal, float, int)):
                     data = int(data)
@@ -150,7 +200,7 @@ def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=
             return self.headers.keys()
 
         def values(self):
-            return [i.value for i in self.data]
+            return list(self.data)
 
         def items(self):
             return {col: self.__getitem__(col) for col in self.headers.keys()}
@@ -158,14 +208,40 @@ def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=
         __setitem__ = None
         __delitem__ = None
 
+    if hasattr(data, "iter_rows"):
+        if hasattr(data, "reset_dimensions"):
+            # The dimensions recorded in the file of a read-only worksheet
+            # can't be trusted
+            data.reset_dimensions()
+        autofilter = _getAutoFilter(data)
+        if autofilter:
+            # Only process data in the excel auto-filter range.
+            # The rows before the range are replaced by empty rows, to keep the
+            # row numbers in the messages correct.
+            bounds = CellRange(autofilter).bounds
+            data = chain(
+                repeat((), bounds[1] - 1),
+                data.iter_rows(
+                    min_row=bounds[1],
+                    max_row=(
+                        min(bounds[3], data.max_row) if data.max_row else bounds[3]
+                    ),
+                    values_only=True,
+                ),
+            )
+        else:
+            data = data.iter_rows(values_only=True)
+
     if hasattr(model, "parseData"):
         # Some models have their own special uploading logic
         return model.parseData(data, MappedRow, user, database, ping)
     else:
-        return _parseData(model, data, MappedRow, user, database, ping)
+        return _parseData(model, data, MappedRow, user, database, ping, bulk)
 
 
-def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
+def parseCSVdata(
+    model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False, bulk=None
+):
     """
     This method:
       - reads CSV data from an input iterator
@@ -176,6 +252,10 @@ def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
       - the first row contains a header, listing all field names
       - a first character # marks a comment line
       - empty rows are skipped
+
+    When the bulk argument is true, or when it is None and the parameter
+    "upload.bulk" is set to true, the records are loaded in batches rather
+    than one by one. See _BulkLoader for details.
     """
 
     class MappedRow:
@@ -259,10 +339,102 @@ def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
         # Some models have their own special uploading logic
         return model.parseData(data, MappedRow, user, database, ping)
     else:
-        return _parseData(model, data, MappedRow, user, database, ping)
+        return _parseData(model, data, MappedRow, user, database, ping, bulk)
+
+
+def parseJSONdata(
+    model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False, bulk=None
+):
+    """
+    This method:
+      - reads newline delimited JSON data from an input iterator
+      - creates or updates the database records
+      - yields a list of data validation errors
 
+    The data must follow the following format:
+      - every line contains a JSON object, mapping field names to values
+      - empty lines are skipped
 
-def _parseData(model, data, rowmapper, user, database, ping):
+    Consecutive objects with the same keys are passed as a single block of
+    rows to parseCSVdata. The row numbers in the messages refer to the lines
+    of the input.
+    """
+    lines = enumerate(data, start=1)
+    errors = []
+    pending = None
+
+    def parseLine(linenumber, line):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            errors.append((ERROR, linenumber, None, None, "Invalid JSON: %s" % e))
+            return None
+        if not isinstance(record, dict):
+            errors.append((ERROR, linenumber, None, None, "Expected a JSON object"))
+            return None
+        return record
+
+    def toCell(value):
+        if value is None:
+            return ""
+        elif isinstance(value, (dict, list)):
+            return json.dumps(value)
+        else:
+            return str(value)
+
+    def block(record):
+        # Yield a header row and the data rows till the keys change
+        nonlocal pending
+        pending = None
+        keys = list(record.keys())
+        yield keys
+        yield [toCell(record[k]) for k in keys]
+        for linenumber, line in lines:
+            record = parseLine(linenumber, line)
+            if record is None:
+                # Keep the row numbers aligned with the line numbers
+                yield []
+            elif record.keys() == set(keys):
+                yield [toCell(record[k]) for k in keys]
+            else:
+                pending = (linenumber, record)
+                return
+
+    for linenumber, line in lines:
+        record = parseLine(linenumber, line)
+        if record is not None:
+            pending = (linenumber, record)
+            break
+    yield from errors
+    errors.clear()
+
+    while pending:
+        # The header row of the block gets row number 1
+        offset = pending[0] - 2
+        for msg in parseCSVdata(
+            model, block(pending[1]), user=user, database=database, ping=ping, bulk=bulk
+        ):
+            if errors:
+                yield from errors
+                errors.clear()
+            if msg[1] is None:
+                yield msg
+            else:
+                yield (msg[0], msg[1] + offset) + msg[2:]
+        yield from errors
+        errors.clear()
+
+
+def _parseData(model, data, rowmapper, user, database, ping, bulk=None):
+    # Postpone the processing of the individual saves till the end of the upload
+    with model.bulkUpdate(database) if issubclass(model, AuditModel) else nullcontext():
+        yield from _parseRows(model, data, rowmapper, user, database, ping, bulk)
+
+
+def _parseRows(model, data, rowmapper, user, database, ping, bulk):
 
     selfReferencing = []
 
@@ -281,9 +453,14 @@ def _parseData(model, data, rowmapper, user, database, ping):
     rownumber = 0
     changed = 0
     added = 0
-    content_type_id = ContentType.objects.get_for_model(
-        model, for_concrete_model=False
-    ).pk
+    if user:
+        try:
+            limit = int(Parameter.getValue("upload.comment_limit", database, "0"))
+        except ValueError:
+            limit = 0
+        comments = CommentBuffer(model, user, database, limit=limit)
+    else:
+        comments = None
 
     # Call the beforeUpload method if it is defined
     if hasattr(model, "beforeUpload"):
@@ -294,26 +471,12 @@ def _parseData(model, data, rowmapper, user, database, ping):
     has_pk_field = False
     processed_header = False
     rowWrapper = rowmapper()
-
-    # Detect excel autofilter data tables
-    if isinstance(data, Worksheet) and data.auto_filter.ref:
-        bounds = CellRange(data.auto_filter.ref).bounds
-    else:
-        bounds = None
+    loader = None
 
     for row in data:
 
         rownumber += 1
-        if bounds:
-            # Only process data in the excel auto-filter range
-            if rownumber < bounds[1]:
-                continue
-            elif rownumber > bounds[3]:
-                break
-            else:
-                rowWrapper.setData(row)
-        else:
-            rowWrapper.setData(row)
+        rowWrapper.setData(row)
 
         # Case 1: Skip empty rows
         if rowWrapper.empty():
@@ -408,16 +571,6 @@ def _parseData(model, data, rowmapper, user, database, ping):
             if errors:
                 raise NameError("Can't proceed")
 
-            # Create a form class that will be used to validate the data
-            fields = [i.name for i in headers if i]
-            if hasattr(model, "getModelForm"):
-                UploadForm = model.getModelForm(tuple(fields), database=database)
-            else:
-                UploadForm = modelform_factory(
-                    model, fields=tuple(fields), formfield_callback=formfieldCallback
-                )
-            rowWrapper = rowmapper(headers)
-
             # Get natural keys for the class
             natural_key = None
             if hasattr(model.objects, "get_by_natural_key"):
@@ -427,8 +580,41 @@ def _parseData(model, data, rowmapper, user, database, ping):
                     model.natural_key, tuple
                 ):
                     natural_key = model.natural_key
+            rowWrapper = rowmapper(headers)
+
+            # Use the bulk loader when possible
+            if bulk is None:
+                bulk = (
+                    Parameter.getValue("upload.bulk", database, "false").lower()
+                    == "true"
+                )
+            if bulk and _BulkLoader.supports(model):
+                loader = _BulkLoader(
+                    model, headers, has_pk_field, natural_key, comments, database
+                )
+                continue
+
+            # Create a form class that will be used to validate the data
+            fields = [i.name for i in headers if i]
+            if hasattr(model, "getModelForm"):
+                UploadForm = model.getModelForm(tuple(fields), database=database)
+            else:
+                UploadForm = modelform_factory(
+                    model, fields=tuple(fields), formfield_callback=formfieldCallback
+                )
+
+        # Case 3a: Process a data row with the bulk loader
+        elif loader:
+            if ping and rownumber % 50 == 0:
+                yield (DEBUG, rownumber, None, None, None)
+            try:
+                for error in loader.add(rownumber, rowWrapper):
+                    yield error
+            except Exception as e:
+                errors += 1
+                yield (ERROR, None, None, None, "Exception during upload: %s" % e)
 
-        # Case 3: Process a data row
+        # Case 3b: Process a data row
         else:
             try:
                 # Step 1: Send a ping-alive message to make the upload interruptable
@@ -493,26 +679,17 @@ def _parseData(model, data, rowmapper, user, database, ping):
                             for x in selfReferencing:
                                 if x.cache is not None and obj.pk not in x.cache:
                                     x.cache[obj.pk] = obj
-                        if user:
+                        if comments:
                             if it:
-                                Comment(
-                                    user_id=user.id,
-                                    content_type_id=content_type_id,
-                                    object_pk=obj.pk,
-                                    object_repr=force_text(obj)[:200],
-                                    type="change",
-                                    comment="Changed %s."
+                                comments.add(
+                                    obj.pk,
+                                    obj,
+                                    "change",
+                                    "Changed %s."
                                     % get_text_list(form.changed_data, "and"),
-                                ).save(using=database)
+                                )
                             else:
-                                Comment(
-                                    user_id=user.id,
-                                    content_type_id=content_type_id,
-                                    object_pk=obj.pk,
-                                    object_repr=force_text(obj)[:200],
-                                    type="add",
-                                    comment="Added",
-                                ).save(using=database)
+                                comments.add(obj.pk, obj, "add", "Added")
                     else:
                         # Validation fails
                         for error in form.non_field_errors():
@@ -533,6 +710,24 @@ def _parseData(model, data, rowmapper, user, database, ping):
                 errors += 1
                 yield (ERROR, None, None, None, "Exception during upload: %s" % e)
 
+    if loader:
+        try:
+            for error in loader.finish():
+                yield error
+        except Exception as e:
+            errors += 1
+            yield (ERROR, None, None, None, "Exception during upload: %s" % e)
+        changed += loader.changed
+        added += loader.added
+        errors += loader.errors
+
+    if comments:
+        try:
+            comments.close()
+        except Exception as e:
+            errors += 1
+            yield (ERROR, None, None, None, "Exception during upload: %s" % e)
+
     yield (
         INFO,
         None,
@@ -551,6 +746,444 @@ def _parseData(model, data, rowmapper, user, database, ping):
     )
 
 
+class _BulkLoader:
+    """
+    Loads uploaded data rows in batches rather than one by one:
+      - each row is validated and converted with the form fields of the model
+      - a batch of rows is copied into a temporary staging table
+      - foreign keys are validated with a single query per field
+      - the staging table is merged into the target table with a single
+        INSERT ... ON CONFLICT statement, which also writes the audit comments
+
+    Only models without custom save or validation logic can be loaded this way.
+    """
+
+    batchsize = 10000
+
+    @staticmethod
+    def supports(model):
+        if (
+            model._meta.proxy
+            or hasattr(model, "getModelForm")
+            or hasattr(model, "beforeUpload")
+        ):
+            return False
+        for cls in model.__mro__:
+            if cls in (models.Model, AuditModel, HierarchyModel):
+                continue
+            for method in ("save", "clean", "clean_fields", "full_clean"):
+                if method in cls.__dict__:
+                    return False
+        return True
+
+    def __init__(self, model, headers, has_pk_field, natural_key, comments, database):
+        self.model = model
+        self.comments = comments
+        # With a comment limit, the comments are staged till we know the total
+        self.comment_table = (
+            "tmp_upload_comment" if comments and comments.limit else "common_comment"
+        )
+        self.database = database
+        self.connection = connections[database]
+        self.table = self.connection.ops.quote_name(model._meta.db_table)
+        self.pk = model._meta.pk
+        self.fields = []
+        for f in headers:
+            if f and f not in self.fields:
+                self.fields.append(f)
+        self.formfields = {
+            f.name: f.formfield(localize=True)
+            for f in self.fields
+            if not isinstance(f, RelatedField)
+        }
+        self.natural_key = (
+            [model._meta.get_field(i) for i in natural_key]
+            if natural_key and not has_pk_field
+            else None
+        )
+        self.content_type_id = ContentType.objects.get_for_model(
+            model, for_concrete_model=False
+        ).pk
+        self.rows = []
+        self.staged = False
+        self.added = 0
+        self.changed = 0
+        self.errors = 0
+
+    def add(self, rownumber, row):
+        """
+        Validates a data row and adds it to the current batch.
+        Yields the validation errors.
+        """
+        values = [rownumber]
+        ok = True
+        for f in self.fields:
+            val = row[f.name]
+            try:
+                if isinstance(f, RelatedField):
+                    if val in EMPTY_VALUES:
+                        if not f.null:
+                            raise ValidationError(
+                                forms.Field.default_error_messages["required"]
+                            )
+                        val = None
+                    else:
+                        val = f.target_field.to_python(val)
+                elif self.formfields[f.name]:
+                    val = self.formfields[f.name].clean(val)
+                else:
+                    val = f.to_python(val)
+            except ValidationError as e:
+                ok = False
+                for msg in e.messages:
+                    self.errors += 1
+                    yield (ERROR, rownumber, f.name, row[f.name], msg)
+            values.append(val)
+        if ok:
+            self.rows.append(values)
+            if len(self.rows) >= self.batchsize:
+                for error in self.flush():
+                    yield error
+
+    def finish(self):
+        """
+        Processes the last batch and cleans up the staging tables.
+        """
+        try:
+            for error in self.flush():
+                yield error
+            if self.staged:
+                written = True
+                if self.comment_table != "common_comment":
+                    # Copy the staged comments, unless there are too many
+                    written = self.added + self.changed <= self.comments.limit
+                    if written:
+                        self.connection.cursor().execute("""
+                            insert into common_comment
+                              (user_id, content_type_id, object_pk, object_repr,
+                              type, comment, lastmodified, processed)
+                            select
+                              user_id, content_type_id, object_pk, object_repr,
+                              type, comment, lastmodified, processed
+                            from tmp_upload_comment
+                            order by id
+                            """)
+                if self.comments:
+                    self.comments.register(self.added, self.changed, written)
+                    if written and (self.added or self.changed):
+                        Comment.notify(self.database)
+        finally:
+            self.drop()
+        if self.added or self.changed:
+            # The bulk statements bypass the signals of the models
+            ReportCache.invalidateOnCommit(self.database)
+
+    def drop(self):
+        """
+        Drops the staging tables, also when loading a batch failed.
+        """
+        if not self.staged:
+            return
+        self.staged = False
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("drop table if exists tmp_upload")
+            cursor.execute("drop table if exists tmp_upload_comment")
+        except DatabaseError:
+            # The rollback of a failed transaction drops them
+            pass
+
+    @staticmethod
+    def _copyValue(value):
+        if value is None:
+            return "\\N"
+        elif isinstance(value, bool):
+            return "t" if value else "f"
+        elif isinstance(value, timedelta):
+            return "%s seconds" % value.total_seconds()
+        return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+            .replace("\v", "\\v")
+        )
+
+    def _getData(self):
+        for row in self.rows:
+            yield "%s\n" % "\v".join(self._copyValue(i) for i in row)
+
+    def flush(self):
+        """
+        Loads the current batch into the target table.
+        Yields the errors that are detected in the database.
+        """
+        if not self.rows:
+            return
+        quote = self.connection.ops.quote_name
+        cursor = self.connection.cursor()
+        stage_pk = self.pk not in self.fields
+
+        # Step 1: Copy the rows into the staging table
+        if not self.staged:
+            # Leftovers of an interrupted upload on this connection are replaced
+            cursor.execute("drop table if exists tmp_upload")
+            cursor.execute(
+                "create temporary table tmp_upload (rownumber integer, %s)"
+                % ", ".join(
+                    "%s %s"
+                    % (
+                        quote(f.column),
+                        (
+                            f.rel_db_type(self.connection)
+                            if isinstance(f, models.AutoField)
+                            else f.db_type(self.connection)
+                        ),
+                    )
+                    for f in ([self.pk] if stage_pk else []) + self.fields
+                )
+            )
+            if self.comment_table != "common_comment":
+                cursor.execute("drop table if exists tmp_upload_comment")
+                cursor.execute(
+                    "create temporary table tmp_upload_comment "
+                    "(like common_comment including defaults)"
+                )
+            self.staged = True
+        else:
+            cursor.execute("truncate table tmp_upload")
+        cursor.copy_from(
+            CopyFromGenerator(self._getData()),
+            "tmp_upload",
+            columns=["rownumber"] + [quote(f.column) for f in self.fields],
+            size=65536,
+            sep="\v",
+        )
+        self.rows = []
+
+        # Step 2: Validate the foreign keys.
+        # Self-referencing keys can point to another record in the staging table,
+        # which requires repeating the check when records are rejected.
+        invalid = []
+        repeat = True
+        while repeat:
+            repeat = False
+            for f in self.fields:
+                if not isinstance(f, RelatedField):
+                    continue
+                selfref = f.remote_field.model == self.model and not stage_pk
+                cursor.execute(
+                    """
+                    select rownumber, %s
+                    from tmp_upload
+                    where %s is not null
+                    and not exists (
+                      select 1 from %s as target where target.%s = tmp_upload.%s
+                      )
+                    %s
+                    """
+                    % (
+                        quote(f.column),
+                        quote(f.column),
+                        quote(f.remote_field.model._meta.db_table),
+                        quote(f.target_field.column),
+                        quote(f.column),
+                        (
+                            """
+                        and not exists (
+                          select 1 from tmp_upload as selfref
+                          where selfref.%s = tmp_upload.%s
+                          )
+                        """ % (quote(self.pk.column), quote(f.column))
+                            if selfref
+                            else ""
+                        ),
+                    )
+                )
+                rejected = []
+                for rownumber, value in cursor.fetchall():
+                    rejected.append(rownumber)
+                    invalid.append(
+                        (
+                            ERROR,
+                            rownumber,
+                            f.name,
+                            value,
+                            force_text(
+                                _(
+                                    "Select a valid choice. That choice is not one of the available choices."
+                                )
+                            ),
+                        )
+                    )
+                if rejected:
+                    cursor.execute(
+                        "delete from tmp_upload where rownumber = any(%s)", (rejected,)
+                    )
+                    if any(
+                        i.remote_field.model == self.model
+                        for i in self.fields
+                        if isinstance(i, RelatedField)
+                    ):
+                        repeat = True
+        invalid.sort(key=lambda x: x[1])
+        for error in invalid:
+            self.errors += 1
+            yield error
+
+        # Step 3: Find the primary key of existing records using the natural key.
+        # New records get a value from the sequence of an autofield.
+        if stage_pk:
+            if self.natural_key:
+                cursor.execute(
+                    "update tmp_upload set %s = target.%s from %s as target where %s"
+                    % (
+                        quote(self.pk.column),
+                        quote(self.pk.column),
+                        self.table,
+                        " and ".join(
+                            (
+                                (
+                                    "target.%s is not distinct from tmp_upload.%s"
+                                    if f.null
+                                    else "target.%s = tmp_upload.%s"
+                                )
+                                % (quote(f.column), quote(f.column))
+                                if f in self.fields
+                                else "target.%s is null" % quote(f.column)
+                            )
+                            for f in self.natural_key
+                        ),
+                    )
+                )
+            if isinstance(self.pk, models.AutoField):
+                cursor.execute(
+                    "update tmp_upload set %s = nextval(pg_get_serial_sequence(%%s, %%s)) where %s is null"
+                    % (quote(self.pk.column), quote(self.pk.column)),
+                    (self.model._meta.db_table, self.pk.column),
+                )
+
+        # Step 4: When a key appears multiple times in the data, the last row wins
+        cursor.execute("""
+            delete from tmp_upload
+            using tmp_upload as later
+            where later.%s = tmp_upload.%s and later.rownumber > tmp_upload.rownumber
+            """ % (quote(self.pk.column), quote(self.pk.column)))
+
+        # Step 5: Merge into the target table and write the audit comments
+        now = datetime.now()
+        insert_fields = ([self.pk] if stage_pk else []) + self.fields
+        update_fields = [f for f in self.fields if f != self.pk]
+        defaults = []
+        for f in self.model._meta.concrete_fields:
+            if f in insert_fields:
+                continue
+            if f.name == "lastmodified" and issubclass(self.model, AuditModel):
+                defaults.append((f, now))
+            else:
+                val = f.get_default()
+                if val is not None:
+                    defaults.append(
+                        (f, f.get_db_prep_save(val, connection=self.connection))
+                    )
+        if update_fields:
+            assignments = [
+                "%s = excluded.%s" % ((quote(f.column),) * 2) for f in update_fields
+            ]
+            if issubclass(self.model, AuditModel):
+                assignments.append("lastmodified = excluded.lastmodified")
+            if issubclass(self.model, HierarchyModel) and any(
+                f.name == "owner" for f in update_fields
+            ):
+                # Trigger a rebuild of the hierarchy only when it changes
+                assignments.extend(
+                    "%s = case when target.owner_id is distinct from excluded.owner_id "
+                    "then null else target.%s end" % (f, f)
+                    for f in ("lft", "rght", "lvl")
+                )
+            conflict = "do update set %s where (%s) is distinct from (%s)" % (
+                ", ".join(assignments),
+                ", ".join("target.%s" % quote(f.column) for f in update_fields),
+                ", ".join("excluded.%s" % quote(f.column) for f in update_fields),
+            )
+        else:
+            conflict = "do nothing"
+        cursor.execute(
+            """
+            with changes as (
+              select tmp_upload.%s as pk,
+                array_remove(array[%s]::text[], null) as fields
+              from tmp_upload
+              inner join %s as target on target.%s = tmp_upload.%s
+              ),
+            merged as (
+              insert into %s as target (%s)
+              select %s from tmp_upload
+              on conflict (%s) %s
+              returning target.%s as pk, (target.xmax = 0) as added
+              ),
+            comments as (
+              insert into %s
+                (user_id, content_type_id, object_pk, object_repr, type,
+                comment, lastmodified, processed)
+              select
+                %%s, %%s, merged.pk::text, left(merged.pk::text, 200),
+                case when merged.added then 'add' else 'change' end,
+                case
+                  when merged.added then 'Added'
+                  when cardinality(changes.fields) = 1
+                    then 'Changed ' || changes.fields[1] || '.'
+                  else 'Changed '
+                    || array_to_string(changes.fields[1:cardinality(changes.fields) - 1], ', ')
+                    || ' and ' || changes.fields[cardinality(changes.fields)] || '.'
+                  end,
+                %%s, false
+              from merged
+              left outer join changes on changes.pk = merged.pk
+              where %%s
+              )
+            select
+              count(*) filter (where added),
+              count(*) filter (where not added)
+            from merged
+            """
+            % (
+                quote(self.pk.column),
+                ", ".join(
+                    "case when target.%s is distinct from tmp_upload.%s then '%s' end"
+                    % (quote(f.column), quote(f.column), f.name)
+                    for f in update_fields
+                )
+                or "null",
+                self.table,
+                quote(self.pk.column),
+                quote(self.pk.column),
+                self.table,
+                ", ".join(
+                    quote(f.column) for f in insert_fields + [i[0] for i in defaults]
+                ),
+                ", ".join(
+                    ["tmp_upload.%s" % quote(f.column) for f in insert_fields]
+                    + ["%s"] * len(defaults)
+                ),
+                quote(self.pk.column),
+                conflict,
+                quote(self.pk.column),
+                self.comment_table,
+            ),
+            [i[1] for i in defaults]
+            + [
+                self.comments.user_id if self.comments else None,
+                self.content_type_id,
+                now,
+                self.comments is not None,
+            ],
+        )
+        added, changed = cursor.fetchone()
+        self.added += added
+        self.changed += changed
+
+
 class BulkForeignKeyFormField(forms.fields.Field):
     def __init__(
         self,
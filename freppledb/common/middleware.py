@@ -205,15 +205,17 @@ class MultiDBMiddleware:
             for i in settings.DATABASES:
                 try:
                     if settings.DATABASES[i]["regexp"].match(request.path):
-                        scenario = Scenario.objects.using(DEFAULT_DB_ALIAS).get(name=i)
-                        if scenario.status != "In use":
+                        status = Scenario.getStatus(i)
+                        if status is None:
+                            continue
+                        elif status != "In use":
                             return HttpResponseNotFound("Scenario not in use")
                         request.prefix = "/%s" % i
                         request.path_info = request.path_info[len(request.prefix) :]
                         request.path = request.path[len(request.prefix) :]
                         request.database = i
                         if hasattr(request.user, "_state"):
-                            request.user._state.db = i.name
+                            request.user._state.db = i
                         response = self.get_response(request)
                         if not response.streaming:
                             # Note: Streaming response get the request field cleared in the
@@ -0,0 +1,45 @@
+#
+# Copyright (C) 2021 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("common", "0028_parameter_upload_bulk")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReportCache",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        primary_key=True, serialize=False, verbose_name="identifier"
+                    ),
+                ),
+                ("key", models.CharField(max_length=40, verbose_name="key")),
+                ("rownumber", models.IntegerField(verbose_name="row number")),
+                ("data", models.BinaryField(null=True, verbose_name="data")),
+            ],
+            options={
+                "db_table": "common_reportcache",
+                "unique_together": {("key", "rownumber")},
+                "default_permissions": [],
+            },
+        )
+    ]
@@ -0,0 +1,40 @@
+#
+# Copyright (C) 2021 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("common", "0030_parameter_upload_comment_limit")]
+
+    operations = [
+        migrations.RunSQL("delete from common_reportcache", migrations.RunSQL.noop),
+        migrations.AddField(
+            model_name="reportcache",
+            name="version",
+            field=models.BigIntegerField(default=0, verbose_name="version"),
+        ),
+        migrations.RunSQL(
+            [
+                "create sequence common_reportcache_version",
+                # Mark the first value as used, so the next value differs
+                "select setval('common_reportcache_version', 1)",
+            ],
+            "drop sequence common_reportcache_version",
+        ),
+    ]
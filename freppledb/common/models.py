@@ -14,14 +14,18 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+from contextlib import contextmanager
 from datetime import datetime
 from importlib import import_module
 import inspect
+from itertools import chain
 import json
 import logging
 from multiprocessing import Process
+import pickle
 from psycopg2.extras import execute_batch
 import sys
+from threading import local
 import time
 
 from django.conf import settings
@@ -29,12 +33,13 @@ from django.contrib.admin.utils import quote
 from django.contrib.auth.models import AbstractUser, Group
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core import mail
 from django.core.validators import FileExtensionValidator
-from django.db import models, DEFAULT_DB_ALIAS, connections, transaction
-from django.db.models import Q
-from django.db.models.signals import pre_delete
+from django.db import models, DEFAULT_DB_ALIAS, connections, router, transaction
+from django.db.models import DEFERRED, Q
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch.dispatcher import receiver
 from django import forms
 from django.forms.models import modelform_factory
@@ -43,7 +48,7 @@ from django.utils import timezone
 from django.utils.encoding import force_text
 from django.utils.html import mark_safe, escape
 from django.utils.translation import gettext_lazy as _
-from django.utils.text import capfirst
+from django.utils.text import capfirst, get_text_list
 
 from .fields import JSONBField
 from freppledb import runFunction
@@ -51,6 +56,22 @@ from freppledb import runFunction
 logger = logging.getLogger(__name__)
 
 
+def getCacheKey(group, key):
+    """
+    Returns the key of a cache entry in a group.
+    All entries of a group are invalidated at once with invalidateCache.
+    """
+    version = cache.get("version_%s" % group)
+    if version is None:
+        version = time.time()
+        cache.set("version_%s" % group, version, None)
+    return "%s_%s_%s" % (group, version, key)
+
+
+def invalidateCache(group):
+    cache.delete("version_%s" % group)
+
+
 class HierarchyModel(models.Model):
     lft = models.PositiveIntegerField(
         db_index=True, editable=False, null=True, blank=True
@@ -70,35 +91,305 @@ class HierarchyModel(models.Model):
         on_delete=models.SET_NULL,
     )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the name and owner to detect changes of the hierarchy
+        instance._loaded_node = (
+            instance.__dict__.get("name", DEFERRED),
+            instance.__dict__.get("owner_id", DEFERRED),
+        )
+        return instance
+
     def save(self, *args, **kwargs):
-        # Trigger recalculation of the hieracrhy.
-        # TODO this triggers the recalculation in too many cases, including a lot
-        # of changes which don't require it. Alternative solution is to use the
-        # pre-save signal which has more information.
-        self.lft = None
-        self.rght = None
-        self.lvl = None
+        update_fields = kwargs.get("update_fields", None)
+        if (
+            update_fields is not None
+            and "owner" not in update_fields
+            and "owner_id" not in update_fields
+        ) or (
+            not self._state.adding
+            and not kwargs.get("force_insert", False)
+            and getattr(self, "_loaded_node", None) == (self.pk, self.owner_id)
+        ):
+            # The hierarchy doesn't change.
+            # The hierarchy fields aren't saved, as they may have been renumbered
+            # since this object was read from the database.
+            if update_fields is None and not kwargs.get("force_insert", False):
+                kwargs["update_fields"] = [
+                    f.attname
+                    for f in self._meta.concrete_fields
+                    if not f.primary_key
+                    and f.attname not in ("lft", "rght", "lvl")
+                    and f.attname in self.__dict__
+                ]
+            super().save(*args, **kwargs)
+            return
 
-        # Call the real save() method
-        super().save(*args, **kwargs)
+        database = kwargs.get("using", None) or router.db_for_write(
+            self.__class__, instance=self
+        )
+        if self._isDeferred(database):
+            # The hierarchy is rebuilt at the end of the bulkUpdate block
+            self.lft = None
+            self.rght = None
+            self.lvl = None
+            super().save(*args, **kwargs)
+            self._loaded_node = (self.pk, self.owner_id)
+            return
+        table = connections[database].ops.quote_name(self._meta.db_table)
+        with transaction.atomic(using=database), connections[
+            database
+        ].cursor() as cursor:
+            current = self._lockHierarchy(cursor, table, self.pk)
+            if not current:
+                # The hierarchy will be rebuilt from scratch
+                self.lft = None
+                self.rght = None
+                self.lvl = None
+                super().save(*args, **kwargs)
+            elif current[0] is None:
+                # A new node is added as the last child of its owner
+                self.lft = None
+                self.rght = None
+                self.lvl = None
+                super().save(*args, **kwargs)
+                if self.owner_id == self.pk:
+                    # We created a loop. The rebuild will report it.
+                    right = None
+                elif self.owner_id:
+                    cursor.execute(
+                        "select rght, lvl from %s where name = %%s" % table,
+                        (self.owner_id,),
+                    )
+                    right, level = cursor.fetchone()
+                    cursor.execute(
+                        """
+                        update %s set
+                          lft = case when lft > %%s then lft + 2 else lft end,
+                          rght = rght + 2
+                        where rght >= %%s
+                        """
+                        % table,
+                        (right, right),
+                    )
+                    level += 1
+                else:
+                    right = self._maxRight(cursor, table) + 1
+                    level = 0
+                if right:
+                    cursor.execute(
+                        "update %s set lft = %%s, rght = %%s, lvl = %%s "
+                        "where name = %%s" % table,
+                        (right, right + 1, level, self.pk),
+                    )
+            else:
+                # An existing node, possibly moving its subtree to a new owner
+                self.lft, self.rght, self.lvl = current[0:3]
+                super().save(*args, **kwargs)
+                if current[3] != self.owner_id and not self._moveSubtree(
+                    cursor, table, current
+                ):
+                    # We created a loop. The rebuild will report it.
+                    cursor.execute(
+                        "update %s set lft = null where name = %%s" % table,
+                        (self.pk,),
+                    )
+            cursor.execute(
+                "select lft, rght, lvl from %s where name = %%s" % table, (self.pk,)
+            )
+            self.lft, self.rght, self.lvl = cursor.fetchone()
+        self._loaded_node = (self.pk, self.owner_id)
+
+    def _lockHierarchy(self, cursor, table, name):
+        """
+        Serializes the changes to the hierarchy of the table.
+        Returns the lft, rght and lvl fields and the owner of the node. These
+        are all None for a new node.
+        Nothing is returned when the hierarchy needs to be rebuilt anyway.
+        """
+        cursor.execute("select pg_advisory_xact_lock(hashtext(%s))", (table,))
+        # This uses the index on the lft field
+        cursor.execute("select 1 from %s where lft is null limit 1" % table)
+        if cursor.fetchone():
+            return None
+        cursor.execute(
+            "select lft, rght, lvl, owner_id from %s where name = %%s" % table,
+            (name,),
+        )
+        return cursor.fetchone() or (None, None, None, None)
+
+    @staticmethod
+    def _maxRight(cursor, table):
+        """
+        Returns the highest rght value in the table.
+        The numbering is contiguous, so it follows from the node with the
+        highest lft value, which is a leaf: the rght values of its ancestors
+        come after it. This uses the index on the lft field.
+        """
+        cursor.execute(
+            "select rght + lvl from %s where lft is not null order by lft desc limit 1"
+            % table
+        )
+        current = cursor.fetchone()
+        return current[0] if current else 0
+
+    def _moveSubtree(self, cursor, table, current):
+        """
+        Moves a node and its descendants to become the last child of its new
+        owner, shifting the nodes in between.
+        """
+        left, right, level = current[0:3]
+        width = right - left + 1
+        if self.owner_id:
+            cursor.execute(
+                "select lft, rght, lvl from %s where name = %%s" % table,
+                (self.owner_id,),
+            )
+            ownerleft, ownerright, ownerlevel = cursor.fetchone()
+            if ownerleft >= left and ownerleft <= right:
+                return False
+        else:
+            ownerright = self._maxRight(cursor, table) + 1
+            ownerlevel = -1
+        if ownerright > right:
+            low, high, shift, delta = (
+                right + 1,
+                ownerright - 1,
+                -width,
+                ownerright - right - 1,
+            )
+        else:
+            low, high, shift, delta = ownerright, left - 1, width, ownerright - left
+        cursor.execute(
+            """
+            update %s set
+              lft = case
+                when lft between %%(left)s and %%(right)s then lft + %%(delta)s
+                when lft between %%(low)s and %%(high)s then lft + %%(shift)s
+                else lft end,
+              rght = case
+                when rght between %%(left)s and %%(right)s then rght + %%(delta)s
+                when rght between %%(low)s and %%(high)s then rght + %%(shift)s
+                else rght end,
+              lvl = case
+                when lft between %%(left)s and %%(right)s then lvl + %%(level)s
+                else lvl end
+            where lft between %%(first)s and %%(last)s
+              or rght between %%(first)s and %%(last)s
+            """
+            % table,
+            {
+                "left": left,
+                "right": right,
+                "delta": delta,
+                "low": low,
+                "high": high,
+                "shift": shift,
+                "level": ownerlevel + 1 - level,
+                "first": min(left, low),
+                "last": max(right, high),
+            },
+        )
+        return True
 
     def delete(self, *args, **kwargs):
-        try:
-            # Update an arbitrary other object to trigger recalculation of the hierarchy
-            obj = self.__class__.objects.using(self._state.db).exclude(pk=self.pk)[0]
-            obj.lft = None
-            obj.rght = None
-            obj.lvl = None
-            obj.save(update_fields=["lft", "rght", "lvl"], using=self._state.db)
-        except Exception:
-            # Failure can happen when eg we delete the last record
-            pass
-        # Call the real delete() method
-        super().delete(*args, **kwargs)
+        database = kwargs.get("using", None) or router.db_for_write(
+            self.__class__, instance=self
+        )
+        if self._isDeferred(database):
+            # The hierarchy is rebuilt at the end of the bulkUpdate block
+            self._deferred.tables[database][self.__class__] = True
+            return super().delete(*args, **kwargs)
+        table = connections[database].ops.quote_name(self._meta.db_table)
+        with transaction.atomic(using=database), connections[
+            database
+        ].cursor() as cursor:
+            current = self._lockHierarchy(cursor, table, self.pk)
+            if current and current[0] is not None:
+                maxright = self._maxRight(cursor, table)
+            # Call the real delete() method
+            result = super().delete(*args, **kwargs)
+            if current and current[0] is not None:
+                # The children of the node become root nodes. Their subtrees
+                # move to the end, and the gap left by the node is closed.
+                left, right, level = current[0:3]
+                width = right - left + 1
+                cursor.execute(
+                    """
+                    update %s set
+                      lft = case
+                        when lft between %%(left)s and %%(right)s
+                          then lft + %%(delta)s
+                        when lft > %%(right)s then lft - %%(width)s
+                        else lft end,
+                      rght = case
+                        when rght between %%(left)s and %%(right)s
+                          then rght + %%(delta)s
+                        when rght > %%(right)s then rght - %%(width)s
+                        else rght end,
+                      lvl = case
+                        when lft between %%(left)s and %%(right)s
+                          then lvl - %%(level)s
+                        else lvl end
+                    where rght > %%(left)s
+                    """
+                    % table,
+                    {
+                        "left": left,
+                        "right": right,
+                        "delta": maxright - width - left,
+                        "width": width,
+                        "level": level + 1,
+                    },
+                )
+        return result
 
     class Meta:
         abstract = True
 
+    # Models saved in a bulkUpdate block, per thread and database
+    _deferred = local()
+
+    @classmethod
+    def _isDeferred(cls, database):
+        tables = getattr(HierarchyModel._deferred, "tables", None)
+        if tables is None or database not in tables:
+            return False
+        tables[database].setdefault(cls, False)
+        return True
+
+    @classmethod
+    @contextmanager
+    def bulkUpdate(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Records saved in this block don't maintain the hierarchy one by one.
+        Instead, the changed records have their hierarchy fields cleared, and
+        the hierarchy is rebuilt once at the end of the block.
+        """
+        tables = getattr(HierarchyModel._deferred, "tables", None)
+        if tables is None:
+            tables = HierarchyModel._deferred.tables = {}
+        if database in tables:
+            # Nested block
+            yield
+            return
+        tables[database] = changed = {}
+        try:
+            yield
+        finally:
+            del tables[database]
+        for model, deleted in changed.items():
+            if deleted:
+                # Mark the hierarchy for a rebuild
+                table = connections[database].ops.quote_name(model._meta.db_table)
+                with connections[database].cursor() as cursor:
+                    cursor.execute(
+                        "update %s set lft = null where name = "
+                        "(select name from %s limit 1)" % (table, table)
+                    )
+            model.rebuildHierarchy(database=database)
+
     @classmethod
     def rebuildHierarchy(cls, database=DEFAULT_DB_ALIAS):
 
@@ -111,21 +402,30 @@ class HierarchyModel(models.Model):
         children = {}
         updates = []
 
-        def tagChildren(me, left, level):
+        def tagChildren(root, left):
+            # Depth-first walk over the subtree, using a stack rather than
+            # recursion to support deep hierarchies.
+            stack = [(root, left, iter(children.get(root, ())))]
             right = left + 1
-            # Get all children of this node
-            for i in children.get(me, []):
-                # Recursive execution of this function for each child of this node
-                right = tagChildren(i, right, level + 1)
+            while stack:
+                me, left, todo = stack[-1]
+                child = next(todo, None)
+                if child is not None:
+                    # Process the next child of this node
+                    stack.append((child, right, iter(children.get(child, ()))))
+                    right += 1
+                    continue
 
-            # After processing the children of this node now know its left and right values
-            updates.append((left, right, level, me))
+                # After processing the children of this node now know its left and right values
+                stack.pop()
+                updates.append((left, right, len(stack), me))
 
-            # Remove from node list (to mark as processed)
-            del nodes[me]
+                # Remove from node list (to mark as processed)
+                del nodes[me]
+                right += 1
 
-            # Return the right value of this node + 1
-            return right + 1
+            # Return the right value of the root + 1
+            return right
 
         # Load all nodes in memory
         for i in cls.objects.using(database).values("name", "owner"):
@@ -144,7 +444,7 @@ class HierarchyModel(models.Model):
         cnt = 1
         for i, j in keys:
             if j is None:
-                cnt = tagChildren(i, cnt, 0)
+                cnt = tagChildren(i, cnt)
 
         if nodes:
             # If the nodes dictionary isn't empty, it is an indication of an
@@ -155,7 +455,7 @@ class HierarchyModel(models.Model):
             updated = True
             while updated:
                 updated = False
-                for i in bad.keys():
+                for i in list(bad.keys()):
                     ok = True
                     for j, k in bad.items():
                         if k == i:
@@ -174,7 +474,7 @@ class HierarchyModel(models.Model):
             keys = sorted(nodes.items())
             for i, j in keys:
                 if j is None:
-                    cnt = tagChildren(i, cnt, 0)
+                    cnt = tagChildren(i, cnt)
 
         # Write all results to the database
         with transaction.atomic(using=database):
@@ -209,7 +509,7 @@ class HierarchyModel(models.Model):
                 obj.save(update_fields=["lft"])
             cls.objects.using(database).filter(owner__isnull=True).exclude(
                 name=rootname
-            ).update(owner=obj)
+            ).update(owner=obj, lft=None)
 
             # Rebuild the hierarchy again with the new root
             cls.rebuildHierarchy(database=database)
@@ -274,6 +574,21 @@ class AuditModel(models.Model):
         # Call the real save() method
         super().save(*args, **kwargs)
 
+    @classmethod
+    @contextmanager
+    def bulkUpdate(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Context manager to wrap around code that saves many records of this model.
+        Models can override it to postpone the processing triggered by saving a
+        single record till the end of the block, and do it set-based then.
+        """
+        parent = getattr(super(), "bulkUpdate", None)
+        if parent:
+            with parent(database):
+                yield
+        else:
+            yield
+
     class Meta:
         abstract = True
 
@@ -345,6 +660,26 @@ class Scenario(models.Model):
             # Failures are acceptable - eg when the default database has not been intialized yet
             pass
 
+    @classmethod
+    def getStatus(cls, name):
+        """
+        Returns the status of a scenario, or None if it doesn't exist.
+        Only scenarios in use are cached: a scenario that becomes available is
+        visible immediately.
+        """
+        key = getCacheKey("scenarios", "status_%s" % name)
+        status = cache.get(key)
+        if status is None:
+            try:
+                status = (
+                    cls.objects.using(DEFAULT_DB_ALIAS).only("status").get(name=name)
+                ).status
+            except cls.DoesNotExist:
+                return None
+            if status == "In use":
+                cache.set(key, status, timeout=settings.REQUEST_CACHE_TIMEOUT)
+        return status
+
     def __lt__(self, other):
         # Default database is always first in the list
         if self.name == DEFAULT_DB_ALIAS:
@@ -558,6 +893,10 @@ class User(AbstractUser):
         verbose_name_plural = _("users")
 
     def getPreference(self, prop, default=None, database=DEFAULT_DB_ALIAS):
+        key = getCacheKey("preferences_%s" % database, "%s_%s" % (self.id, prop))
+        result = cache.get(key, DEFERRED)
+        if result is not DEFERRED:
+            return result if result else default
         try:
             result = None
             for p in (
@@ -572,6 +911,7 @@ class User(AbstractUser):
                     result.update(p.value)
                 else:
                     result = p.value
+            cache.set(key, result, timeout=settings.REQUEST_CACHE_TIMEOUT)
             return result if result else default
         except ValueError:
             logger.error("Invalid preference '%s' of user '%s'" % (prop, self.username))
@@ -580,6 +920,13 @@ class User(AbstractUser):
             return default
 
     def setPreference(self, prop, val, database=DEFAULT_DB_ALIAS):
+        if prop in settings.GLOBAL_PREFERENCES and self.is_superuser:
+            # Global preferences apply to all users
+            invalidateCache("preferences_%s" % database)
+        else:
+            cache.delete(
+                getCacheKey("preferences_%s" % database, "%s_%s" % (self.id, prop))
+            )
         if val is None:
             if prop in settings.GLOBAL_PREFERENCES and self.is_superuser:
                 # Delete global preferences
@@ -667,6 +1014,24 @@ def delete_user(sender, instance, **kwargs):
     raise PermissionDenied
 
 
+@receiver(post_save, sender=Scenario)
+@receiver(post_delete, sender=Scenario)
+def invalidate_scenario_cache(sender, **kwargs):
+    invalidateCache("scenarios")
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_cache(sender, instance, **kwargs):
+    # The scenarios of the user may have changed
+    cache.delete(getCacheKey("scenarios", "user_%s" % instance.username))
+
+
+@receiver(post_save, sender=UserPreference)
+@receiver(post_delete, sender=UserPreference)
+def invalidate_preference_cache(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    invalidateCache("preferences_%s" % using)
+
+
 class Comment(models.Model):
     type_list = (
         ("add", _("Add")),
@@ -738,15 +1103,22 @@ class Comment(models.Model):
             update_fields=update_fields,
         )
         if update_fields != ["processed"]:
-            req = getattr(_thread_locals, "request", None)
-            NotificationFactory.launchWorker(
-                database=using,
-                url="%s://%s" % ("https" if req.is_secure() else "http", req.get_host())
-                if req
-                else None,
-            )
+            self.notify(using)
         return tmp
 
+    @staticmethod
+    def notify(database=DEFAULT_DB_ALIAS):
+        # Launch the worker that sends out the notifications of new comments
+        from .middleware import _thread_locals
+
+        req = getattr(_thread_locals, "request", None)
+        NotificationFactory.launchWorker(
+            database=database,
+            url="%s://%s" % ("https" if req.is_secure() else "http", req.get_host())
+            if req
+            else None,
+        )
+
     def attachmentlink(self):
         if self.attachment:
             return mark_safe(
@@ -910,6 +1282,110 @@ class SystemMessage(models.Model):
                 Notification(comment=c, user=u).save(using=db)
 
 
+class CommentBuffer:
+    """
+    Collects the comments of an upload or a bulk edit, and writes them with
+    multi-row inserts rather than one by one.
+
+    With a limit, the comments are only written when closing the buffer. When
+    there are more than the limit, a single comment summarizing the changes is
+    written instead.
+    """
+
+    batchsize = 1000
+
+    def __init__(self, model, user, database=DEFAULT_DB_ALIAS, limit=0):
+        self.model = model
+        self.content_type_id = ContentType.objects.get_for_model(
+            model, for_concrete_model=False
+        ).pk
+        self.user_id = user.id if user else None
+        self.database = database
+        self.limit = limit
+        self.comments = []
+        self.written = False
+        self.summarized = False
+        self.added = 0
+        self.changed = 0
+        self.deleted = 0
+
+    def add(self, object_pk, object_repr, type, comment):
+        if type == "add":
+            self.added += 1
+        elif type == "change":
+            self.changed += 1
+        elif type == "delete":
+            self.deleted += 1
+        if self.summarized:
+            return
+        self.comments.append(
+            Comment(
+                user_id=self.user_id,
+                content_type_id=self.content_type_id,
+                object_pk=object_pk,
+                object_repr=force_text(object_repr)[:200],
+                type=type,
+                comment=comment,
+            )
+        )
+        if self.limit:
+            if len(self.comments) > self.limit:
+                self.comments = []
+                self.summarized = True
+        elif len(self.comments) >= self.batchsize:
+            self.flush()
+
+    def register(self, added, changed, written):
+        """
+        Registers changes of which the comments are written elsewhere.
+        When they aren't written, the changes are summarized.
+        """
+        self.added += added
+        self.changed += changed
+        if added or changed:
+            if written:
+                self.written = True
+            else:
+                self.comments = []
+                self.summarized = True
+
+    def flush(self):
+        if self.comments:
+            Comment.objects.using(self.database).bulk_create(
+                self.comments, batch_size=self.batchsize
+            )
+            self.comments = []
+            self.written = True
+
+    def close(self):
+        """
+        Writes the remaining comments, or the summary of all changes.
+        """
+        if self.summarized:
+            changes = []
+            if self.added:
+                changes.append("added %d" % self.added)
+            if self.changed:
+                changes.append("changed %d" % self.changed)
+            if self.deleted:
+                changes.append("deleted %d" % self.deleted)
+            Comment(
+                user_id=self.user_id,
+                content_type_id=self.content_type_id,
+                object_pk="all",
+                object_repr=force_text(self.model._meta.verbose_name_plural)[:200],
+                type="change" if self.changed or self.deleted else "add",
+                comment="Bulk change: %s." % get_text_list(changes, "and"),
+            ).save(using=self.database)
+        else:
+            self.flush()
+            if self.written:
+                Comment.notify(self.database)
+        self.comments = []
+        self.summarized = False
+        self.written = False
+
+
 class Follower(models.Model):
     type_list = (("M", "email"), ("O", "online"))
 
@@ -1026,6 +1502,9 @@ class NotificationFactory:
     _workers = {}
     _reg = {}
 
+    # Number of messages processed in a single transaction
+    batchsize = 500
+
     @classmethod
     def launchWorker(cls, database=DEFAULT_DB_ALIAS, url=None):
         worker = cls._workers.get(database, None)
@@ -1043,7 +1522,18 @@ class NotificationFactory:
             p.start()
 
     @classmethod
-    def register(cls, followerclass, messageclasses):
+    def register(cls, followerclass, messageclasses, key=None):
+        """
+        Registers a function that decides whether a follower of an object of the
+        follower class is notified of a message on one of the message classes.
+
+        The optional key function returns the keys of the objects of the
+        follower class that can be interested in a message. The followers of
+        other objects of the follower class are then skipped without calling
+        the notification function. When it returns None, all followers are
+        checked.
+        """
+
         def decorator(func):
             if not inspect.isclass(followerclass):
                 raise Exception("NotificationFactory needs a class as first argument")
@@ -1058,10 +1548,31 @@ class NotificationFactory:
                     cls._reg[m] = [func]
             func.messages = messageclasses
             func.follower = followerclass
+            func.key = key
             return func
 
         return decorator
 
+    @staticmethod
+    def objectKey(msg):
+        # Key function for messages on the followed object itself
+        return (msg.object_pk,)
+
+    @staticmethod
+    def fieldKey(followerclass, field):
+        """
+        Returns a key function for messages on the followed object itself, or on
+        objects that refer to it with a field.
+        """
+
+        def key(msg):
+            if msg.content_type.model_class() == followerclass:
+                return (msg.object_pk,)
+            else:
+                return (getattr(msg.content_object, field),)
+
+        return key
+
     @classmethod
     def _buildRegistry(cls):
         # Find all notification registrations
@@ -1078,6 +1589,37 @@ class NotificationFactory:
                 ):
                     raise e
 
+    @classmethod
+    def _getCandidates(cls, msg, meta, byModel, byObject):
+        """
+        Returns the followers that can be interested in a message, sorted by
+        their identifier, together with the notification functions to check.
+        """
+        candidates = {}
+        for c in meta:
+            keys = None
+            if c.key:
+                try:
+                    keys = c.key(msg)
+                except Exception:
+                    # Check all followers, eg when the object is already deleted
+                    keys = None
+            for m in c.messages:
+                if m is c.follower and keys is not None:
+                    flws = chain(
+                        byObject.get((m, "all"), ()),
+                        *(byObject.get((m, k), ()) for k in keys)
+                    )
+                else:
+                    flws = byModel.get(m, ())
+                for flw in flws:
+                    if flw.id in candidates:
+                        if c not in candidates[flw.id][1]:
+                            candidates[flw.id][1].append(c)
+                    else:
+                        candidates[flw.id] = (flw, [c])
+        return [candidates[i] for i in sorted(candidates)]
+
     @classmethod
     def start(cls, url=None, database=DEFAULT_DB_ALIAS):
         """
@@ -1093,23 +1635,49 @@ class NotificationFactory:
                 Follower.objects.all()
                 .using(database)
                 .filter(user__is_active=True)
+                .select_related("content_type", "user")
                 .order_by("id")
             )
+
+            # Index the followers by model and by followed object
+            byModel = {}
+            byObject = {}
+            for flw in followers:
+                m = flw.content_type.model_class()
+                byModel.setdefault(m, []).append(flw)
+                byObject.setdefault((m, flw.object_pk), []).append(flw)
+
+            # Permission checks are cached per user
+            permissions = {}
+
+            def hasPermission(user, perm):
+                if (user.id, perm) not in permissions:
+                    permissions[(user.id, perm)] = user.has_perm(perm)
+                return permissions[(user.id, perm)]
+
             idle_loop_done = False
+            count_messages = 0
+            count_notifications = 0
+            start = logged = time.time()
             while True:
                 with transaction.atomic(using=database):
                     empty = True
                     emails = []
                     if followers:
+                        processed = []
+                        notifications = []
                         for msg in (
                             Comment.objects.all()
                             .using(database)
                             .filter(processed=False)
                             .order_by("id")
                             .select_related("content_type")
-                            .select_for_update(skip_locked=True, of=("self",))[:50]
+                            .select_for_update(skip_locked=True, of=("self",))[
+                                : cls.batchsize
+                            ]
                         ):
                             empty = False
+                            processed.append(msg.id)
                             recipients = set()
                             try:
                                 created = set()
@@ -1122,45 +1690,43 @@ class NotificationFactory:
                                 )
                                 meta = cls._reg.get(model, None)
                                 if meta:
-                                    for flw in followers:
-                                        for c in meta:
+                                    for flw, callbacks in cls._getCandidates(
+                                        msg, meta, byModel, byObject
+                                    ):
+                                        if flw.user_id in created:
+                                            continue
+                                        for c in callbacks:
                                             try:
                                                 if (
-                                                    flw.user not in created
-                                                    and flw.content_type.model_class()
-                                                    in c.messages
-                                                    and (
-                                                        flw.object_pk == "all"
-                                                        or c(flw, msg)
+                                                    flw.object_pk == "all"
+                                                    or c(flw, msg)
+                                                ) and (
+                                                    not view_permission
+                                                    or hasPermission(
+                                                        flw.user, view_permission
                                                     )
-                                                    and (
-                                                        not view_permission
-                                                        or flw.user.has_perm(
-                                                            view_permission
+                                                ):
+                                                    notifications.append(
+                                                        Notification(
+                                                            comment=msg,
+                                                            user=flw.user,
+                                                            type=flw.type,
+                                                            follower=flw,
                                                         )
                                                     )
-                                                ):
-                                                    Notification(
-                                                        comment=msg,
-                                                        user=flw.user,
-                                                        type=flw.type,
-                                                        follower=flw,
-                                                    ).save(database)
                                                     if (
                                                         flw.type == "M"
                                                         and flw.user.email
                                                         and settings.EMAIL_HOST
                                                     ):
                                                         recipients.add(flw.user.email)
-                                                    created.add(flw.user)
+                                                    created.add(flw.user_id)
                                                     break
                                             except Exception as e:
                                                 logger.error(
                                                     "Exception in notification function %s: %s"
                                                     % (c, e)
                                                 )
-                                msg.processed = True
-                                msg.save(update_fields=["processed"], using=database)
                                 if recipients:
                                     data = msg.getMail(url, database)
                                     email = mail.EmailMultiAlternatives(
@@ -1177,6 +1743,16 @@ class NotificationFactory:
                                     "Couldn't create nofications for message %s: %s"
                                     % (msg.id, e)
                                 )
+                        if notifications:
+                            Notification.objects.using(database).bulk_create(
+                                notifications, batch_size=cls.batchsize
+                            )
+                        if processed:
+                            Comment.objects.all().using(database).filter(
+                                id__in=processed
+                            ).update(processed=True)
+                        count_messages += len(processed)
+                        count_notifications += len(notifications)
                         if emails:
                             connection = None
                             try:
@@ -1198,6 +1774,7 @@ class NotificationFactory:
                         )
                         if recs:
                             empty = False
+                            count_messages += recs
                     if empty:
                         if idle_loop_done:
                             break
@@ -1208,10 +1785,34 @@ class NotificationFactory:
                                 # the test suite, we try again 5 seconds later before shutting
                                 # down the worker.
                                 time.sleep(5)
+                    elif time.time() - logged > 60:
+                        logged = time.time()
+                        cls._logThroughput(
+                            database, count_messages, count_notifications, start
+                        )
+            if count_messages:
+                cls._logThroughput(
+                    database, count_messages, count_notifications, start
+                )
         finally:
             for db in settings.DATABASES:
                 connections[db].close()
 
+    @staticmethod
+    def _logThroughput(database, messages, notifications, start):
+        duration = time.time() - start
+        logger.info(
+            "Notification worker on %s processed %d messages and created %d "
+            "notifications in %.1f seconds (%.0f messages per second)"
+            % (
+                database,
+                messages,
+                notifications,
+                duration,
+                messages / duration if duration else 0,
+            )
+        )
+
     @classmethod
     def join(cls):
         Scenario.syncWithSettings()
@@ -1456,3 +2057,121 @@ class BucketDetail(AuditModel):
         db_table = "common_bucketdetail"
         unique_together = (("bucket", "startdate"),)
         ordering = ["bucket", "startdate"]
+
+
+class ReportCache(models.Model):
+    """
+    Stores pre-bucketed output rows of pivot reports, so paging through a
+    report doesn't recompute all bucket aggregates.
+    An entry is identified by a hash of the report, its filter, sorting, time
+    buckets and page. Row number 0 of each entry is an empty marker row, which
+    allows caching empty pages as well.
+    The plan export and any change to the data empty the cache.
+
+    The cache has a version number, which is incremented when it is emptied.
+    Entries are stored with the version that was current when their computation
+    started, and only entries of the current version are used. An entry computed
+    with the data from before a change is thus never returned after the change.
+    """
+
+    id = models.BigAutoField(_("identifier"), primary_key=True)
+    key = models.CharField(_("key"), max_length=40)
+    rownumber = models.IntegerField(_("row number"))
+    version = models.BigIntegerField(_("version"), default=0)
+    data = models.BinaryField(_("data"), null=True)
+
+    class Meta:
+        db_table = "common_reportcache"
+        unique_together = (("key", "rownumber"),)
+        default_permissions = []
+
+    @staticmethod
+    def getVersion(database=DEFAULT_DB_ALIAS):
+        """
+        Returns the current version of the cache. It needs to be retrieved
+        before computing an entry to store.
+        """
+        with connections[database].cursor() as cursor:
+            cursor.execute("select last_value from common_reportcache_version")
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def get(key, database=DEFAULT_DB_ALIAS):
+        """
+        Returns the list of cached rows, or None if the entry isn't cached.
+        """
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                """
+                select data from common_reportcache
+                where key = %s
+                and version = (select last_value from common_reportcache_version)
+                order by rownumber
+                """,
+                (key,),
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            return None
+        return [pickle.loads(bytes(i[0])) for i in rows[1:]]
+
+    @staticmethod
+    def store(key, rows, version, database=DEFAULT_DB_ALIAS):
+        """
+        Stores an entry computed with the given version of the cache.
+        An entry of an older version is ignored.
+        """
+        if version != ReportCache.getVersion(database):
+            return
+        with transaction.atomic(using=database):
+            with connections[database].cursor() as cursor:
+                execute_batch(
+                    cursor,
+                    """
+                    insert into common_reportcache (key, rownumber, version, data)
+                    values (%s, %s, %s, %s)
+                    on conflict (key, rownumber) do update
+                    set version = excluded.version, data = excluded.data
+                    where common_reportcache.version < excluded.version
+                    """,
+                    [(key, 0, version, None)]
+                    + [
+                        (key, cnt, version, pickle.dumps(r))
+                        for cnt, r in enumerate(rows, start=1)
+                    ],
+                    page_size=200,
+                )
+
+    @staticmethod
+    def invalidate(database=DEFAULT_DB_ALIAS):
+        with connections[database].cursor() as cursor:
+            cursor.execute("select nextval('common_reportcache_version')")
+            cursor.execute(
+                "delete from common_reportcache where version < %s",
+                (cursor.fetchone()[0],),
+            )
+
+    @staticmethod
+    def invalidateOnCommit(database=DEFAULT_DB_ALIAS):
+        """
+        Empties the cache when the current transaction is committed. A
+        transaction that saves many records only does this once.
+        """
+        conn = connections[database]
+        registered = getattr(conn, "reportcache_invalidation", None)
+        # Django discards the callbacks of a rolled back transaction or savepoint
+        if registered and any(i[1] is registered for i in conn.run_on_commit):
+            return
+
+        def pending():
+            ReportCache.invalidate(database)
+
+        conn.reportcache_invalidation = pending
+        transaction.on_commit(pending, using=database)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_report_cache(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    if issubclass(sender, AuditModel):
+        ReportCache.invalidateOnCommit(using)
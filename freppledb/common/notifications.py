@@ -18,12 +18,16 @@
 from .models import NotificationFactory, User, Bucket, BucketDetail, Parameter
 
 
-@NotificationFactory.register(User, [User])
+@NotificationFactory.register(User, [User], key=NotificationFactory.objectKey)
 def UserNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(Bucket, [Bucket, BucketDetail])
+@NotificationFactory.register(
+    Bucket,
+    [Bucket, BucketDetail],
+    key=NotificationFactory.fieldKey(Bucket, "bucket_id"),
+)
 def BucketNotification(flw, msg):
     if flw.content_type == msg.content_type:
         return flw.object_pk == msg.object_pk
@@ -31,11 +35,13 @@ def BucketNotification(flw, msg):
         return flw.object_pk == msg.content_object.bucket.name
 
 
-@NotificationFactory.register(BucketDetail, [BucketDetail])
+@NotificationFactory.register(
+    BucketDetail, [BucketDetail], key=NotificationFactory.objectKey
+)
 def BucketDetailNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(Parameter, [Parameter])
+@NotificationFactory.register(Parameter, [Parameter], key=NotificationFactory.objectKey)
 def ParameterNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
@@ -29,18 +29,25 @@ It provides the following functionality:
 """
 
 import codecs
+from contextlib import nullcontext
 import csv
 from datetime import date, datetime, timedelta, time
 from decimal import Decimal
 import functools
+import hashlib
 import logging
 import math
 import operator
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from queue import Full, Queue
+from threading import Event, Lock, Thread
 from time import timezone, daylight
-from io import StringIO, BytesIO
+from io import StringIO
 import urllib
+import zlib
 from openpyxl import load_workbook, Workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.cell import WriteOnlyCell
@@ -48,7 +55,7 @@ from openpyxl.styles import NamedStyle, PatternFill
 from dateutil.parser import parse
 from openpyxl.comments import Comment as CellComment
 
-from django.db.models import Model, Lookup
+from django.db.models import Model, Lookup, QuerySet
 from django.db.models.expressions import RawSQL
 from django.db.utils import DEFAULT_DB_ALIAS, load_backend
 from django.contrib.auth.models import Group
@@ -58,7 +65,7 @@ from django.views.decorators.csrf import csrf_protect
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.admin.utils import unquote, quote
-from django.core.exceptions import ValidationError
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.core.management.color import no_style
 from django.db import connections, transaction, models
 from django.db.models.fields import CharField, AutoField
@@ -79,15 +86,19 @@ from django.views.generic.base import View
 
 from freppledb.boot import getAttributeFields
 from freppledb.common.models import (
+    AuditModel,
     User,
     Comment,
+    CommentBuffer,
     Parameter,
     BucketDetail,
     Bucket,
     HierarchyModel,
     NotificationFactory,
+    ReportCache,
 )
 from freppledb.common.dataload import parseExcelWorksheet, parseCSVdata
+from freppledb.common.spreadsheet import SpreadsheetStream
 
 
 logger = logging.getLogger(__name__)
@@ -611,6 +622,23 @@ class GridReport(View):
     # Defines the difference between height of the grid and its boundaries
     heightmargin = 75
 
+    # Use keyset pagination when the query allows it. Pages are then read
+    # by seeking past the sort key of the previous page, rather than skipping
+    # over all records of the previous pages.
+    keysetPagination = True
+
+    # Number of records read at a time when exporting all records of a grid
+    exportChunksize = 10000
+
+    # Maximum number of scenarios queried concurrently when a report is
+    # exported for multiple scenarios
+    exportScenarioThreads = 4
+
+    # Size limits of an excel worksheet. Bigger exports are returned as a
+    # compressed CSV file instead.
+    spreadsheetMaxRows = 1048576
+    spreadsheetMaxColumns = 16384
+
     # Define a list of actions
     actions = None
 
@@ -934,9 +962,123 @@ class GridReport(View):
         return ",\n".join(result)
 
     @classmethod
-    def _generate_spreadsheet_data(
-        cls, request, scenario_list, output, *args, **kwargs
-    ):
+    def _export_query(cls, request, *args, **kwargs):
+        """
+        Returns the data_query result for an export. Querysets are read in
+        chunks with a server-side cursor, rather than loaded in memory at once.
+        """
+        query = cls.data_query(request, *args, **kwargs)
+        if isinstance(query, QuerySet):
+            return query.iterator(chunk_size=cls.exportChunksize)
+        return query
+
+    @classmethod
+    def _spreadsheet_size(cls, request, scenario_list, *args, **kwargs):
+        """
+        Returns an estimate of the number of rows and columns of a spreadsheet
+        export.
+        The record counts come from the report cache or from the query planner,
+        so the export doesn't scan the data an extra time. When the planner
+        underestimates a big export, Excel opens the file with the rows that
+        fit in a worksheet.
+        """
+        rows = 1
+        for scenario in scenario_list:
+            scenario_request = copy(request)
+            scenario_request.database = scenario
+            rows += cls.estimate_query(scenario_request, *args, **kwargs)
+        return rows, len(request.rows) + 1
+
+    @classmethod
+    def _exceeds_spreadsheet_limits(cls, request, scenario_list, *args, **kwargs):
+        rows, columns = cls._spreadsheet_size(request, scenario_list, *args, **kwargs)
+        return rows > cls.spreadsheetMaxRows or columns > cls.spreadsheetMaxColumns
+
+    @classmethod
+    def _scenario_queries(cls, request, scenario_list, *args, **kwargs):
+        """
+        Yields the scenario name and the result of the _export_query method for
+        each scenario in the list, and sets request.database to that scenario.
+
+        With multiple scenarios the queries run concurrently in worker threads,
+        each with its own database connection. The rows are returned in the
+        order of the scenario list while the other scenarios are still running.
+        """
+        if len(scenario_list) <= 1:
+            for scenario in scenario_list:
+                request.database = scenario
+                yield scenario, cls._export_query(request, *args, **kwargs)
+            return
+
+        from freppledb.common.middleware import _thread_locals
+
+        stop = Event()
+
+        def putChunk(rows, chunk):
+            # Wait for the consumer to catch up, unless it stopped reading
+            while not stop.is_set():
+                try:
+                    rows.put(chunk, timeout=1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def runQuery(scenario, rows):
+            scenario_request = copy(request)
+            scenario_request.database = scenario
+            setattr(_thread_locals, "request", scenario_request)
+            translation.activate(request.LANGUAGE_CODE)
+            try:
+                chunk = []
+                for row in cls._export_query(scenario_request, *args, **kwargs):
+                    chunk.append(row)
+                    if len(chunk) >= 1000:
+                        if not putChunk(rows, chunk):
+                            return
+                        chunk = []
+                if putChunk(rows, chunk):
+                    putChunk(rows, None)
+            except Exception as e:
+                putChunk(rows, e)
+            finally:
+                translation.deactivate()
+                setattr(_thread_locals, "request", None)
+                connections.close_all()
+
+        def getRows(rows):
+            while True:
+                chunk = rows.get()
+                if chunk is None:
+                    return
+                elif isinstance(chunk, Exception):
+                    raise chunk
+                yield from chunk
+
+        executor = ThreadPoolExecutor(
+            max_workers=min(len(scenario_list), cls.exportScenarioThreads)
+        )
+        futures = []
+        try:
+            queues = []
+            for scenario in scenario_list:
+                rows = Queue(maxsize=10)
+                futures.append(executor.submit(runQuery, scenario, rows))
+                queues.append((scenario, rows))
+            for scenario, rows in queues:
+                request.database = scenario
+                yield scenario, getRows(rows)
+        finally:
+            stop.set()
+            for f in futures:
+                f.cancel()
+            executor.shutdown(wait=False)
+
+    @classmethod
+    def _generate_spreadsheet_data(cls, request, scenario_list, *args, **kwargs):
+        if translation.get_language() != request.LANGUAGE_CODE:
+            translation.activate(request.LANGUAGE_CODE)
+
         # Create a workbook
         wb = Workbook(write_only=True)
         if callable(cls.title):
@@ -1015,14 +1157,17 @@ class GridReport(View):
         # Add an auto-filter to the table
         ws.auto_filter.ref = "A1:%s1048576" % get_column_letter(len(header))
 
+        # The data rows are streamed
+        stream = SpreadsheetStream(wb, ws)
+
         original_database = request.database
         try:
-            for scenario in scenario_list:
-
-                request.database = scenario
+            for scenario, query in cls._scenario_queries(
+                request, scenario_list, *args, fields=fields, **kwargs
+            ):
 
                 # Loop over all records
-                for row in cls.data_query(request, *args, fields=fields, **kwargs):
+                for row in query:
                     if hasattr(row, "__getitem__"):
                         r = [
                             _getCellValue(row[f.field_name], field=f, request=request)
@@ -1037,12 +1182,14 @@ class GridReport(View):
                         ]
                     if len(scenario_list) > 1:
                         r.insert(0, scenario)
-                    ws.append(r)
+                    data = stream.append(r)
+                    if data:
+                        yield data
         finally:
             request.database = original_database
 
-        # Write the spreadsheet
-        wb.save(output)
+        # Complete the spreadsheet
+        yield stream.close()
 
     @classmethod
     def _generate_csv_data(cls, request, scenario_list, *args, **kwargs):
@@ -1122,10 +1269,11 @@ class GridReport(View):
         # Write the report content
         original_database = request.database
         try:
-            for scenario in scenario_list:
-                request.database = scenario
+            for scenario, query in cls._scenario_queries(
+                request, scenario_list, *args, fields=fields, **kwargs
+            ):
 
-                for row in cls.data_query(request, *args, fields=fields, **kwargs):
+                for row in query:
                     # Clear the return string buffer
                     sf.seek(0)
                     sf.truncate(0)
@@ -1422,11 +1570,32 @@ class GridReport(View):
                     request.database
                 )
         query = cls._apply_sort(request, request.query)
+        keyset = (
+            cls._get_keyset(query)
+            if cls.keysetPagination and not hasattr(cls, "query")
+            else None
+        )
+        if keyset:
+            query = query.order_by(*[("-%s" % k) if d else k for k, d in keyset])
         if page:
             # Display a single page
             cnt = (page - 1) * request.pagesize + 1
             if hasattr(cls, "query"):
                 return cls.query(request, query[cnt - 1 : cnt + request.pagesize])
+            elif keyset:
+                request.keyset = keyset
+                request.keyset_query = cls._get_keyset_hash(query)
+                query = query.values(
+                    *fields, *[k for k, d in keyset if k not in fields]
+                )
+                seek = cls._get_keyset_cursor(request, page)
+                if seek:
+                    # Like the offset pages, a page ends with the first row of
+                    # the next page
+                    return query.filter(cls._seek(keyset, seek))[
+                        : request.pagesize + 1
+                    ]
+                return query[cnt - 1 : cnt + request.pagesize]
             else:
                 return query[cnt - 1 : cnt + request.pagesize].values(*fields)
         else:
@@ -1443,10 +1612,120 @@ class GridReport(View):
                     return cls.query(request, query)
                 else:
                     fields = [i.field_name for i in request.rows if i.field_name]
+                    if keyset:
+                        return cls._iterate_keyset(
+                            query.values(
+                                *fields, *[k for k, d in keyset if k not in fields]
+                            ),
+                            keyset,
+                        )
                     return query.values(*fields)
 
     @classmethod
-    def count_query(cls, request, *args, **kwargs):
+    def _get_keyset(cls, query):
+        """
+        Returns the sort fields of a query as a list of tuples (field, descending),
+        completed with the primary key to make the sort order unique.
+        Returns None when keyset pagination isn't possible for the query.
+        """
+        q = query.query
+        if (
+            q.group_by
+            or q.distinct
+            or q.values_select
+            or q.extra_order_by
+            or any(
+                getattr(a, "contains_aggregate", False) for a in q.annotations.values()
+            )
+        ):
+            return None
+        keyset = []
+        ordering = q.order_by or (q.default_ordering and query.model._meta.ordering)
+        for o in ordering or ():
+            if not isinstance(o, str) or o == "?":
+                return None
+            desc = o.startswith("-")
+            name = o.lstrip("-")
+            if name in ("pk", query.model._meta.pk.name):
+                keyset.append(("pk", desc))
+                return keyset
+            if name not in q.annotations:
+                # Sorting on a relation sorts on the ordering of the related
+                # model, which we can't express as a simple comparison.
+                model = query.model
+                try:
+                    for part in name.split("__"):
+                        field = model._meta.get_field(part)
+                        model = field.related_model
+                except FieldDoesNotExist:
+                    return None
+                if field.is_relation:
+                    return None
+            keyset.append((name, desc))
+        keyset.append(("pk", False))
+        return keyset
+
+    @staticmethod
+    def _get_keyset_hash(query):
+        sql, params = query.query.get_compiler(query.db).as_sql()
+        return hashlib.sha1(repr((sql, params)).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _get_keyset_cursor(request, page):
+        """
+        Returns the sort key of the last record of the previous page, if the
+        grid passed a cursor for the same query.
+        """
+        try:
+            cursor = json.loads(request.GET["cursor"])
+            if (
+                cursor["page"] == page - 1
+                and cursor["query"] == request.keyset_query
+                and len(cursor["key"]) == len(request.keyset)
+            ):
+                return cursor["key"]
+        except Exception:
+            pass
+        return None
+
+    @staticmethod
+    def _seek(keyset, values):
+        """
+        Returns a filter on the records sorted after the given sort key.
+        PostgreSQL sorts null values last in ascending order, and first in
+        descending order.
+        """
+        result = []
+        same = models.Q()
+        for (name, desc), value in zip(keyset, values):
+            if value is None:
+                if desc:
+                    result.append(same & models.Q(**{"%s__isnull" % name: False}))
+                same &= models.Q(**{"%s__isnull" % name: True})
+            else:
+                after = models.Q(**{"%s__%s" % (name, "lt" if desc else "gt"): value})
+                if not desc:
+                    after |= models.Q(**{"%s__isnull" % name: True})
+                result.append(same & after)
+                same &= models.Q(**{name: value})
+        return functools.reduce(operator.or_, result)
+
+    @classmethod
+    def _iterate_keyset(cls, query, keyset):
+        """
+        Reads all records of a query in chunks, seeking past the last record
+        of the previous chunk.
+        """
+        chunk = query
+        while True:
+            rows = list(chunk[: cls.exportChunksize])
+            yield from rows
+            if len(rows) < cls.exportChunksize:
+                break
+            chunk = query.filter(cls._seek(keyset, [rows[-1][k] for k, d in keyset]))
+
+    @classmethod
+    def _count_queryset(cls, request, *args, **kwargs):
         if not hasattr(request, "query"):
             if callable(cls.basequeryset):
                 request.query = cls.filter_items(
@@ -1456,12 +1735,113 @@ class GridReport(View):
                 request.query = cls.filter_items(request, cls.basequeryset).using(
                     request.database
                 )
+        return request.query
+
+    @classmethod
+    def count_query(cls, request, *args, **kwargs):
+        return cls._count(request, cls._count_queryset(request, *args, **kwargs))
+
+    @classmethod
+    def estimate_query(cls, request, *args, **kwargs):
+        # Same as count_query, but a count that isn't cached is replaced with
+        # the estimate of the query planner.
+        return cls._count(
+            request, cls._count_queryset(request, *args, **kwargs), exact=False
+        )
+
+    # Keys of the record counts being computed in the background
+    _counting = set()
+    _counting_lock = Lock()
+
+    @classmethod
+    def _count(cls, request, query, exact=True):
+        """
+        Returns the number of records of a query.
+        Counts are kept in the report cache, which is emptied when the data
+        changes. Unfiltered tables with many records return the estimate from
+        the database statistics, and compute the exact count in the background.
+        Only the changes of audit models empty the cache, so the counts of other
+        models aren't cached.
+        With exact=False a count that isn't cached is estimated by the query
+        planner instead.
+        """
+        sql, params = query.query.get_compiler(request.database).as_sql(
+            with_col_aliases=False
+        )
+        cacheable = issubclass(query.model, AuditModel)
+        if cacheable:
+            key = hashlib.sha1(
+                repr(("count", sql, params)).encode("utf-8")
+            ).hexdigest()
+            cached = ReportCache.get(key, request.database)
+            if cached:
+                return cached[0]
+            version = ReportCache.getVersion(request.database)
+        if not exact:
+            return cls._plan_count(request, sql, params)
+        estimate = cls._estimate_count(request, query)
+        if estimate is not None and not cacheable:
+            return estimate
+        elif estimate is not None:
+            with cls._counting_lock:
+                if key not in cls._counting:
+                    cls._counting.add(key)
+                    Thread(
+                        target=cls._count_in_background,
+                        args=(request.database, key, version, sql, params),
+                        daemon=True,
+                    ).start()
+            return estimate
+        with connections[request.database].cursor() as cursor:
+            cursor.execute("select count(*) from (" + sql + ") t_subquery", params)
+            count = cursor.fetchone()[0]
+        if cacheable:
+            ReportCache.store(key, [count], version, request.database)
+        return count
+
+    @staticmethod
+    def _estimate_count(request, query):
+        """
+        Returns the estimated record count of an unfiltered table when it
+        exceeds the ESTIMATE_COUNT_THRESHOLD setting, and None otherwise.
+        """
+        q = query.query
+        if q.where or q.distinct or q.group_by or q.low_mark or q.high_mark:
+            return None
         with connections[request.database].cursor() as cursor:
-            tmp = request.query.query.get_compiler(request.database).as_sql(
-                with_col_aliases=False
+            cursor.execute(
+                "select reltuples::bigint from pg_class where oid = %s::regclass",
+                (query.model._meta.db_table,),
             )
-            cursor.execute("select count(*) from (" + tmp[0] + ") t_subquery", tmp[1])
-            return cursor.fetchone()[0]
+            estimate = cursor.fetchone()[0]
+        return estimate if estimate >= settings.ESTIMATE_COUNT_THRESHOLD else None
+
+    @staticmethod
+    def _plan_count(request, sql, params):
+        """
+        Returns the number of records the query planner expects a query to
+        return, without running the query.
+        """
+        with connections[request.database].cursor() as cursor:
+            cursor.execute("explain (format json) " + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    @classmethod
+    def _count_in_background(cls, database, key, version, sql, params):
+        try:
+            with connections[database].cursor() as cursor:
+                cursor.execute("select count(*) from (" + sql + ") t_subquery", params)
+                count = cursor.fetchone()[0]
+            ReportCache.store(key, [count], version, database)
+        except Exception as e:
+            logger.warning("Can't count records: %s" % e)
+        finally:
+            with cls._counting_lock:
+                cls._counting.discard(key)
+            connections[database].close()
 
     @classmethod
     def _generate_json_data(cls, request, *args, **kwargs):
@@ -1493,6 +1873,7 @@ class GridReport(View):
 
         # GridReport
         first = True
+        previous = last = None
         fields = [i.field_name for i in request.rows if i.field_name]
         for i in cls.data_query(request, *args, fields=fields, page=page, **kwargs):
             if first:
@@ -1512,7 +1893,23 @@ class GridReport(View):
                     r.append(', "%s":%s' % (f.name, s))
             r.append("}")
             yield "".join(r)
-        yield "\n]}\n"
+            previous, last = last, i
+        if previous is not None and getattr(request, "keyset", None):
+            # Pass the sort key of the one but last record, which allows reading
+            # the next page with keyset pagination. The last record of a page is
+            # also the first record of the next page.
+            yield '\n],"cursor":%s}\n' % json.dumps(
+                json.dumps(
+                    {
+                        "page": page,
+                        "query": request.keyset_query,
+                        "key": [previous[k] for k, d in request.keyset],
+                    },
+                    default=str,
+                )
+            )
+        else:
+            yield "\n]}\n"
 
     @classmethod
     def post(cls, request, *args, **kwargs):
@@ -1766,15 +2163,24 @@ class GridReport(View):
                 accepted_scenarios = [t[0] for t in scenario_permissions]
                 scenario_list = [x for x in scenario_list if x in accepted_scenarios]
 
-            # Return an excel spreadsheet
-            output = BytesIO()
-            cls._generate_spreadsheet_data(
-                request, scenario_list, output, *args, **kwargs
-            )
-            response = HttpResponse(
-                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                content=output.getvalue(),
-            )
+            if cls._exceeds_spreadsheet_limits(request, scenario_list, *args, **kwargs):
+                # Too big for excel: return a compressed CSV file instead
+                response = StreamingHttpResponse(
+                    content_type="application/gzip",
+                    streaming_content=_gzipStream(
+                        cls._generate_csv_data(request, scenario_list, *args, **kwargs)
+                    ),
+                )
+                extension = "csv.gz"
+            else:
+                # Return an excel spreadsheet
+                response = StreamingHttpResponse(
+                    content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    streaming_content=cls._generate_spreadsheet_data(
+                        request, scenario_list, *args, **kwargs
+                    ),
+                )
+                extension = "xlsx"
             # Filename parameter is encoded as specified in rfc5987
             if callable(cls.title):
                 title = cls.title(request, *args, **kwargs)
@@ -1782,8 +2188,9 @@ class GridReport(View):
                 title = cls.model._meta.verbose_name_plural if cls.model else cls.title
             response[
                 "Content-Disposition"
-            ] = "attachment; filename*=utf-8''%s.xlsx" % urllib.parse.quote(
-                force_str(title)
+            ] = "attachment; filename*=utf-8''%s.%s" % (
+                urllib.parse.quote(force_str(title)),
+                extension,
             )
             response["Cache-Control"] = "no-cache, no-store"
             return response
@@ -1852,10 +2259,12 @@ class GridReport(View):
         # Loop over the data records
         resp = HttpResponse()
         ok = True
-        with transaction.atomic(using=request.database, savepoint=False):
-            content_type_id = ContentType.objects.get_for_model(
-                cls.model, for_concrete_model=False
-            ).pk
+        with transaction.atomic(
+            using=request.database, savepoint=False
+        ), cls.model.bulkUpdate(request.database) if issubclass(
+            cls.model, AuditModel
+        ) else nullcontext():
+            comments = CommentBuffer(cls.model, request.user, request.database)
             for rec in json.JSONDecoder().decode(
                 request.read().decode(request.encoding or settings.DEFAULT_CHARSET)
             ):
@@ -1865,15 +2274,14 @@ class GridReport(View):
                         sid = transaction.savepoint(using=request.database)
                         try:
                             obj = cls.model.objects.using(request.database).get(pk=key)
-                            Comment(
-                                user_id=request.user.id,
-                                content_type_id=content_type_id,
-                                object_pk=force_str(key),
-                                object_repr=force_str(obj)[:200],
-                                type="delete",
-                                comment="Deleted %s." % force_str(obj),
-                            ).save(using=request.database)
+                            obj_repr = force_str(obj)
                             obj.delete()
+                            comments.add(
+                                force_str(key),
+                                obj_repr,
+                                "delete",
+                                "Deleted %s." % obj_repr,
+                            )
                             transaction.savepoint_commit(sid)
                         except cls.model.DoesNotExist:
                             transaction.savepoint_rollback(sid)
@@ -1903,14 +2311,9 @@ class GridReport(View):
                                     _("Can't copy %s") % cls.model._meta.app_label
                                 )
                             obj.save(using=request.database, force_insert=True)
-                            Comment(
-                                user_id=request.user.pk,
-                                content_type_id=content_type_id,
-                                object_pk=obj.pk,
-                                object_repr=force_str(obj)[:200],
-                                type="add",
-                                comment="Copied from %s." % orig_repr,
-                            ).save(using=request.database)
+                            comments.add(
+                                obj.pk, obj, "add", "Copied from %s." % orig_repr
+                            )
                             transaction.savepoint_commit(sid)
                         except cls.model.DoesNotExist:
                             transaction.savepoint_rollback(sid)
@@ -1954,15 +2357,13 @@ class GridReport(View):
                         if form.has_changed():
                             obj = form.save(commit=False)
                             obj.save(using=request.database)
-                            Comment(
-                                user_id=request.user.pk,
-                                content_type_id=content_type_id,
-                                object_pk=obj.pk,
-                                object_repr=force_str(obj),
-                                type="change",
-                                comment="Changed %s."
+                            comments.add(
+                                obj.pk,
+                                obj,
+                                "change",
+                                "Changed %s."
                                 % get_text_list(form.changed_data, "and"),
-                            ).save(using=request.database)
+                            )
                         transaction.savepoint_commit(sid)
                     except cls.model.DoesNotExist:
                         transaction.savepoint_rollback(sid)
@@ -1989,6 +2390,7 @@ class GridReport(View):
                         ok = False
                         resp.write(escape(e))
                         resp.write("<br>")
+            comments.close()
         if ok:
             resp.write("OK")
         resp.status_code = ok and 200 or 500
@@ -2282,66 +2684,70 @@ class GridReport(View):
                     )
 
                     # Loop through the data records
-                    wb = load_workbook(filename=file, data_only=True)
-                    numsheets = len(wb.sheetnames)
-
-                    for ws_name in wb.sheetnames:
-                        rowprefix = "" if numsheets == 1 else "%s " % ws_name
-                        ws = wb[ws_name]
-                        for error in parseExcelWorksheet(
-                            cls.model,
-                            ws,
-                            user=request.user,
-                            database=request.database,
-                            ping=True,
-                        ):
-                            if error[0] == logging.DEBUG:
-                                # Yield some result so we can detect disconnect clients and interrupt the upload
-                                yield "<tr class='hidden' data-cnt='%s'>" % error[1]
-                                continue
-                            if firsterror and error[0] in (
-                                logging.ERROR,
-                                logging.WARNING,
+                    wb = load_workbook(filename=file, read_only=True, data_only=True)
+                    try:
+                        numsheets = len(wb.sheetnames)
+
+                        for ws_name in wb.sheetnames:
+                            rowprefix = "" if numsheets == 1 else "%s " % ws_name
+                            ws = wb[ws_name]
+                            for error in parseExcelWorksheet(
+                                cls.model,
+                                ws,
+                                user=request.user,
+                                database=request.database,
+                                ping=True,
                             ):
-                                yield '<tr><th class="sr-only">%s</th><th>%s</th><th>%s</th><th>%s</th><th>%s%s%s</th></tr>' % (
-                                    capfirst(_("worksheet")),
-                                    capfirst(_("row")),
-                                    capfirst(_("field")),
-                                    capfirst(_("value")),
-                                    capfirst(_("error")),
-                                    " / ",
-                                    capfirst(_("warning")),
-                                )
-                                firsterror = False
-                            if error[0] == logging.ERROR:
-                                yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
-                                    cls.model._meta.verbose_name,
-                                    error[1] if error[1] else "",
-                                    "%s%s" % (rowprefix, error[2]) if error[2] else "",
-                                    error[3] if error[3] else "",
-                                    capfirst(_("error")),
-                                    error[4],
-                                )
-                                numerrors += 1
-                            elif error[1] == logging.WARNING:
-                                yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
-                                    cls.model._meta.verbose_name,
-                                    error[1] if error[1] else "",
-                                    "%s%s" % (rowprefix, error[2]) if error[2] else "",
-                                    error[3] if error[3] else "",
-                                    capfirst(_("warning")),
-                                    error[4],
-                                )
-                                numwarnings += 1
-                            else:
-                                yield '<tr class=%s><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
-                                    "danger" if numerrors > 0 else "success",
-                                    cls.model._meta.verbose_name,
-                                    error[1] if error[1] else "",
-                                    "%s%s" % (rowprefix, error[2]) if error[2] else "",
-                                    error[3] if error[3] else "",
-                                    error[4],
-                                )
+                                if error[0] == logging.DEBUG:
+                                    # Yield some result so we can detect disconnect clients and interrupt the upload
+                                    yield "<tr class='hidden' data-cnt='%s'>" % error[1]
+                                    continue
+                                if firsterror and error[0] in (
+                                    logging.ERROR,
+                                    logging.WARNING,
+                                ):
+                                    yield '<tr><th class="sr-only">%s</th><th>%s</th><th>%s</th><th>%s</th><th>%s%s%s</th></tr>' % (
+                                        capfirst(_("worksheet")),
+                                        capfirst(_("row")),
+                                        capfirst(_("field")),
+                                        capfirst(_("value")),
+                                        capfirst(_("error")),
+                                        " / ",
+                                        capfirst(_("warning")),
+                                    )
+                                    firsterror = False
+                                if error[0] == logging.ERROR:
+                                    yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
+                                        cls.model._meta.verbose_name,
+                                        error[1] if error[1] else "",
+                                        "%s%s" % (rowprefix, error[2]) if error[2] else "",
+                                        error[3] if error[3] else "",
+                                        capfirst(_("error")),
+                                        error[4],
+                                    )
+                                    numerrors += 1
+                                elif error[1] == logging.WARNING:
+                                    yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
+                                        cls.model._meta.verbose_name,
+                                        error[1] if error[1] else "",
+                                        "%s%s" % (rowprefix, error[2]) if error[2] else "",
+                                        error[3] if error[3] else "",
+                                        capfirst(_("warning")),
+                                        error[4],
+                                    )
+                                    numwarnings += 1
+                                else:
+                                    yield '<tr class=%s><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+                                        "danger" if numerrors > 0 else "success",
+                                        cls.model._meta.verbose_name,
+                                        error[1] if error[1] else "",
+                                        "%s%s" % (rowprefix, error[2]) if error[2] else "",
+                                        error[3] if error[3] else "",
+                                        error[4],
+                                    )
+                    finally:
+                        # A read-only workbook keeps the file open
+                        wb.close()
                 yield "</tbody></table></div>"
 
             # Records are committed. Launch notification generator now.
@@ -2777,6 +3183,11 @@ class GridPivot(GridReport):
 
     multiselect = False
 
+    # Set to true to serve pages of the report from the report cache.
+    # The cached rows are discarded when the plan is exported or the data is
+    # edited, so only reports that depend on nothing else can set this.
+    cacheable = False
+
     @classmethod
     def _render_cross(cls, request):
         result = []
@@ -2860,7 +3271,7 @@ class GridPivot(GridReport):
         return ",\n".join(result)
 
     @classmethod
-    def count_query(cls, request, *args, **kwargs):
+    def _count_queryset(cls, request, *args, **kwargs):
         if not hasattr(request, "basequery"):
             if callable(cls.basequeryset):
                 request.basequery = cls.basequeryset(request, *args, **kwargs)
@@ -2868,9 +3279,7 @@ class GridPivot(GridReport):
                 request.basequery = cls.basequeryset
             if args and args[0] and not cls.new_arg_logic:
                 request.basequery = request.basequery.filter(pk__exact=args[0])
-        return (
-            cls.filter_items(request, request.basequery).using(request.database).count()
-        )
+        return cls.filter_items(request, request.basequery).using(request.database)
 
     @classmethod
     def data_query(cls, request, *args, page=None, fields=None, **kwargs):
@@ -2885,13 +3294,14 @@ class GridPivot(GridReport):
                 request.basequery = request.basequery.filter(pk__exact=args[0])
         if page:
             cnt = (page - 1) * request.pagesize + 1
-            return cls.query(
-                request,
-                cls._apply_sort(
-                    request, cls.filter_items(request, request.basequery)
-                ).using(request.database)[cnt - 1 : cnt + request.pagesize],
-                sortsql=cls._apply_sort_index(request),
-            )
+            query = cls._apply_sort(
+                request, cls.filter_items(request, request.basequery)
+            ).using(request.database)[cnt - 1 : cnt + request.pagesize]
+            if cls.cacheable:
+                return cls._cached_query(
+                    request, query, sortsql=cls._apply_sort_index(request)
+                )
+            return cls.query(request, query, sortsql=cls._apply_sort_index(request))
         else:
             return cls.query(
                 request,
@@ -2901,6 +3311,41 @@ class GridPivot(GridReport):
                 sortsql=cls._apply_sort_index(request),
             )
 
+    @classmethod
+    def _cached_query(cls, request, basequery, sortsql):
+        """
+        Returns the rows of a page from the report cache, and computes and
+        stores them when they're not cached yet.
+        """
+        basesql, baseparams = basequery.query.get_compiler(basequery.db).as_sql(
+            with_col_aliases=False
+        )
+        key = hashlib.sha1(
+            repr(
+                (
+                    cls.__module__,
+                    cls.__name__,
+                    basesql,
+                    baseparams,
+                    sortsql,
+                    getattr(request, "report_bucket", None),
+                    getattr(request, "report_startdate", None),
+                    getattr(request, "report_enddate", None),
+                    getattr(request, "current_date", None),
+                )
+            ).encode("utf-8")
+        ).hexdigest()
+        rows = ReportCache.get(key, request.database)
+        if rows is not None:
+            yield from rows
+            return
+        version = ReportCache.getVersion(request.database)
+        rows = []
+        for r in cls.query(request, basequery, sortsql=sortsql):
+            rows.append(r)
+            yield r
+        ReportCache.store(key, rows, version, request.database)
+
     @classmethod
     def _generate_json_data(cls, request, *args, **kwargs):
         # Prepare the query
@@ -2979,7 +3424,10 @@ class GridPivot(GridReport):
             writer = csv.writer(sf, quoting=csv.QUOTE_NONNUMERIC, delimiter=",")
         if translation.get_language() != request.LANGUAGE_CODE:
             translation.activate(request.LANGUAGE_CODE)
-        listformat = request.GET.get("format", "csvlist") == "csvlist"
+        listformat = request.GET.get("format", "csvlist") in (
+            "csvlist",
+            "spreadsheetlist",
+        )
 
         # Write a Unicode Byte Order Mark header, aka BOM (Excel needs it to open UTF-8 file properly)
         yield cls.getBOM(settings.CSV_CHARSET)
@@ -3070,9 +3518,9 @@ class GridPivot(GridReport):
         # Write the report content
         orginal_database = request.database
         try:
-            for scenario in scenario_list:
-                request.database = scenario
-                query = cls.data_query(request, *args, fields=fields, **kwargs)
+            for scenario, query in cls._scenario_queries(
+                request, scenario_list, *args, fields=fields, **kwargs
+            ):
 
                 if listformat:
                     for row in query:
@@ -3273,9 +3721,30 @@ class GridPivot(GridReport):
             request.database = orginal_database
 
     @classmethod
-    def _generate_spreadsheet_data(
-        cls, request, scenario_list, output, *args, **kwargs
-    ):
+    def _spreadsheet_size(cls, request, scenario_list, *args, **kwargs):
+        records = 0
+        for scenario in scenario_list:
+            scenario_request = copy(request)
+            scenario_request.database = scenario
+            records += cls.estimate_query(scenario_request, *args, **kwargs)
+        if request.GET.get("format", "spreadsheetlist") == "spreadsheetlist":
+            # A row per bucket, a column per cross
+            return (
+                records * len(request.report_bucketlist) + 1,
+                len(request.rows) + len(request.crosses) + 2,
+            )
+        else:
+            # A row per cross, a column per bucket
+            return (
+                records * len(request.crosses) + 1,
+                len(request.rows) + len(request.report_bucketlist) + 2,
+            )
+
+    @classmethod
+    def _generate_spreadsheet_data(cls, request, scenario_list, *args, **kwargs):
+        if translation.get_language() != request.LANGUAGE_CODE:
+            translation.activate(request.LANGUAGE_CODE)
+
         # Create a workbook
         wb = Workbook(write_only=True)
         if callable(cls.title):
@@ -3431,12 +3900,15 @@ class GridPivot(GridReport):
         # Add an auto-filter to the table
         ws.auto_filter.ref = "A1:%s1048576" % get_column_letter(len(fields))
 
+        # The data rows are streamed
+        stream = SpreadsheetStream(wb, ws)
+
         # Write the report content
         original_database = request.database
         try:
-            for scenario in scenario_list:
-                request.database = scenario
-                query = cls.data_query(request, *args, fields=fields, **kwargs)
+            for scenario, query in cls._scenario_queries(
+                request, scenario_list, *args, fields=fields, **kwargs
+            ):
 
                 if listformat:
                     for row in query:
@@ -3463,7 +3935,9 @@ class GridPivot(GridReport):
                             )
                         if len(scenario_list) > 1:
                             fields.insert(0, scenario)
-                        ws.append(fields)
+                        data = stream.append(fields)
+                        if data:
+                            yield data
                 else:
                     currentkey = None
                     row_of_buckets = None
@@ -3511,7 +3985,9 @@ class GridPivot(GridReport):
                                 )
                                 if len(scenario_list) > 1:
                                     fields.insert(0, scenario)
-                                ws.append(fields)
+                                data = stream.append(fields)
+                                if data:
+                                    yield data
                             currentkey = row[request.rows[0].name]
                             row_of_buckets = [row]
                     # Write the last row
@@ -3549,12 +4025,14 @@ class GridPivot(GridReport):
                             )
                             if len(scenario_list) > 1:
                                 fields.insert(0, scenario)
-                            ws.append(fields)
+                            data = stream.append(fields)
+                            if data:
+                                yield data
         finally:
             request.database = original_database
 
-        # Write the spreadsheet
-        wb.save(output)
+        # Complete the spreadsheet
+        yield stream.close()
 
 
 numericTypes = (Decimal, float, int)
@@ -3597,6 +4075,20 @@ def _parseSeconds(data):
     )
 
 
+def _gzipStream(content):
+    """
+    Compresses the output of a generator with gzip.
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in content:
+        data = compressor.compress(
+            chunk.encode(settings.CSV_CHARSET) if isinstance(chunk, str) else chunk
+        )
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 def _getCellValue(data, field=None, exportConfig=None, request=None):
     if data is None:
         return ""
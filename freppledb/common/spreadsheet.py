@@ -0,0 +1,161 @@
+#
+# Copyright (C) 2021 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import date, datetime
+from decimal import Decimal
+from io import BytesIO
+import math
+import re
+from xml.sax.saxutils import escape
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.datetime import to_excel
+
+# Control characters aren't allowed in XML
+illegalCharacters = re.compile(r"[\000-\010]|[\013-\014]|[\016-\037]")
+
+
+class SpreadsheetStream:
+    """
+    Streams an openpyxl write-only workbook as an XLSX file, while its data
+    rows are being appended.
+
+    The workbook is prepared as usual: styles, a single worksheet, the header
+    row, comments and auto-filter. The data rows are then appended to this
+    object rather than to the worksheet. They are written straight into a
+    zip archive, and the compressed output is returned in chunks as it becomes
+    available.
+    """
+
+    # Number of rows converted to XML at a time
+    batchsize = 1000
+
+    def __init__(self, workbook, worksheet):
+        self.workbook = workbook
+        self.worksheet = worksheet
+        self.archive = None
+        self.output = []
+        self.rows = []
+        self.columns = []
+
+        # Register the cell styles for dates, before the styles are saved
+        self.datestyle = WriteOnlyCell(worksheet, value=date(2000, 1, 1)).style_id
+        self.datetimestyle = WriteOnlyCell(
+            worksheet, value=datetime(2000, 1, 1)
+        ).style_id
+
+    def write(self, data):
+        # The zip archive writes its output here
+        self.output.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read(self):
+        """
+        Returns the output that is ready.
+        """
+        data = b"".join(self.output)
+        self.output = []
+        return data
+
+    def _start(self):
+        # Save the workbook without data rows, and copy it to the archive
+        template = BytesIO()
+        self.workbook.save(template)
+        sheetpath = self.worksheet.path[1:]
+        self.archive = ZipFile(self, "w", ZIP_DEFLATED)
+        with ZipFile(template) as wb:
+            for name in wb.namelist():
+                if name != sheetpath:
+                    self.archive.writestr(name, wb.read(name))
+            sheet = wb.read(sheetpath).decode("utf-8")
+
+        # The data rows go at the end of the sheetData element.
+        # The dimension element is optional, and we don't know the size yet.
+        sheet = re.sub(r"<dimension [^>]*/>", "", sheet)
+        sheet = re.sub(r"<sheetData\s*/>", "<sheetData></sheetData>", sheet)
+        pos = sheet.index("</sheetData>")
+        self.rownumber = sheet.count("<row ", 0, pos)
+        self.end = sheet[pos:]
+        # The size of the sheet is unknown, and can exceed the limit of 2 GiB
+        self.entry = self.archive.open(sheetpath, "w", force_zip64=True)
+        self.entry.write(sheet[:pos].encode("utf-8"))
+
+    def _cell(self, column, value):
+        if value is None or value == "":
+            return ""
+        while column >= len(self.columns):
+            self.columns.append(get_column_letter(len(self.columns) + 1))
+        ref = "%s%s" % (self.columns[column], self.rownumber)
+        if isinstance(value, bool):
+            return '<c r="%s" t="b"><v>%d</v></c>' % (ref, value)
+        elif isinstance(value, (int, Decimal)) or (
+            isinstance(value, float) and math.isfinite(value)
+        ):
+            return '<c r="%s"><v>%s</v></c>' % (ref, value)
+        elif isinstance(value, datetime):
+            return '<c r="%s" s="%d"><v>%s</v></c>' % (
+                ref,
+                self.datetimestyle,
+                to_excel(value),
+            )
+        elif isinstance(value, date):
+            return '<c r="%s" s="%d"><v>%s</v></c>' % (
+                ref,
+                self.datestyle,
+                to_excel(value),
+            )
+        return '<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+            ref,
+            escape(illegalCharacters.sub("", str(value))),
+        )
+
+    def append(self, row):
+        """
+        Appends a row of values, and returns the output that is ready.
+        """
+        if not self.archive:
+            self._start()
+        self.rownumber += 1
+        self.rows.append(
+            '<row r="%s">%s</row>'
+            % (
+                self.rownumber,
+                "".join([self._cell(col, val) for col, val in enumerate(row)]),
+            )
+        )
+        if len(self.rows) >= self.batchsize:
+            self.entry.write("".join(self.rows).encode("utf-8"))
+            self.rows = []
+        return self.read()
+
+    def close(self):
+        """
+        Completes the file, and returns the remaining output.
+        """
+        if not self.archive:
+            self._start()
+        self.rows.append(self.end)
+        self.entry.write("".join(self.rows).encode("utf-8"))
+        self.rows = []
+        self.entry.close()
+        self.archive.close()
+        return self.read()
@@ -15,13 +15,30 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import csv
+import gzip
+from io import BytesIO, StringIO
+import json
+import multiprocessing
+from openpyxl import load_workbook, Workbook
+import os
 import time
+from threading import Thread
+from types import SimpleNamespace
+from unittest import mock
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db import DEFAULT_DB_ALIAS
+from django.http import HttpResponse
 from django.http.response import StreamingHttpResponse
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
 
-from freppledb.common.models import User
+from freppledb.common.commands import PlanTaskParallel, PlanTaskRegistry
+from freppledb.common.dashboard import Dashboard
+from freppledb.common.models import Parameter, Scenario, User, UserPreference
+from freppledb.common.report import GridReport
+from freppledb.common.spreadsheet import SpreadsheetStream
 
 
 def checkResponse(testcase, response):
@@ -45,6 +62,235 @@ class DataLoadTest(TestCase):
                 return
         self.fail("Didn't find expected number of parameters")
 
+    def test_record_count(self):
+        def getRecords(url):
+            response = self.client.get(url, {"format": "json"})
+            return json.loads(b"".join(response.streaming_content))["records"]
+
+        # The cached counts of other models than audit models aren't emptied
+        # when they change, so they aren't cached
+        count = getRecords("/data/common/user/")
+        User.objects.create_user("counted", "counted@company.com", "counted")
+        self.assertEqual(getRecords("/data/common/user/"), count + 1)
+
+    def test_keyset_pagination(self):
+        def getPage(**kwargs):
+            response = self.client.get(
+                "/data/common/parameter/", {"format": "json", "rows": 3, **kwargs}
+            )
+            return json.loads(b"".join(response.streaming_content))
+
+        first = getPage(page=1)
+        self.assertIn("cursor", first)
+        seek = getPage(page=2, cursor=first["cursor"])
+        offset = getPage(page=2)
+        self.assertEqual(seek["rows"], offset["rows"])
+        self.assertNotEqual(seek["rows"], first["rows"])
+
+        # The cursor of a page read with a cursor gives the next page as well
+        seek = getPage(page=3, cursor=seek["cursor"])
+        offset = getPage(page=3)
+        self.assertEqual(seek["rows"], offset["rows"])
+
+    def test_spreadsheet_export(self):
+        # The export doesn't count the records before it starts
+        with mock.patch.object(GridReport, "count_query", side_effect=AssertionError):
+            response = self.client.get("/data/common/parameter/?format=spreadsheetlist")
+        self.assertIsInstance(response, StreamingHttpResponse)
+        wb = load_workbook(
+            BytesIO(b"".join(response.streaming_content)), read_only=True
+        )
+        rows = list(wb.active.iter_rows(values_only=True))
+        self.assertEqual(rows[0][0], "Name")
+        self.assertEqual(len(rows), Parameter.objects.count() + 1)
+
+        # Exports too big for excel return a compressed CSV file
+        with mock.patch.object(GridReport, "spreadsheetMaxRows", 1):
+            response = self.client.get("/data/common/parameter/?format=spreadsheetlist")
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertIn(".csv.gz", response["Content-Disposition"])
+        data = gzip.decompress(b"".join(response.streaming_content))
+        rows = list(csv.reader(StringIO(data.decode(settings.CSV_CHARSET))))
+        self.assertEqual(len(rows), Parameter.objects.count() + 1)
+
+
+class ScenarioExportTest(SimpleTestCase):
+    def test_scenario_queries(self):
+        def data_query(request, *args, **kwargs):
+            # The first scenario is the slowest one
+            if request.database == "default":
+                time.sleep(0.2)
+            return [(request.database, i) for i in range(2500)]
+
+        request = SimpleNamespace(database="default", LANGUAGE_CODE="en")
+        scenarios = ["default", "scenario1", "scenario2"]
+        with mock.patch.object(GridReport, "data_query", side_effect=data_query):
+            result = [
+                (scenario, request.database, list(query))
+                for scenario, query in GridReport._scenario_queries(request, scenarios)
+            ]
+        self.assertEqual([r[0] for r in result], scenarios)
+        for scenario, database, rows in result:
+            self.assertEqual(database, scenario)
+            self.assertEqual(rows, [(scenario, i) for i in range(2500)])
+
+
+class SpreadsheetStreamTest(SimpleTestCase):
+    def test_large_sheet(self):
+        # A sheet bigger than the zip64 limit of 2 GiB remains readable.
+        # We lower the limit rather than writing that much data.
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("data")
+        ws.append(["name", "value"])
+        stream = SpreadsheetStream(wb, ws)
+        output = BytesIO()
+        with mock.patch("zipfile.ZIP64_LIMIT", 1024):
+            for i in range(1000):
+                output.write(stream.append(["row %s" % i, i]))
+            output.write(stream.close())
+        rows = list(load_workbook(output, read_only=True).active.values)
+        self.assertEqual(len(rows), 1001)
+        self.assertEqual(rows[-1], ("row 999", 999))
+
+
+class DashboardTest(SimpleTestCase):
+    def test_render_once(self):
+        # Concurrent requests for a widget wait for the one rendering it
+        class SlowWidget:
+            name = "slow"
+            renders = 0
+
+            @staticmethod
+            def getCacheKey(request):
+                return None
+
+            @classmethod
+            def render(cls, request):
+                cls.renders += 1
+                time.sleep(0.5)
+                return HttpResponse("rendered")
+
+        request = SimpleNamespace(
+            database="default", user=SimpleNamespace(pk=1), GET={}
+        )
+        responses = []
+        threads = [
+            Thread(
+                target=lambda: responses.append(
+                    Dashboard.renderWidget(request, SlowWidget)
+                )
+            )
+            for i in range(3)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(SlowWidget.renders, 1)
+        self.assertEqual([i.content for i in responses], [b"rendered"] * 3)
+
+        # A request waiting for a render that takes too long gets status 504
+        thread = Thread(target=Dashboard.renderWidget, args=(request, SlowWidget))
+        thread.start()
+        time.sleep(0.1)
+        with mock.patch.object(Dashboard, "renderTimeout", 0.1):
+            self.assertEqual(
+                Dashboard.renderWidget(request, SlowWidget).status_code, 504
+            )
+        thread.join()
+
+    def test_render_interrupted(self):
+        # An interrupted render doesn't block the next requests for the widget
+        class Interrupted(BaseException):
+            pass
+
+        class InterruptedWidget:
+            name = "interrupted"
+
+            @staticmethod
+            def getCacheKey(request):
+                return None
+
+            @staticmethod
+            def render(request):
+                raise Interrupted
+
+        request = SimpleNamespace(
+            database="default", user=SimpleNamespace(pk=1), GET={}
+        )
+        with self.assertRaises(Interrupted):
+            Dashboard.renderWidget(request, InterruptedWidget)
+        self.assertFalse(
+            [i for i in Dashboard._rendering if i[0] == InterruptedWidget.name]
+        )
+
+
+class PlanTaskParallelTest(SimpleTestCase):
+    def setUp(self):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self.skipTest("Processes can't be forked on this platform")
+
+    @staticmethod
+    def group(fail=False):
+        def run(**kwargs):
+            if fail:
+                raise ValueError(os.getpid())
+
+        return SimpleNamespace(weight=1, run=run)
+
+    def runGroup(self, run):
+        process = PlanTaskParallel._PlanTaskProcess(
+            SimpleNamespace(run=run), name="export1"
+        )
+        process.start()
+        process.join()
+        return process
+
+    def test_process(self):
+        # The duration and the exception are reported back over the pipe
+        process = self.runGroup(lambda **kwargs: None)
+        self.assertIsNotNone(process.duration)
+        self.assertIsNone(process.exception)
+
+        def fail(**kwargs):
+            raise ValueError("failed")
+
+        process = self.runGroup(fail)
+        self.assertIsInstance(process.exception, ValueError)
+        self.assertEqual(str(process.exception), "failed")
+
+        # An exception that can't be pickled is passed on as its message
+        def unpicklable(**kwargs):
+            e = ValueError("unpicklable")
+            e.callback = lambda: None
+            raise e
+
+        process = self.runGroup(unpicklable)
+        self.assertEqual(str(process.exception), "unpicklable")
+
+        # A process that dies reports its exit code
+        process = self.runGroup(lambda **kwargs: os._exit(3))
+        self.assertIsNone(process.duration)
+        self.assertEqual(str(process.exception), "Process exited with code 3")
+
+    @override_settings(PLANTASK_PROCESSES=["export1"])
+    def test_parallel(self):
+        # Only the groups in the PLANTASK_PROCESSES setting run in a process,
+        # and their failures are raised in the parent process
+        parallel = PlanTaskParallel()
+        parallel.timestamp = None
+        parallel.groups = {"export1": self.group(fail=True), "export2": self.group()}
+        with mock.patch.object(PlanTaskRegistry, "getArguments", return_value={}):
+            with self.assertRaises(ValueError) as e:
+                parallel.run()
+        self.assertNotEqual(e.exception.args[0], os.getpid())
+
+        parallel.groups = {"export1": self.group(), "export2": self.group(fail=True)}
+        with mock.patch.object(PlanTaskRegistry, "getArguments", return_value={}):
+            with self.assertRaises(ValueError) as e:
+                parallel.run()
+        self.assertEqual(e.exception.args[0], os.getpid())
+
 
 class UserPreferenceTest(TestCase):
     def test_get_set_preferences(self):
@@ -54,3 +300,45 @@ class UserPreferenceTest(TestCase):
         user.setPreference("test", {"a": 1, "b": "c"})
         after = user.getPreference("test")
         self.assertEqual(after, {"a": 1, "b": "c"})
+
+
+class RequestCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.login(username="admin", password="admin")
+
+    def tearDown(self):
+        # The database is rolled back, so the cache is no longer valid
+        cache.clear()
+
+    def test_scenario_status(self):
+        scenario = Scenario.objects.get_or_create(name="scenario1")[0]
+        scenario.status = "In use"
+        scenario.save()
+        self.assertEqual(Scenario.getStatus("scenario1"), "In use")
+        scenario.status = "Free"
+        scenario.save()
+        self.client.logout()
+        response = self.client.get("/scenario1/data/input/item/")
+        self.assertEqual(response.status_code, 404)
+
+    def test_user(self):
+        response = self.client.get("/data/common/user/")
+        self.assertEqual(response.status_code, 200)
+        user = User.objects.get(username="admin")
+        user.is_superuser = False
+        user.save()
+        response = self.client.get("/data/common/user/")
+        self.assertEqual(response.status_code, 403)
+
+    def test_user_preference(self):
+        user = User.objects.get(username="admin")
+        user.setPreference("test", {"a": 1})
+        self.assertEqual(user.getPreference("test"), {"a": 1})
+        preference = UserPreference.objects.get(user=user, property="test")
+        preference.value = {"a": 2}
+        preference.save()
+        user = User.objects.get(username="admin")
+        self.assertEqual(user.getPreference("test"), {"a": 2})
+        preference.delete()
+        self.assertIsNone(user.getPreference("test"))
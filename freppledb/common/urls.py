@@ -45,6 +45,11 @@ urlpatterns = [
         freppledb.common.dashboard.Dashboard.dispatch,
         name="dashboard",
     ),
+    url(
+        r"^widgets/$",
+        freppledb.common.dashboard.Dashboard.dispatchAll,
+        name="dashboard_all",
+    ),
     # Model list reports, which override standard admin screens
     url(r"^data/login/$", freppledb.common.views.login),
     url(
@@ -15,21 +15,28 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import csv
 from datetime import datetime
+from logging import ERROR, INFO
 import os
+from threading import Lock, local
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, DEFAULT_DB_ALIAS, transaction
 from django.template import Template, RequestContext
 from django.utils.translation import gettext_lazy as _
 
 from freppledb import __version__
+from freppledb.common.dataload import parseCSVdata
+from freppledb.common.middleware import _thread_locals
 from freppledb.common.models import User
+from freppledb.common.report import matchesModelName
 from freppledb.execute.models import Task
 
-from ...utils import getERPconnection
+from ...utils import getERPconnection, getERPcursor
 
 
 class Command(BaseCommand):
@@ -44,6 +51,35 @@ class Command(BaseCommand):
     ext = "csv"
     # ext = 'cpy'
 
+    # Number of rows fetched from the ERP database at a time
+    batchsize = 10000
+
+    # Number of extracts running concurrently, each on its own ERP connection
+    workers = 4
+
+    # Number of times a failing extract is retried
+    retries = 1
+
+    # Extracts to run. They are independent of each other.
+    # Note: the suboperation table is now deprecated.
+    # The same data can now be directly loaded in the the operation table.
+    extracts = [
+        "extractLocation",
+        "extractCustomer",
+        "extractItem",
+        "extractSupplier",
+        "extractResource",
+        "extractSalesOrder",
+        "extractOperation",
+        "extractSuboperation",
+        "extractOperationResource",
+        "extractOperationMaterial",
+        "extractItemSupplier",
+        "extractCalendar",
+        "extractCalendarBucket",
+        "extractBuffer",
+    ]
+
     # For the display in the execution screen
     title = _("Import data from %(erp)s") % {"erp": "erp"}
 
@@ -67,6 +103,13 @@ class Command(BaseCommand):
             type=int,
             help="Task identifier (generated automatically if not provided)",
         )
+        parser.add_argument(
+            "--direct",
+            action="store_true",
+            default=False,
+            help="Load the extracted data directly in the frePPLe database, "
+            "rather than writing data files",
+        )
 
     @staticmethod
     def getHTML(request):
@@ -141,182 +184,255 @@ class Command(BaseCommand):
         self.task.save(using=self.database)
 
         # Set the destination folder
-        self.destination = settings.DATABASES[self.database]["FILEUPLOADFOLDER"]
-        if not os.access(self.destination, os.W_OK):
-            raise CommandError("Can't write to folder %s " % self.destination)
-
-        # Open database connection
-        print("Connecting to the database")
-        with getERPconnection(self.database) as erp_connection:
-            self.cursor = erp_connection.cursor()
-            self.fk = "_id" if self.ext == "cpy" else ""
-
-            # Extract all files
-            try:
-                self.extractLocation()
-                self.task.status = "6%"
-                self.task.save(using=self.database)
-
-                self.extractCustomer()
-                self.task.status = "12%"
-                self.task.save(using=self.database)
-
-                self.extractItem()
-                self.task.status = "18%"
-                self.task.save(using=self.database)
-
-                self.extractSupplier()
-                self.task.status = "24%"
-                self.task.save(using=self.database)
-
-                self.extractResource()
-                self.task.status = "30%"
-                self.task.save(using=self.database)
-
-                self.extractSalesOrder()
-                self.task.status = "36%"
-                self.task.save(using=self.database)
-
-                self.extractOperation()
-                self.task.status = "42%"
-                self.task.save(using=self.database)
-
-                # Note: the suboperation table is now deprecated.
-                # The same data can now be directly loaded in the the operation table.
-                self.extractSuboperation()
-                self.task.status = "48%"
-                self.task.save(using=self.database)
-
-                self.extractOperationResource()
-                self.task.status = "54%"
-                self.task.save(using=self.database)
-
-                self.extractOperationMaterial()
-                self.task.status = "60%"
-                self.task.save(using=self.database)
-
-                self.extractItemSupplier()
-                self.task.status = "66%"
-                self.task.save(using=self.database)
-
-                self.extractCalendar()
-                self.task.status = "72%"
-                self.task.save(using=self.database)
-
-                self.extractCalendarBucket()
-                self.task.status = "78%"
-                self.task.save(using=self.database)
-
-                self.extractBuffer()
-                self.task.status = "84%"
-                self.task.save(using=self.database)
-
-                self.extractItemSupplier()
-                self.task.status = "90%"
-                self.task.save(using=self.database)
+        self.direct = options["direct"]
+        if not self.direct:
+            self.destination = settings.DATABASES[self.database]["FILEUPLOADFOLDER"]
+            if not os.access(self.destination, os.W_OK):
+                raise CommandError("Can't write to folder %s " % self.destination)
+
+        # Extract all files
+        self.fk = "_id" if self.ext == "cpy" and not self.direct else ""
+        self.errors = 0
+        self.throughput = []
+        try:
+            failed = self.extractAll()
+            if failed:
+                self.task.status = "Failed"
+                self.task.message = "Failed: %s" % ", ".join(failed)
+            elif self.errors:
+                self.task.status = "Failed"
+                self.task.message = "%s data errors" % self.errors
+            else:
+                self.task.status = "Done"
+                self.task.message = None
+            if self.throughput:
+                self.task.message = "; ".join(
+                    ([self.task.message] if self.task.message else [])
+                    + self.throughput
+                )
 
-                self.extractCalendar()
-                self.task.status = "96%"
-                self.task.save(using=self.database)
+        except Exception as e:
+            self.task.status = "Failed"
+            self.task.message = "Failed: %s" % e
 
-                self.extractCalendarBucket()
-                self.task.status = "100%"
-                self.task.save(using=self.database)
+        finally:
+            self.task.processid = None
+            self.task.finished = datetime.now()
+            self.task.save(using=self.database)
 
-                self.task.status = "Done"
+    def getConnection(self):
+        return getERPconnection(self.database)
 
-            except Exception as e:
-                self.task.status = "Failed"
-                self.task.message = "Failed: %s" % e
+    def extractAll(self):
+        """
+        Runs the extract methods concurrently, each worker thread using its own
+        ERP connection. A failing extract is retried on a new connection.
+        Returns the list of extracts that failed.
 
-            finally:
-                self.task.processid = None
-                self.task.finished = datetime.now()
-                self.task.save(using=self.database)
+        In direct mode the extracts run one at a time, so the data is loaded
+        in the order of the extracts list and the foreign keys can be checked.
+        """
+        self.pool = pool = local()
+        opened = []
+        lock = Lock()
+
+        def run(extract):
+            for attempt in range(self.retries + 1):
+                if getattr(pool, "connection", None) is None:
+                    pool.connection = self.getConnection()
+                    with lock:
+                        opened.append(pool.connection)
+                try:
+                    getattr(self, extract)()
+                    return
+                except Exception as e:
+                    print("Error running %s: %s" % (extract, e))
+                    # The next attempt or extract on this thread uses a new
+                    # connection
+                    try:
+                        pool.connection.close()
+                    except Exception:
+                        pass
+                    pool.connection = None
+                    if attempt >= self.retries:
+                        raise
+
+        failed = []
+        try:
+            with ThreadPoolExecutor(
+                max_workers=1 if self.direct else self.workers
+            ) as executor:
+                futures = {executor.submit(run, i): i for i in self.extracts}
+                for cnt, future in enumerate(as_completed(futures), start=1):
+                    if future.exception():
+                        failed.append(futures[future])
+                    self.task.status = "%d%%" % (cnt * 100 / len(futures))
+                    self.task.save(using=self.database)
+        finally:
+            for conn in opened:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        return sorted(failed, key=self.extracts.index)
+
+    def writeFile(self, filename, header, sql):
+        """
+        Streams the result of a query on the ERP database into a data file.
+        The rows are fetched in batches, and the file only gets its final name
+        when it is complete.
+        """
+        if self.direct:
+            return self.loadTable(filename, header, sql)
+        outfilename = os.path.join(self.destination, "%s.%s" % (filename, self.ext))
+        print("Start extracting %s to %s" % (filename, outfilename))
+        tmpfilename = "%s.tmp" % outfilename
+        cursor = getERPcursor(self.pool.connection)
+        try:
+            cursor.execute(sql)
+            with open(tmpfilename, "w", newline="") as outfile:
+                outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
+                outcsv.writerow(header)
+                while True:
+                    rows = cursor.fetchmany(self.batchsize)
+                    if not rows:
+                        break
+                    outcsv.writerows(rows)
+            os.replace(tmpfilename, outfilename)
+        finally:
+            cursor.close()
+            if os.path.exists(tmpfilename):
+                os.remove(tmpfilename)
+
+    def loadTable(self, name, header, sql):
+        """
+        Streams the result of a query on the ERP database directly into the
+        frePPLe database, in a single transaction. The rows are validated and
+        copied in batches into a staging table that is merged into the target
+        table. See the _BulkLoader class for details.
+        """
+        model = None
+        for ct in ContentType.objects.all():
+            if ct.model_class() and matchesModelName(name, ct.model_class()):
+                model = ct.model_class()
+                break
+        if not model:
+            raise CommandError("No model found for %s" % name)
+        print("Start loading %s" % name)
+        start = datetime.now()
+        rowcount = 0
+        cursor = getERPcursor(self.pool.connection)
+
+        def getRows():
+            nonlocal rowcount
+            yield header
+            while True:
+                rows = cursor.fetchmany(self.batchsize)
+                if not rows:
+                    break
+                rowcount += len(rows)
+                yield from rows
+
+        setattr(_thread_locals, "database", self.database)
+        try:
+            cursor.execute(sql)
+            errors = 0
+            with transaction.atomic(using=self.database):
+                for msg in parseCSVdata(
+                    model, getRows(), user=self.user, database=self.database, bulk=True
+                ):
+                    if msg[0] == ERROR:
+                        errors += 1
+                        print(
+                            "Error loading %s: row %s, field %s, value %s: %s"
+                            % ((name,) + tuple(msg[1:]))
+                        )
+                    elif msg[0] == INFO:
+                        print("Finished loading %s: %s" % (name, msg[4]))
+        finally:
+            cursor.close()
+            setattr(_thread_locals, "database", None)
+            connections.close_all()
+        duration = (datetime.now() - start).total_seconds()
+        self.errors += errors
+        self.throughput.append(
+            "%s: %d rows in %.1f seconds (%d rows/s)"
+            % (name, rowcount, duration, rowcount / max(duration, 0.001))
+        )
 
     def extractLocation(self):
         """
         Straightforward mapping JobBOSS locations to frePPLe locations.
         Only the SHOP location is actually used in the frePPLe model.
         """
-        outfilename = os.path.join(self.destination, "location.%s" % self.ext)
-        print("Start extracting locations to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "location",
+            ["name", "description", "lastmodified"],
             """
       select
         location_id, description, current_timestamp
       from location
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(["name", "description", "lastmodified"])
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractCustomer(self):
         """
         Straightforward mapping JobBOSS customers to frePPLe customers.
         """
-        outfilename = os.path.join(self.destination, "customer.%s" % self.ext)
-        print("Start extracting customers to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "customer",
+            ["name", "category", "lastmodified"],
             """
       select distinct customer, type, current_timestamp from customer
       union
       select 'N/A', null, current_timestamp
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(["name", "category", "lastmodified"])
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractItem(self):
         """
         Map active JobBOSS jobs into frePPLe items.
         """
-        outfilename = os.path.join(self.destination, "item.%s" % self.ext)
-        print("Start extracting items to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "item",
+            ["name", "subcategory", "description", "category", "lastmodified"],
             """
       select job, part_number, description, customer, current_timestamp
       from job
       where status = 'Active'
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(
-                ["name", "subcategory", "description", "category", "lastmodified"]
-            )
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractSupplier(self):
         """
         Map active JobBOSS vendors into frePPLe suppliers.
         """
-        outfilename = os.path.join(self.destination, "supplier.%s" % self.ext)
-        print("Start extracting suppliers to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "supplier",
+            ["name", "description", "lastmodified"],
             """
       select vendor, name, current_timestamp
       from vendor
       where status = 'Active'
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(["name", "description", "lastmodified"])
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractResource(self):
         """
         Map JobBOSS work centers into frePPLe resources.
         Only take the top-level workcenters, and skip the inactive ones.
         """
-        outfilename = os.path.join(self.destination, "resource.%s" % self.ext)
-        print("Start extracting resources to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "resource",
+            [
+                "name",
+                "category",
+                "subcategory",
+                "maximum",
+                "location%s" % self.fk,
+                "type",
+                "lastmodified",
+            ],
             """
       select work_center, uvtext4, department, machines, 'SHOP', 'default', current_timestamp
       from work_center
@@ -325,30 +441,29 @@ class Command(BaseCommand):
       select vendor, name, 'OUTSOURCED', 1, 'SHOP', 'infinite', current_timestamp
       from vendor
       where status = 'Active'
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(
-                [
-                    "name",
-                    "category",
-                    "subcategory",
-                    "maximum",
-                    "location%s" % self.fk,
-                    "type",
-                    "lastmodified",
-                ]
-            )
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractSalesOrder(self):
         """
         Map JobBOSS top level jobs into frePPLe sales orders.
         """
-        outfilename = os.path.join(self.destination, "demand.%s" % self.ext)
-        print("Start extracting demand to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "demand",
+            [
+                "name",
+                "item%s" % self.fk,
+                "location%s" % self.fk,
+                "customer%s" % self.fk,
+                "status",
+                "due",
+                "quantity",
+                "minimum shipment" if self.ext == "csv" else "minshipment",
+                "description",
+                "category",
+                "priority",
+                "lastmodified",
+            ],
             """
       select
         job, job, 'SHOP', coalesce(customer, 'N/A'), 'open', order_date,
@@ -358,27 +473,8 @@ class Command(BaseCommand):
       where status = 'Active'
       and top_lvl_job = job
       and make_quantity > completed_quantity
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(
-                [
-                    "name",
-                    "item%s" % self.fk,
-                    "location%s" % self.fk,
-                    "customer%s" % self.fk,
-                    "status",
-                    "due",
-                    "quantity",
-                    "minimum shipment" if self.ext == "csv" else "minshipment",
-                    "description",
-                    "category",
-                    "priority",
-                    "lastmodified",
-                ]
-            )
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractOperation(self):
         """
@@ -386,9 +482,20 @@ class Command(BaseCommand):
         We extract a routing operation and also suboperations.
         SQL contains an ugly trick to avoid duplicate job-sequence combinations.
         """
-        outfilename = os.path.join(self.destination, "operation.%s" % self.ext)
-        print("Start extracting operations to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "operation",
+            [
+                "name",
+                "description",
+                "category",
+                "subcategory",
+                "type",
+                "item%s" % self.fk,
+                "location%s" % self.fk,
+                "duration",
+                "duration_per",
+                "lastmodified",
+            ],
             """
       select
         job, description, part_number, null, 'routing', job,
@@ -426,33 +533,21 @@ class Command(BaseCommand):
       where job.status = 'Active'
       ) ops
       where rownumber = 1
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(
-                [
-                    "name",
-                    "description",
-                    "category",
-                    "subcategory",
-                    "type",
-                    "item%s" % self.fk,
-                    "location%s" % self.fk,
-                    "duration",
-                    "duration_per",
-                    "lastmodified",
-                ]
-            )
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractSuboperation(self):
         """
     Map JobBOSS joboperations into frePPLe suboperations.
     """
-        outfilename = os.path.join(self.destination, "suboperation.%s" % self.ext)
-        print("Start extracting suboperations to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "suboperation",
+            [
+                "operation%s" % self.fk,
+                "suboperation%s" % self.fk,
+                "priority",
+                "lastmodified",
+            ],
             """
       select
         distinct job.job, concat(job.job, ' - ', sequence), sequence, current_timestamp
@@ -460,27 +555,21 @@ class Command(BaseCommand):
       inner join job
       on job_operation.job = job.job
       where job.status = 'Active'
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(
-                [
-                    "operation%s" % self.fk,
-                    "suboperation%s" % self.fk,
-                    "priority",
-                    "lastmodified",
-                ]
-            )
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractOperationResource(self):
         """
     Map JobBOSS joboperation workcenters into frePPLe operation-resources.
     """
-        outfilename = os.path.join(self.destination, "operationresource.%s" % self.ext)
-        print("Start extracting operationresource to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "operationresource",
+            [
+                "operation%s" % self.fk,
+                "resource%s" % self.fk,
+                "quantity",
+                "lastmodified",
+            ],
             """
       select
         concat(job.job, ' - ', sequence),
@@ -493,27 +582,22 @@ class Command(BaseCommand):
       left outer join vendor on job_operation.vendor = vendor.vendor and vendor.status = 'Active'
       where job.status = 'Active'
         and (vendor.vendor is not null or work_center.work_center is not null)
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(
-                [
-                    "operation%s" % self.fk,
-                    "resource%s" % self.fk,
-                    "quantity",
-                    "lastmodified",
-                ]
-            )
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractOperationMaterial(self):
         """
     Map JobBOSS joboperation workcenters into frePPLe operation-materials.
     """
-        outfilename = os.path.join(self.destination, "operationmaterial.%s" % self.ext)
-        print("Start extracting operationmaterial to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "operationmaterial",
+            [
+                "operation%s" % self.fk,
+                "item%s" % self.fk,
+                "type",
+                "quantity",
+                "lastmodified",
+            ],
             """
       select
         case when job_operation.sequence is null then parent_job else concat(parent_job, ' - ', sequence) end,
@@ -536,28 +620,22 @@ class Command(BaseCommand):
         group by job
       ) job_max_sequence on job_max_sequence.job = job.job
       where status = 'Active'
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(
-                [
-                    "operation%s" % self.fk,
-                    "item%s" % self.fk,
-                    "type",
-                    "quantity",
-                    "lastmodified",
-                ]
-            )
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractBuffer(self):
         """
     Map JobBOSS operation completed into frePPLe buffer onhand.
     """
-        outfilename = os.path.join(self.destination, "buffer.%s" % self.ext)
-        print("Start extracting buffer to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "buffer",
+            [
+                "name",
+                "item%s" % self.fk,
+                "location%s" % self.fk,
+                "onhand",
+                "lastmodified",
+            ],
             """
       select
         concat(job, ' @ SHOP'), job, 'SHOP',
@@ -566,20 +644,8 @@ class Command(BaseCommand):
       from job
       where status = 'Active'
         and completed_quantity > 0
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(
-                [
-                    "name",
-                    "item%s" % self.fk,
-                    "location%s" % self.fk,
-                    "onhand",
-                    "lastmodified",
-                ]
-            )
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractItemSupplier(self):
         """
@@ -591,17 +657,13 @@ class Command(BaseCommand):
         """
     Extract working hours calendars from the ERP system.
     """
-        outfilename = os.path.join(self.destination, "calendar.%s" % self.ext)
-        print("Start extracting calendar to %s" % outfilename)
-        self.cursor.execute(
+        self.writeFile(
+            "calendar",
+            ["name", "lastmodified"],
             """
       select 'Working hours', current_timestamp
-      """
+      """,
         )
-        with open(outfilename, "w", newline="") as outfile:
-            outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
-            outcsv.writerow(["name", "lastmodified"])
-            outcsv.writerows(self.cursor.fetchall())
 
     def extractCalendarBucket(self):
         pass
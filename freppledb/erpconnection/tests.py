@@ -0,0 +1,108 @@
+#
+# Copyright (C) 2017 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import csv
+import os
+import sqlite3
+import tempfile
+from unittest import mock
+
+from django.db import DEFAULT_DB_ALIAS
+from django.test import SimpleTestCase, TransactionTestCase
+
+from freppledb.erpconnection.management.commands.erp2frepple import Command
+from freppledb.input.models import Location
+
+
+class ERPStandIn(Command):
+    """
+    A stand-in for the ERP database, using a SQLite database file.
+    """
+
+    def getConnection(self):
+        self.connections += 1
+        return sqlite3.connect(self.erpdatabase, check_same_thread=False)
+
+
+class ERPStandInMixin:
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        erpdatabase = os.path.join(self.folder.name, "erp.sqlite")
+        with sqlite3.connect(erpdatabase) as conn:
+            conn.execute("create table location (location_id text, description text)")
+            conn.executemany(
+                "insert into location values (?, ?)",
+                [("location %s" % i, "description %s" % i) for i in range(25)],
+            )
+            conn.execute("create table customer (customer text, type text)")
+        self.command = ERPStandIn()
+        self.command.erpdatabase = erpdatabase
+        self.command.connections = 0
+        self.command.destination = self.folder.name
+        self.command.database = DEFAULT_DB_ALIAS
+        self.command.user = None
+        self.command.direct = False
+        self.command.fk = ""
+        self.command.errors = 0
+        self.command.throughput = []
+        self.command.task = mock.Mock()
+        self.command.batchsize = 10
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+
+class ERP2freppleTest(ERPStandInMixin, SimpleTestCase):
+    def test_extract(self):
+        self.command.extracts = ["extractLocation", "extractCustomer", "extractItem"]
+        self.assertEqual(self.command.extractAll(), ["extractItem"])
+
+        # Location is complete, customer only has the 'N/A' record
+        with open(os.path.join(self.folder.name, "location.csv")) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ["name", "description", "lastmodified"])
+        self.assertEqual(len(rows), 26)
+        with open(os.path.join(self.folder.name, "customer.csv")) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(len(rows), 2)
+
+        # The job table doesn't exist: the item extract is retried and leaves no file
+        self.assertEqual(
+            sorted(os.listdir(self.folder.name)),
+            ["customer.csv", "erp.sqlite", "location.csv"],
+        )
+        self.assertTrue(self.command.connections > 1)
+        self.assertEqual(self.command.task.status, "100%")
+
+
+class ERP2freppleDirectTest(ERPStandInMixin, TransactionTestCase):
+    def test_direct(self):
+        self.command.direct = True
+        self.command.extracts = ["extractLocation", "extractCustomer"]
+        self.assertEqual(self.command.extractAll(), [])
+        self.assertEqual(self.command.errors, 0)
+        self.assertEqual(
+            Location.objects.filter(name__startswith="location ").count(), 25
+        )
+        self.assertEqual(
+            Location.objects.get(name="location 3").description, "description 3"
+        )
+        self.assertEqual(len(self.command.throughput), 2)
+        self.assertTrue(self.command.throughput[0].startswith("location: 25 rows"))
+
+        # No data files are written
+        self.assertEqual(os.listdir(self.folder.name), ["erp.sqlite"])
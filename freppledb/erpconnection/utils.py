@@ -15,6 +15,8 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from uuid import uuid4
+
 from django.db import DEFAULT_DB_ALIAS
 
 
@@ -31,8 +33,24 @@ def getERPconnection(database=DEFAULT_DB_ALIAS):
        Benefit is that end user can then easily change these.
     b) Settings in the frePPLe djangosettings file.
        For storing password and other security sensitive information this file is better.
+
+  The erp2frepple command calls this method in each of its worker threads.
   """
     import adodbapi
 
     connectionstring = "Provider=SQLNCLI11;Server=localhost;Database=acutec;User Id=acutec;Password=acutec;"
     return adodbapi.connect(connectionstring, timeout=600)
+
+
+def getERPcursor(connection):
+    """
+  Returns a cursor that doesn't load the complete result of a query in memory.
+
+  With PostgreSQL (ie the psycopg2 driver) this is a server-side cursor. Other
+  drivers return a regular cursor, and fetching the rows in batches with
+  fetchmany is the best we can do.
+  """
+    try:
+        return connection.cursor(name="erp2frepple_%s" % uuid4().hex)
+    except TypeError:
+        return connection.cursor()
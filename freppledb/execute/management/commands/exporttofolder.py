@@ -358,12 +358,10 @@ class Command(BaseCommand):
                             # Write the report file
                             datafile = open(os.path.join(exportFolder, filename), "wb")
                             if filename.endswith(".xlsx"):
-                                reportclass._generate_spreadsheet_data(
-                                    request,
-                                    [request.database],
-                                    datafile,
-                                    **cfg.get("data", {})
-                                )
+                                for r in reportclass._generate_spreadsheet_data(
+                                    request, [request.database], **cfg.get("data", {})
+                                ):
+                                    datafile.write(r)
                             elif filename.endswith(".csv"):
                                 for r in reportclass._generate_csv_data(
                                     request, [request.database], **cfg.get("data", {})
@@ -16,6 +16,7 @@
 #
 
 import codecs
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 from time import localtime, strftime
 import csv
@@ -39,7 +40,13 @@ from freppledb.common.middleware import _thread_locals
 from freppledb.common.report import GridReport, matchesModelName
 from freppledb import __version__
 from freppledb.common.dataload import parseCSVdata, parseExcelWorksheet
-from freppledb.common.models import User, NotificationFactory
+from freppledb.common.models import (
+    AuditModel,
+    HierarchyModel,
+    NotificationFactory,
+    ReportCache,
+    User,
+)
 from freppledb.common.report import EXCLUDE_FROM_BULK_OPERATIONS, create_connection
 
 logger = logging.getLogger(__name__)
@@ -67,6 +74,18 @@ class Command(BaseCommand):
             type=int,
             help="Task identifier (generated automatically if not provided)",
         )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=4,
+            help="Number of data files loaded concurrently",
+        )
+        parser.add_argument(
+            "--delete-missing",
+            action="store_true",
+            default=False,
+            help="Delete the records that are missing in the .cpy data files",
+        )
 
     def get_version(self):
         return __version__
@@ -75,6 +94,8 @@ class Command(BaseCommand):
         # Pick up the options
         now = datetime.now()
         self.database = options["database"]
+        self.threads = options["threads"]
+        self.deleteMissing = options["delete_missing"]
         if self.database not in settings.DATABASES:
             raise CommandError("No database settings known for '%s'" % self.database)
         if options["user"]:
@@ -217,63 +238,36 @@ class Command(BaseCommand):
                 # Sort the list of models, based on dependencies between models
                 models = GridReport.sort_models(models)
 
-                i = 0
+                # Files without dependency between them are loaded concurrently
                 cnt = len(models)
-                for ifile, model, contenttype_id, dependencies in models:
-                    task.status = str(int(10 + i / cnt * 80)) + "%"
-                    task.message = "Processing data file %s" % ifile
-                    task.save(using=self.database)
-                    i += 1
-                    filetoparse = os.path.join(
-                        os.path.abspath(
-                            settings.DATABASES[self.database]["FILEUPLOADFOLDER"]
-                        ),
-                        ifile,
-                    )
-                    if ifile.lower().endswith((".sql", ".sql.gz")):
-                        logger.info(
-                            "%s Started executing SQL statements from file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        errors[0] += self.executeSQLfile(filetoparse)
-                        logger.info(
-                            "%s Finished executing SQL statements from file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                    elif ifile.lower().endswith((".cpy", ".cpy.gz")):
-                        logger.info(
-                            "%s Started uploading copy file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        errors[0] += self.executeCOPYfile(model, filetoparse)
-                        logger.info(
-                            "%s Finished uploading copy file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                    elif ifile.lower().endswith(".xlsx"):
-                        logger.info(
-                            "%s Started processing data in Excel file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        returnederrors = self.loadExcelfile(model, filetoparse)
-                        errors[0] += returnederrors[0]
-                        errors[1] += returnederrors[1]
-                        logger.info(
-                            "%s Finished processing data in file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                    else:
-                        logger.info(
-                            "%s Started processing data in CSV file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
-                        )
-                        returnederrors = self.loadCSVfile(model, filetoparse)
-                        errors[0] += returnederrors[0]
-                        errors[1] += returnederrors[1]
-                        logger.info(
-                            "%s Finished processing data in CSV file: %s"
-                            % (datetime.now().replace(microsecond=0), ifile)
+                done = 0
+                running = {}
+                waiting = list(models)
+                with ThreadPoolExecutor(max_workers=max(1, self.threads)) as executor:
+                    while waiting or running:
+                        for m in list(waiting):
+                            if len(running) >= max(1, self.threads):
+                                break
+                            if any(
+                                self.conflicts(m, m2)
+                                for m2 in waiting[: waiting.index(m)]
+                                + list(running.values())
+                            ):
+                                continue
+                            waiting.remove(m)
+                            running[executor.submit(self.processFile, m[0], m[1])] = m
+                        task.status = str(int(10 + done / cnt * 80)) + "%"
+                        task.message = "Processing data file %s" % ", ".join(
+                            m[0] for m in running.values()
                         )
+                        task.save(using=self.database)
+                        finished = wait(running, return_when=FIRST_COMPLETED)
+                        for f in finished.done:
+                            del running[f]
+                            done += 1
+                            returnederrors = f.result()
+                            errors[0] += returnederrors[0]
+                            errors[1] += returnederrors[1]
             else:
                 errors[0] += 1
                 cnt = 0
@@ -289,14 +283,19 @@ class Command(BaseCommand):
                     task.message = "Destination folder does not exist"
                 else:
                     task.message = (
-                        "Uploaded %s data files with %s errors and %s warnings"
-                        % (cnt, errors[0], errors[1])
+                        "Uploaded %s data files with %s errors and %s warnings in %d seconds"
+                        % (
+                            cnt,
+                            errors[0],
+                            errors[1],
+                            (datetime.now() - now).total_seconds(),
+                        )
                     )
             else:
                 task.status = "Done"
-                task.message = "Uploaded %s data files with %s warnings" % (
-                    cnt,
-                    errors[1],
+                task.message = (
+                    "Uploaded %s data files with %s warnings in %d seconds"
+                    % (cnt, errors[1], (datetime.now() - now).total_seconds())
                 )
             task.finished = datetime.now()
 
@@ -327,13 +326,109 @@ class Command(BaseCommand):
                 "%s End of importfromfolder\n" % datetime.now().replace(microsecond=0)
             )
 
+    @staticmethod
+    def conflicts(m1, m2):
+        """
+        Returns true when two data files can't be loaded at the same time.
+        This is the case for files of the same model, files of models that
+        depend on each other, and SQL files that can touch any table.
+        """
+        if m1[0].lower().endswith((".sql", ".sql.gz")) or m2[0].lower().endswith(
+            (".sql", ".sql.gz")
+        ):
+            return True
+        return (
+            m1[1] == m2[1]
+            or m1[1] in m2[3]
+            or m2[1] in m1[3]
+            or issubclass(m1[1], m2[1])
+            or issubclass(m2[1], m1[1])
+        )
+
+    def processFile(self, ifile, model):
+        """
+        Loads a single data file, and returns the number of errors and warnings.
+        This method runs in a worker thread with its own database connection.
+        """
+        setattr(_thread_locals, "database", self.database)
+        start = datetime.now()
+        filetoparse = os.path.join(
+            os.path.abspath(settings.DATABASES[self.database]["FILEUPLOADFOLDER"]),
+            ifile,
+        )
+        returnederrors = [0, 0]
+        try:
+            if ifile.lower().endswith((".sql", ".sql.gz")):
+                logger.info(
+                    "%s Started executing SQL statements from file: %s"
+                    % (datetime.now().replace(microsecond=0), ifile)
+                )
+                returnederrors[0] += self.executeSQLfile(filetoparse)
+                logger.info(
+                    "%s Finished executing SQL statements from file: %s"
+                    % (datetime.now().replace(microsecond=0), ifile)
+                )
+            elif ifile.lower().endswith((".cpy", ".cpy.gz")):
+                logger.info(
+                    "%s Started uploading copy file: %s"
+                    % (datetime.now().replace(microsecond=0), ifile)
+                )
+                returnederrors[0] += self.executeCOPYfile(model, filetoparse)
+                logger.info(
+                    "%s Finished uploading copy file: %s"
+                    % (datetime.now().replace(microsecond=0), ifile)
+                )
+            elif ifile.lower().endswith(".xlsx"):
+                logger.info(
+                    "%s Started processing data in Excel file: %s"
+                    % (datetime.now().replace(microsecond=0), ifile)
+                )
+                returnederrors = self.loadExcelfile(model, filetoparse)
+                logger.info(
+                    "%s Finished processing data in file: %s"
+                    % (datetime.now().replace(microsecond=0), ifile)
+                )
+            else:
+                logger.info(
+                    "%s Started processing data in CSV file: %s"
+                    % (datetime.now().replace(microsecond=0), ifile)
+                )
+                returnederrors = self.loadCSVfile(model, filetoparse)
+                logger.info(
+                    "%s Finished processing data in CSV file: %s"
+                    % (datetime.now().replace(microsecond=0), ifile)
+                )
+            duration = (datetime.now() - start).total_seconds()
+            logger.info(
+                "%s Processed %.1f MB of file %s in %.1f seconds: %.2f MB/s"
+                % (
+                    datetime.now().replace(microsecond=0),
+                    os.path.getsize(filetoparse) / 1048576,
+                    ifile,
+                    duration,
+                    os.path.getsize(filetoparse) / 1048576 / max(duration, 0.001),
+                )
+            )
+            return returnederrors
+        finally:
+            setattr(_thread_locals, "database", None)
+            connections.close_all()
+
     def executeCOPYfile(self, model, ifile):
         """
         Use the copy command to upload data into the database
         The filename must be equal to the table name (E.g : demand, buffer, forecast...)
         The first line of the file must contain the columns to popualate, comma separated
+
+        The data is copied into a temporary staging table first, which is then
+        merged into the target table with a single statement:
+          - records with an existing primary key, or natural key, are updated
+          - other records are inserted
+          - with the --delete-missing option, the records that aren't in the
+            file are deleted, except for the records other records refer to
         """
-        cursor = connections[self.database].cursor()
+        connection = connections[self.database]
+        quote = connection.ops.quote_name
         try:
 
             if ifile.lower().endswith(".gz"):
@@ -348,51 +443,208 @@ class Command(BaseCommand):
             f.close()
 
             # Validate the data fields in the header
-            headers = []
+            fields = []
             for f in firstLine.split(","):
                 col = f.strip().strip("#").strip('"').lower() if f else ""
                 dbfield = None
                 for i in model._meta.fields:
                     # Try with database field name
                     if col == i.get_attname():
-                        dbfield = i.get_attname()
+                        dbfield = i
                         break
                     # Try with translated field names
                     elif col == i.name.lower() or col == i.verbose_name.lower():
-                        dbfield = i.get_attname()
+                        dbfield = i
                         break
                     if translation.get_language() != "en":
                         # Try with English field names
                         with translation.override("en"):
                             if col == i.name.lower() or col == i.verbose_name.lower():
-                                dbfield = i.get_attname()
+                                dbfield = i
                                 break
                 if dbfield:
-                    headers.append('"%s"' % dbfield)
+                    fields.append(dbfield)
                 else:
                     raise Exception("Invalid field name '%s'" % col)
+            headers = [quote(f.column) for f in fields]
+
+            # Records are matched on the primary key or the natural key
+            if model._meta.pk in fields:
+                key = [model._meta.pk]
+            elif model._meta.unique_together and all(
+                model._meta.get_field(i) in fields
+                for i in model._meta.unique_together[0]
+            ):
+                key = [model._meta.get_field(i) for i in model._meta.unique_together[0]]
+            else:
+                key = None
 
-            # count how many records in table before the copy operation
-            cursor.execute("select count(*) from %s" % tableName)
-            countBefore = cursor.fetchone()[0]
+            with transaction.atomic(using=self.database):
+                cursor = connection.cursor()
 
-            # Load the data records
-            copyFile = file_open(ifile)
-            cursor.copy_expert(
-                "copy %s (%s) from STDIN with delimiter ',' csv header"
-                % (tableName, ",".join(headers)),
-                copyFile,
-            )
+                # Load the data records in the staging table
+                cursor.execute(
+                    "create temporary table tmp_copy on commit drop as "
+                    "select %s from %s with no data"
+                    % (",".join(headers), quote(tableName))
+                )
+                cursor.execute("alter table tmp_copy add column rownumber serial")
+                copyFile = file_open(ifile)
+                cursor.copy_expert(
+                    "copy tmp_copy (%s) from STDIN with delimiter ',' csv header"
+                    % ",".join(headers),
+                    copyFile,
+                )
+
+                # When a key appears multiple times in the file, the last row wins
+                if key:
+                    cursor.execute(
+                        """
+                        delete from tmp_copy
+                        using tmp_copy as later
+                        where %s and later.rownumber > tmp_copy.rownumber
+                        """
+                        % " and ".join(
+                            "later.%s = tmp_copy.%s" % ((quote(f.column),) * 2)
+                            for f in key
+                        )
+                    )
+
+                # Merge into the target table
+                columns = list(headers)
+                values = ["tmp_copy.%s" % i for i in headers]
+                stamp = issubclass(model, AuditModel) and not any(
+                    f.name == "lastmodified" for f in fields
+                )
+                if stamp:
+                    columns.append("lastmodified")
+                    values.append("now()")
+                update = [f for f in fields if f not in key] if key else []
+                if not key:
+                    conflict = ""
+                elif update:
+                    assignments = [
+                        "%s = excluded.%s" % ((quote(f.column),) * 2) for f in update
+                    ]
+                    if stamp:
+                        assignments.append("lastmodified = excluded.lastmodified")
+                    if issubclass(model, HierarchyModel) and any(
+                        f.name == "owner" for f in update
+                    ):
+                        # Trigger a rebuild of the hierarchy only when it changes
+                        assignments.extend(
+                            "%s = case when target.owner_id is distinct from "
+                            "excluded.owner_id then null else target.%s end" % (f, f)
+                            for f in ("lft", "rght", "lvl")
+                        )
+                    conflict = "on conflict (%s) do update set %s" % (
+                        ", ".join(quote(f.column) for f in key),
+                        ", ".join(assignments),
+                    )
+                else:
+                    conflict = "on conflict (%s) do nothing" % ", ".join(
+                        quote(f.column) for f in key
+                    )
+                cursor.execute(
+                    """
+                    with merged as (
+                      insert into %s as target (%s)
+                      select %s from tmp_copy
+                      order by rownumber
+                      %s
+                      returning (target.xmax = 0) as added
+                      )
+                    select
+                      count(*) filter (where added),
+                      count(*) filter (where not added)
+                    from merged
+                    """
+                    % (
+                        quote(tableName),
+                        ",".join(columns),
+                        ",".join(values),
+                        conflict,
+                    )
+                )
+                added, changed = cursor.fetchone()
+
+                # Delete the records that are not in the file
+                deleted = 0
+                if self.deleteMissing:
+                    if key:
+                        match = " and ".join(
+                            "tmp_copy.%s = target.%s" % ((quote(f.column),) * 2)
+                            for f in key
+                        )
+                        # The statement bypasses the on_delete rules of the
+                        # models, so records that are referenced are kept
+                        referenced = [
+                            "exists (select 1 from %s where %s = target.%s)"
+                            % (
+                                quote(rel.related_model._meta.db_table),
+                                quote(rel.field.column),
+                                quote(rel.field.target_field.column),
+                            )
+                            for rel in model._meta.related_objects
+                            if not rel.many_to_many
+                            and rel.related_model._meta.managed
+                            and not rel.related_model._meta.proxy
+                        ]
+                        cursor.execute(
+                            """
+                            with deleted as (
+                              delete from %s as target
+                              where not exists (
+                                select 1 from tmp_copy where %s
+                                )
+                              %s
+                              returning 1
+                              )
+                            select count(*) from deleted
+                            """
+                            % (
+                                quote(tableName),
+                                match,
+                                "".join("and not %s " % i for i in referenced),
+                            )
+                        )
+                        deleted = cursor.fetchone()[0]
+                        if referenced:
+                            cursor.execute("""
+                                select count(*) from %s as target
+                                where not exists (
+                                  select 1 from tmp_copy where %s
+                                  )
+                                """ % (quote(tableName), match))
+                            kept = cursor.fetchone()[0]
+                            if kept:
+                                logger.warning(
+                                    "%s Kept %s records missing in the file in "
+                                    "table %s, because other records refer to them"
+                                    % (
+                                        datetime.now().replace(microsecond=0),
+                                        kept,
+                                        tableName,
+                                    )
+                                )
+                    else:
+                        logger.warning(
+                            "%s Can't delete missing records from table %s without "
+                            "a primary key or natural key in the file"
+                            % (datetime.now().replace(microsecond=0), tableName)
+                        )
 
-            # count how many records in table after the copy operation
-            cursor.execute("select count(*) from %s" % tableName)
-            countAfter = cursor.fetchone()[0]
+            if added or changed or deleted:
+                # The bulk statements bypass the signals of the models
+                ReportCache.invalidate(self.database)
 
             logger.info(
-                "%s %s records uploaded into table %s"
+                "%s %s records inserted, %s updated and %s deleted in table %s"
                 % (
                     datetime.now().replace(microsecond=0),
-                    (countAfter - countBefore),
+                    added,
+                    changed,
+                    deleted,
                     tableName,
                 )
             )
@@ -496,7 +748,7 @@ class Command(BaseCommand):
         warningcount = 0
         try:
             with transaction.atomic(using=self.database):
-                wb = load_workbook(filename=file, data_only=True)
+                wb = load_workbook(filename=file, read_only=True, data_only=True)
                 for ws_name in wb.sheetnames:
                     ws = wb[ws_name]
                     for error in parseExcelWorksheet(
@@ -537,6 +789,7 @@ class Command(BaseCommand):
                                     error[4],
                                 )
                             )
+                wb.close()
             # Records are committed. Launch notification generator now.
             NotificationFactory.launchWorker(database=self.database, url=None)
         except Exception:
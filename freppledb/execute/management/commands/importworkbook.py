@@ -135,7 +135,9 @@ class Command(BaseCommand):
                     if "filename" not in locals():
                         filename = options["file"]
                     for file in filename:
-                        wb = load_workbook(filename=file, data_only=True)
+                        wb = load_workbook(
+                            filename=file, read_only=True, data_only=True
+                        )
                         models = []
                         for ws_name in wb.sheetnames:
                             # Find the model
@@ -280,6 +282,7 @@ class Command(BaseCommand):
                             #       error[4]
                             #       )
                             # yield '</tbody></table></div>'
+                        wb.close()
                         print("%s" % _("Done"))
                         # yield '<div><strong>%s</strong></div>' % _("Done")
             except GeneratorExit:
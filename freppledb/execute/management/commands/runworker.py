@@ -32,7 +32,8 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import DEFAULT_DB_ALIAS, connections
 
 from freppledb import __version__, runCommand
-from freppledb.common.models import Parameter
+from freppledb.common.dashboard import Dashboard
+from freppledb.common.models import Parameter, ReportCache
 from freppledb.common.middleware import _thread_locals
 from freppledb.execute.models import Task
 
@@ -113,6 +114,15 @@ def launchWorker(database=DEFAULT_DB_ALIAS):
             Popen(["frepplectl", "runworker", "--database=%s" % database])
 
 
+def refreshDashboard(database=DEFAULT_DB_ALIAS):
+    try:
+        Dashboard.refreshCache(database)
+    except Exception as e:
+        logger.warning("Can't refresh the dashboard widgets: %s" % e)
+    finally:
+        connections[database].close()
+
+
 def runTask(task, database):
     task.started = datetime.now()
     # Verify the command exists
@@ -176,6 +186,21 @@ def runTask(task, database):
                 if task.status not in ("Done", "Failed"):
                     task.status = "Done"
             task.save(using=database)
+
+        # Tasks can change the data with SQL statements that bypass the
+        # invalidation of the report cache.
+        ReportCache.invalidate(database)
+
+        # Render the dashboard widgets with the new data in the background,
+        # unless more tasks are waiting to change it again.
+        if (
+            "FREPPLE_TEST" not in os.environ
+            and not Task.objects.all()
+            .using(database)
+            .filter(status="Waiting")
+            .exists()
+        ):
+            Thread(target=refreshDashboard, args=(database,)).start()
         if "FREPPLE_TEST" not in os.environ:
             logger.info(
                 "Worker %s for database '%s' finished task %d at %s: success"
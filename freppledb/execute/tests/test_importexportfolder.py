@@ -18,13 +18,23 @@
 import os
 from shutil import rmtree
 import tempfile
+from time import sleep, time
+from unittest import mock
 
 from django.conf import settings
 from django.core import management
 from django.db import DEFAULT_DB_ALIAS
 from django.test import TransactionTestCase
 
-from freppledb.input.models import ManufacturingOrder, PurchaseOrder, DistributionOrder
+from freppledb.execute.management.commands.importfromfolder import Command
+from freppledb.input.models import (
+    Customer,
+    Demand,
+    Item,
+    ManufacturingOrder,
+    PurchaseOrder,
+    DistributionOrder,
+)
 from freppledb.common.models import Notification
 
 
@@ -83,3 +93,84 @@ class execute_with_commands(TransactionTestCase):
         self.assertEqual(DistributionOrder.objects.count(), countDO)
         self.assertEqual(PurchaseOrder.objects.count(), countPO)
         self.assertEqual(ManufacturingOrder.objects.count(), countMO)
+
+    def test_importfromfolder_order(self):
+        # Files are loaded after the files of the models they depend on, and
+        # independent files are loaded concurrently
+        for name in ("customer.csv", "item.csv", "location.csv", "demand.csv"):
+            with open(os.path.join(self.datafolder, name), "w") as f:
+                f.write("name\n")
+        loaded = {}
+        processFile = Command.processFile
+
+        def timeFile(command, ifile, model):
+            start = time()
+            sleep(0.5)
+            try:
+                return processFile(command, ifile, model)
+            finally:
+                loaded[ifile] = (start, time())
+
+        with mock.patch.object(Command, "processFile", timeFile):
+            management.call_command("importfromfolder", threads=4)
+        self.assertEqual(len(loaded), 4)
+        for name in ("customer.csv", "item.csv", "location.csv"):
+            self.assertLessEqual(loaded[name][1], loaded["demand.csv"][0])
+        self.assertLess(
+            max(loaded[i][0] for i in ("customer.csv", "item.csv", "location.csv")),
+            min(loaded[i][1] for i in ("customer.csv", "item.csv", "location.csv")),
+        )
+        self.assertTrue(
+            Command.conflicts(
+                ("demand.csv", Demand, None, {Demand, Customer}),
+                ("customer.csv", Customer, None, {Customer}),
+            )
+        )
+        self.assertFalse(
+            Command.conflicts(
+                ("item.csv", Item, None, {Item}),
+                ("customer.csv", Customer, None, {Customer}),
+            )
+        )
+        self.assertTrue(
+            Command.conflicts(
+                ("script.sql", None, None, set()),
+                ("customer.csv", Customer, None, {Customer}),
+            )
+        )
+
+    def test_importcopyfile(self):
+        count = Customer.objects.count()
+        with open(os.path.join(self.datafolder, "customer.cpy"), "w") as f:
+            f.write("name,category\n")
+            f.write("Customer near factory 1,first\n")
+            f.write("new customer,new\n")
+            f.write("Customer near factory 1,updated\n")
+        management.call_command("importfromfolder")
+        self.assertEqual(Customer.objects.count(), count + 1)
+        self.assertEqual(
+            Customer.objects.get(name="Customer near factory 1").category, "updated"
+        )
+        self.assertEqual(Customer.objects.get(name="new customer").category, "new")
+
+        # Delete the customers that are not in the file
+        with open(os.path.join(self.datafolder, "customer.cpy"), "w") as f:
+            f.write("name\n")
+            for c in Customer.objects.exclude(name="new customer"):
+                f.write('"%s"\n' % c.name)
+        management.call_command("importfromfolder", delete_missing=True)
+        self.assertEqual(Customer.objects.count(), count)
+        self.assertFalse(Customer.objects.filter(name="new customer").exists())
+        self.assertEqual(
+            Customer.objects.get(name="Customer near factory 1").category, "updated"
+        )
+
+        # Customers with demands are kept
+        customer = Demand.objects.filter(customer__isnull=False)[0].customer
+        with open(os.path.join(self.datafolder, "customer.cpy"), "w") as f:
+            f.write("name\n")
+            for c in Customer.objects.exclude(name=customer.name):
+                f.write('"%s"\n' % c.name)
+        management.call_command("importfromfolder", delete_missing=True)
+        self.assertEqual(Customer.objects.count(), count)
+        self.assertTrue(Customer.objects.filter(name=customer.name).exists())
@@ -23,6 +23,7 @@ import unittest
 
 from django.conf import settings
 from django.core import management
+from django.core.cache import cache
 from django.db import DEFAULT_DB_ALIAS, transaction
 from django.db.models import Sum, Count, Q
 from django.test import TransactionTestCase
@@ -97,6 +98,37 @@ class execute_with_commands(TransactionTestCase):
                     count += 1
         self.assertGreaterEqual(count, 8)
 
+    def test_delta_export(self):
+        def getPlan():
+            return (
+                input.models.OperationPlan.objects.filter(status="proposed").count(),
+                input.models.OperationPlanMaterial.objects.count(),
+                input.models.OperationPlanResource.objects.count(),
+            )
+
+        Parameter.objects.update_or_create(
+            name="plan.export_delta", defaults={"value": "true"}
+        )
+        management.call_command("runplan", plantype=1, constraint=15, env="supply")
+        initial = getPlan()
+
+        # Replan with less demand: the obsolete proposed operationplans have
+        # material and resource records that need to be deleted as well
+        demands = input.models.Demand.objects.order_by("pk").values_list(
+            "pk", flat=True
+        )
+        input.models.Demand.objects.filter(pk__in=list(demands)[::2]).update(
+            status="closed"
+        )
+        management.call_command("runplan", plantype=1, constraint=15, env="supply")
+        delta = getPlan()
+        self.assertLess(delta[0], initial[0])
+
+        # The delta export gives the same result as a complete export
+        Parameter.objects.filter(name="plan.export_delta").update(value="false")
+        management.call_command("runplan", plantype=1, constraint=15, env="supply")
+        self.assertEqual(delta, getPlan())
+
 
 class execute_multidb(TransactionTestCase):
 
@@ -267,6 +299,8 @@ class remote_commands(TransactionTestCase):
     def tearDown(self):
         Notification.wait()
         del os.environ["FREPPLE_TEST"]
+        # The scenario status cached by this test is no longer valid
+        cache.clear()
         super().tearDown()
 
     def test_remote_command(self):
@@ -331,7 +365,9 @@ class remote_commands(TransactionTestCase):
                 cnt += 1
             self.assertLess(cnt, 20, "Running task taking too long")
 
-            # Refresh the client to see the new scenario
+            # Refresh the client to see the new scenario.
+            # The worker process can't empty the cache of this process.
+            cache.clear()
             self.client = self.client_class()
 
             # Generate a plan in the scenario
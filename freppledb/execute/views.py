@@ -1149,107 +1149,111 @@ def importWorkbook(request):
             ):
                 yield _("Unsupported file format.")
                 continue
-            wb = load_workbook(filename=file, data_only=True)
-            models = []
-            for ws_name in wb.sheetnames:
-                # Find the model
-                model = None
-                contenttype_id = None
-                for m, ct in all_models:
-                    if matchesModelName(ws_name, m):
-                        model = m
-                        contenttype_id = ct
-                        break
-                if not model or model in EXCLUDE_FROM_BULK_OPERATIONS:
-                    yield '<div class="alert alert-warning">' + force_text(
-                        _("Ignoring data in worksheet: %s") % ws_name
-                    ) + "</div>"
-                elif not request.user.has_perm(
-                    "%s.%s"
-                    % (
-                        model._meta.app_label,
-                        get_permission_codename("add", model._meta),
-                    )
-                ):
-                    # Check permissions
-                    yield '<div class="alert alert-danger">' + force_text(
-                        _("You don't permissions to add: %s") % ws_name
-                    ) + "</div>"
-                else:
-                    deps = set([model])
-                    GridReport.dependent_models(model, deps)
-                    models.append((ws_name, model, contenttype_id, deps))
+            wb = load_workbook(filename=file, read_only=True, data_only=True)
+            try:
+                models = []
+                for ws_name in wb.sheetnames:
+                    # Find the model
+                    model = None
+                    contenttype_id = None
+                    for m, ct in all_models:
+                        if matchesModelName(ws_name, m):
+                            model = m
+                            contenttype_id = ct
+                            break
+                    if not model or model in EXCLUDE_FROM_BULK_OPERATIONS:
+                        yield '<div class="alert alert-warning">' + force_text(
+                            _("Ignoring data in worksheet: %s") % ws_name
+                        ) + "</div>"
+                    elif not request.user.has_perm(
+                        "%s.%s"
+                        % (
+                            model._meta.app_label,
+                            get_permission_codename("add", model._meta),
+                        )
+                    ):
+                        # Check permissions
+                        yield '<div class="alert alert-danger">' + force_text(
+                            _("You don't permissions to add: %s") % ws_name
+                        ) + "</div>"
+                    else:
+                        deps = set([model])
+                        GridReport.dependent_models(model, deps)
+                        models.append((ws_name, model, contenttype_id, deps))
 
-            # Sort the list of models, based on dependencies between models
-            models = GridReport.sort_models(models)
+                # Sort the list of models, based on dependencies between models
+                models = GridReport.sort_models(models)
 
-            # Process all rows in each worksheet
-            yield (
-                '<div class="table-responsive">'
-                '<table class="table table-condensed" style="white-space: nowrap;"><tbody>'
-            )
-            for ws_name, model, contenttype_id, dependencies in models:
-                with transaction.atomic(using=request.database):
-                    yield '<tr style="text-align: center"><th colspan="5">%s %s<div class="recordcount pull-right"></div></th></tr>' % (
-                        capfirst(_("worksheet")),
-                        ws_name,
-                    )
-                    numerrors = 0
-                    numwarnings = 0
-                    firsterror = True
-                    ws = wb[ws_name]
-                    for error in parseExcelWorksheet(
-                        model,
-                        ws,
-                        user=request.user,
-                        database=request.database,
-                        ping=True,
-                    ):
-                        if error[0] == logging.DEBUG:
-                            # Yield some result so we can detect disconnect clients and interrupt the upload
-                            yield "<tr class='hidden' data-cnt='%s'>" % error[1]
-                            continue
-                        if firsterror and error[0] in (logging.ERROR, logging.WARNING):
-                            yield '<tr><th class="sr-only">%s</th><th>%s</th><th>%s</th><th>%s</th><th>%s%s%s</th></tr>' % (
-                                capfirst(_("worksheet")),
-                                capfirst(_("row")),
-                                capfirst(_("field")),
-                                capfirst(_("value")),
-                                capfirst(_("error")),
-                                " / ",
-                                capfirst(_("warning")),
-                            )
-                            firsterror = False
-                        if error[0] == logging.ERROR:
-                            yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
-                                ws_name,
-                                error[1] if error[1] else "",
-                                error[2] if error[2] else "",
-                                error[3] if error[3] else "",
-                                capfirst(_("error")),
-                                error[4],
-                            )
-                            numerrors += 1
-                        elif error[1] == logging.WARNING:
-                            yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
-                                ws_name,
-                                error[1] if error[1] else "",
-                                error[2] if error[2] else "",
-                                error[3] if error[3] else "",
-                                capfirst(_("warning")),
-                                error[4],
-                            )
-                            numwarnings += 1
-                        else:
-                            yield '<tr class=%s><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
-                                "danger" if numerrors > 0 else "success",
-                                ws_name,
-                                error[1] if error[1] else "",
-                                error[2] if error[2] else "",
-                                error[3] if error[3] else "",
-                                error[4],
-                            )
-            yield "</tbody></table></div>"
+                # Process all rows in each worksheet
+                yield (
+                    '<div class="table-responsive">'
+                    '<table class="table table-condensed" style="white-space: nowrap;"><tbody>'
+                )
+                for ws_name, model, contenttype_id, dependencies in models:
+                    with transaction.atomic(using=request.database):
+                        yield '<tr style="text-align: center"><th colspan="5">%s %s<div class="recordcount pull-right"></div></th></tr>' % (
+                            capfirst(_("worksheet")),
+                            ws_name,
+                        )
+                        numerrors = 0
+                        numwarnings = 0
+                        firsterror = True
+                        ws = wb[ws_name]
+                        for error in parseExcelWorksheet(
+                            model,
+                            ws,
+                            user=request.user,
+                            database=request.database,
+                            ping=True,
+                        ):
+                            if error[0] == logging.DEBUG:
+                                # Yield some result so we can detect disconnect clients and interrupt the upload
+                                yield "<tr class='hidden' data-cnt='%s'>" % error[1]
+                                continue
+                            if firsterror and error[0] in (logging.ERROR, logging.WARNING):
+                                yield '<tr><th class="sr-only">%s</th><th>%s</th><th>%s</th><th>%s</th><th>%s%s%s</th></tr>' % (
+                                    capfirst(_("worksheet")),
+                                    capfirst(_("row")),
+                                    capfirst(_("field")),
+                                    capfirst(_("value")),
+                                    capfirst(_("error")),
+                                    " / ",
+                                    capfirst(_("warning")),
+                                )
+                                firsterror = False
+                            if error[0] == logging.ERROR:
+                                yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
+                                    ws_name,
+                                    error[1] if error[1] else "",
+                                    error[2] if error[2] else "",
+                                    error[3] if error[3] else "",
+                                    capfirst(_("error")),
+                                    error[4],
+                                )
+                                numerrors += 1
+                            elif error[1] == logging.WARNING:
+                                yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
+                                    ws_name,
+                                    error[1] if error[1] else "",
+                                    error[2] if error[2] else "",
+                                    error[3] if error[3] else "",
+                                    capfirst(_("warning")),
+                                    error[4],
+                                )
+                                numwarnings += 1
+                            else:
+                                yield '<tr class=%s><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+                                    "danger" if numerrors > 0 else "success",
+                                    ws_name,
+                                    error[1] if error[1] else "",
+                                    error[2] if error[2] else "",
+                                    error[3] if error[3] else "",
+                                    error[4],
+                                )
+                yield "</tbody></table></div>"
+            finally:
+                # A read-only workbook keeps the file open
+                wb.close()
             yield "<div><strong>%s</strong><br><br></div>" % _("Done")
     except GeneratorExit:
         logger.warning("Connection Aborted")
@@ -0,0 +1,92 @@
+#
+# Copyright (C) 2021 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import migrations, transaction
+
+# Models searched by the global search box
+searchModels = (
+    "calendar",
+    "customer",
+    "demand",
+    "item",
+    "location",
+    "operation",
+    "operationplan",
+    "resource",
+    "setupmatrix",
+    "skill",
+    "supplier",
+)
+
+
+def searchFields(apps):
+    for name in searchModels:
+        model = apps.get_model("input", name)
+        yield model, model._meta.pk
+        try:
+            yield model, model._meta.get_field("description")
+        except FieldDoesNotExist:
+            pass
+
+
+def createSearchIndexes(apps, schema_editor):
+    """
+    Trigram indexes on the expressions used by the case insensitive contains
+    and startswith lookups of the global search. PostgreSQL keeps them up to
+    date, also for data loaded with copy statements.
+    Without the pg_trgm extension the search keeps working, without indexes.
+    """
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        try:
+            with transaction.atomic(using=connection.alias):
+                cursor.execute("create extension if not exists pg_trgm")
+        except Exception as e:
+            print("\nSkipping the search indexes: %s" % e)
+            return
+        for model, field in searchFields(apps):
+            cursor.execute(
+                "create index if not exists %s on %s "
+                "using gin (upper(%s::text) gin_trgm_ops)"
+                % (
+                    connection.ops.quote_name(
+                        "%s_%s_search" % (model._meta.db_table, field.column)
+                    ),
+                    connection.ops.quote_name(model._meta.db_table),
+                    connection.ops.quote_name(field.column),
+                )
+            )
+
+
+def dropSearchIndexes(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        for model, field in searchFields(apps):
+            cursor.execute(
+                "drop index if exists %s"
+                % connection.ops.quote_name(
+                    "%s_%s_search" % (model._meta.db_table, field.column)
+                )
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("input", "0053_operationplan_quantitycompleted")]
+
+    operations = [migrations.RunPython(createSearchIndexes, dropSearchIndexes)]
@@ -16,12 +16,14 @@
 #
 
 import ast
+from contextlib import contextmanager
 from datetime import datetime, time
 from decimal import Decimal
 from dateutil.parser import parse
+from threading import local
 
 from django.core.cache import cache
-from django.db import models, DEFAULT_DB_ALIAS
+from django.db import models, connections, DEFAULT_DB_ALIAS
 from django.db.models.fields.related import RelatedField
 from django.forms.models import modelform_factory
 from django import forms
@@ -1718,31 +1720,48 @@ class OperationPlan(AuditModel):
     def __str__(self):
         return str(self.reference)
 
-    def propagateStatus(self):
-        if self.type == "STCK":
-            return
-        state = getattr(self, "_state", None)
-        db = state.db if state else DEFAULT_DB_ALIAS
+    # Operationplans saved in a bulkUpdate block, per thread and database
+    _deferred = local()
 
+    @staticmethod
+    def completedAllowFuture(database=DEFAULT_DB_ALIAS):
         # Get the parameter that controls whether completed operations are
         # allowed to have dates in the future
-        completed_allow_future = cache.get("completed_allow_future_%s" % db, None)
+        completed_allow_future = cache.get(
+            "completed_allow_future_%s" % database, None
+        )
         if completed_allow_future is None:
             completed_allow_future = (
-                Parameter.getValue("COMPLETED.allow_future", db, "false").lower()
+                Parameter.getValue(
+                    "COMPLETED.allow_future", database, "false"
+                ).lower()
                 == "true"
             )
             cache.set(
-                "completed_allow_future_%s" % db, completed_allow_future, timeout=60
+                "completed_allow_future_%s" % database,
+                completed_allow_future,
+                timeout=60,
             )
+        return completed_allow_future
+
+    def propagateStatus(self, alignChildren=True):
+        if self.type == "STCK":
+            return
+        state = getattr(self, "_state", None)
+        db = state.db if state else DEFAULT_DB_ALIAS
+
+        completed_allow_future = self.completedAllowFuture(db)
+
+        # Operationplans that get a new status also save their corrected dates
+        statusfields = ["status", "startdate", "enddate"]
 
         # Assure that all child operationplans also get the same status
         now = datetime.now()
-        if self.type not in ("DO", "PO"):
+        if alignChildren and self.type not in ("DO", "PO"):
             for subop in self.xchildren.all().using(db):
                 if subop.status != self.status:
                     subop.status = self.status
-                    subop.save(update_fields=["status"])
+                    subop.save(update_fields=statusfields)
 
         if self.status not in ("completed", "closed"):
             return
@@ -1786,7 +1805,8 @@ class OperationPlan(AuditModel):
                             subop.startdate = now
                     subop.save(update_fields=["status", "startdate", "enddate"])
 
-            # Assure that the parent is at least approved
+            # Assure that the parent is at least approved.
+            # The routing doesn't pass its new status on to its steps.
             if len(steps) == len(subopplans):
                 all_steps_completed = all_steps_closed = True
             else:
@@ -1804,9 +1824,7 @@ class OperationPlan(AuditModel):
                         self.owner.enddate = now
                     if self.owner.startdate > now:
                         self.owner.startdate = now
-                self.owner.save(
-                    update_fields=["status", "startdate", "enddate"], using=db
-                )
+                self.owner.saveStatusOfChildren(statusfields, db)
             elif all_steps_completed and self.owner.status != "completed":
                 self.owner.status = "completed"
                 if not completed_allow_future:
@@ -1814,14 +1832,12 @@ class OperationPlan(AuditModel):
                         self.owner.enddate = now
                     if self.owner.startdate > now:
                         self.owner.startdate = now
-                self.owner.save(
-                    update_fields=["status", "startdate", "enddate"], using=db
-                )
+                self.owner.saveStatusOfChildren(statusfields, db)
             elif self.owner.status == "proposed":
                 self.owner.status = "approved"
                 if not completed_allow_future and self.owner.startdate > now:
                     self.owner.startdate = now
-                self.owner.save(update_fields=["status", "startdate"], using=db)
+                self.owner.saveStatusOfChildren(["status", "startdate"], db)
 
         # Remove all capacity consumption of closed and completed
         self.resources.all().using(db).delete()
@@ -1864,7 +1880,7 @@ class OperationPlan(AuditModel):
                             and f.operationplan.type != "STCK"
                         ):
                             f.operationplan.status = self.status
-                            f.operationplan.save(update_fields=["status"])
+                            f.operationplan.save(update_fields=statusfields)
                             closed_balance += f.quantity
                             if closed_balance >= 0:
                                 break
@@ -1873,7 +1889,7 @@ class OperationPlan(AuditModel):
                         for f in flplns:
                             if f.quantity > 0 and f.operationplan.status == "approved":
                                 f.operationplan.status = self.status
-                                f.operationplan.save(update_fields=["status"])
+                                f.operationplan.save(update_fields=statusfields)
                                 closed_balance += f.quantity
                                 if closed_balance >= 0:
                                     break
@@ -1885,16 +1901,323 @@ class OperationPlan(AuditModel):
                                     and f.operationplan.status == "proposed"
                                 ):
                                     f.operationplan.status = self.status
-                                    f.operationplan.save(update_fields=["status"])
+                                    f.operationplan.save(update_fields=statusfields)
                                     closed_balance += f.quantity
                                     if closed_balance >= 0:
                                         break
 
+    @classmethod
+    def propagateStatusBulk(cls, references, database=DEFAULT_DB_ALIAS):
+        """
+        Set-based version of the propagateStatus method for a set of
+        operationplans that are already saved with their new status.
+        Instead of recursively saving every affected operationplan, each step
+        is a single SQL statement. The steps are repeated for the operationplans
+        that got a new status, until nothing changes any more.
+        """
+        completed_allow_future = cls.completedAllowFuture(database)
+        now = datetime.now()
+        # Operationplans to process, and whether to align their children
+        todo = {ref: True for ref in references}
+        done = {}
+        with connections[database].cursor() as cursor:
+            while todo:
+                # Assure that all child operationplans also get the same status
+                cursor.execute(
+                    """
+                    with recursive children (reference, type, status) as (
+                      select reference, type, status
+                      from operationplan
+                      where reference = any(%s) and type not in ('STCK', 'DO', 'PO')
+                      union all
+                      select child.reference, child.type, children.status
+                      from operationplan child
+                      inner join children
+                        on child.owner_id = children.reference
+                        and children.type not in ('DO', 'PO')
+                    )
+                    update operationplan
+                    set status = children.status
+                    from children
+                    where operationplan.reference = children.reference
+                      and operationplan.status is distinct from children.status
+                    returning operationplan.reference
+                    """,
+                    ([ref for ref, align in todo.items() if align],),
+                )
+                for rec in cursor.fetchall():
+                    todo[rec[0]] = False
+                for ref in todo:
+                    done[ref] = None
+
+                # Pick the operationplans that are completed or closed
+                cursor.execute(
+                    """
+                    select reference, status
+                    from operationplan
+                    where reference = any(%s)
+                      and type != 'STCK'
+                      and status in ('completed', 'closed')
+                    """,
+                    (list(todo.keys()),),
+                )
+                closing = []
+                for ref, status in cursor.fetchall():
+                    closing.append(ref)
+                    done[ref] = status
+                todo = {}
+                if not closing:
+                    break
+
+                # Assure the start and end are in the past
+                if not completed_allow_future:
+                    cursor.execute(
+                        """
+                        update operationplan
+                        set startdate = least(startdate, %s),
+                          enddate = least(enddate, %s)
+                        where reference = any(%s)
+                          and (startdate > %s or enddate > %s)
+                        """,
+                        (now, now, closing, now, now),
+                    )
+
+                # Assure that previous routing steps get the same status
+                cursor.execute(
+                    """
+                    update operationplan
+                    set status = op.status,
+                      startdate = case when %s then operationplan.startdate
+                        else least(operationplan.startdate, %s) end,
+                      enddate = case when %s then operationplan.enddate
+                        else least(operationplan.enddate, %s) end
+                    from operationplan op
+                    inner join operationplan parent
+                      on parent.reference = op.owner_id
+                    inner join operation parentop
+                      on parentop.name = parent.operation_id
+                      and parentop.type = 'routing'
+                    where op.reference = any(%s)
+                      and op.type = 'MO'
+                      and operationplan.owner_id = op.owner_id
+                      and operationplan.status is distinct from op.status
+                      and coalesce((
+                        select priority from operation
+                        where name = operationplan.operation_id
+                          and owner_id = parentop.name
+                        ), 0) < coalesce((
+                        select priority from operation
+                        where name = op.operation_id
+                          and owner_id = parentop.name
+                        ), 0)
+                    returning operationplan.reference
+                    """,
+                    (
+                        completed_allow_future,
+                        now,
+                        completed_allow_future,
+                        now,
+                        closing,
+                    ),
+                )
+                for rec in cursor.fetchall():
+                    todo[rec[0]] = True
+
+                # Update the status of the routing operationplans.
+                # They don't pass their new status on to their steps.
+                cursor.execute(
+                    """
+                    with steps as (
+                      select
+                        parent.reference,
+                        count(*) as count,
+                        bool_and(step.status = 'closed') as closed,
+                        bool_and(step.status in ('completed', 'closed')) as completed,
+                        (
+                          select count(*) from operation
+                          where owner_id = parent.operation_id
+                        ) as expected
+                      from operationplan parent
+                      inner join operation parentop
+                        on parentop.name = parent.operation_id
+                        and parentop.type = 'routing'
+                      inner join operationplan step
+                        on step.owner_id = parent.reference
+                      where parent.reference in (
+                        select owner_id from operationplan
+                        where reference = any(%s) and type = 'MO'
+                        )
+                      group by parent.reference
+                      ),
+                    newstatus as (
+                      select
+                        steps.reference,
+                        case
+                          when steps.count = steps.expected and steps.closed
+                            then 'closed'
+                          when steps.count = steps.expected and steps.completed
+                            then 'completed'
+                          when operationplan.status = 'proposed' then 'approved'
+                          else operationplan.status
+                        end as status
+                      from steps
+                      inner join operationplan
+                        on operationplan.reference = steps.reference
+                      )
+                    update operationplan
+                    set status = newstatus.status,
+                      startdate = case when %s then operationplan.startdate
+                        else least(operationplan.startdate, %s) end,
+                      enddate = case
+                        when %s or newstatus.status = 'approved'
+                          then operationplan.enddate
+                        else least(operationplan.enddate, %s) end
+                    from newstatus
+                    where operationplan.reference = newstatus.reference
+                      and operationplan.status is distinct from newstatus.status
+                    returning operationplan.reference
+                    """,
+                    (
+                        closing,
+                        completed_allow_future,
+                        now,
+                        completed_allow_future,
+                        now,
+                    ),
+                )
+                for rec in cursor.fetchall():
+                    todo.setdefault(rec[0], False)
+
+                # Delete existing resource loadplans
+                cursor.execute(
+                    """
+                    delete from operationplanresource
+                    where operationplan_id = any(%s)
+                    """,
+                    (closing,),
+                )
+
+                # Assure the material flows are in the past
+                if not completed_allow_future:
+                    cursor.execute(
+                        """
+                        update operationplanmaterial
+                        set flowdate = %s
+                        where operationplan_id = any(%s) and flowdate > %s
+                        """,
+                        (now, closing, now),
+                    )
+
+                # Assure that the consumed material is covered by closed or
+                # completed supply. Confirmed supply is closed first, then
+                # approved and finally proposed supply. Within each status we
+                # close the earliest and biggest supply first.
+                cursor.execute(
+                    """
+                    with consumers as (
+                      select
+                        opm.item_id, opm.location_id, min(op.status) as status
+                      from operationplanmaterial opm
+                      inner join operationplan op
+                        on op.reference = opm.operationplan_id
+                      where opm.operationplan_id = any(%s) and opm.quantity < 0
+                      group by opm.item_id, opm.location_id
+                      ),
+                    shortages as (
+                      select
+                        consumers.item_id, consumers.location_id, consumers.status,
+                        -0.00001 - sum(opm.quantity) as shortage
+                      from consumers
+                      inner join operationplanmaterial opm
+                        on opm.item_id = consumers.item_id
+                        and opm.location_id = consumers.location_id
+                      inner join operationplan op
+                        on op.reference = opm.operationplan_id
+                        and (op.type = 'STCK' or op.status in ('closed', 'completed'))
+                      group by
+                        consumers.item_id, consumers.location_id, consumers.status
+                      having -0.00001 - sum(opm.quantity) > 0
+                      ),
+                    candidates as (
+                      select
+                        opm.operationplan_id, shortages.status, shortages.shortage,
+                        sum(opm.quantity) over (
+                          partition by opm.item_id, opm.location_id
+                          order by
+                            case op.status
+                              when 'confirmed' then 1
+                              when 'approved' then 2
+                              else 3
+                            end,
+                            opm.flowdate, opm.quantity desc, opm.id
+                          ) - opm.quantity as covered
+                      from shortages
+                      inner join operationplanmaterial opm
+                        on opm.item_id = shortages.item_id
+                        and opm.location_id = shortages.location_id
+                        and opm.quantity > 0
+                      inner join operationplan op
+                        on op.reference = opm.operationplan_id
+                        and op.type != 'STCK'
+                        and op.status in ('confirmed', 'approved', 'proposed')
+                      )
+                    update operationplan
+                    set status = candidates.status
+                    from candidates
+                    where operationplan.reference = candidates.operationplan_id
+                      and candidates.covered < candidates.shortage
+                    returning operationplan.reference, operationplan.status
+                    """,
+                    (closing,),
+                )
+                for ref, status in cursor.fetchall():
+                    if done.get(ref, None) != status:
+                        todo[ref] = True
+
+    @classmethod
+    @contextmanager
+    def bulkUpdate(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Operationplans saved in this block don't propagate their status
+        one by one. This is done for all of them at the end of the block.
+        """
+        deferred = getattr(OperationPlan._deferred, "references", None)
+        if deferred is None:
+            deferred = OperationPlan._deferred.references = {}
+        if database in deferred:
+            # Nested block
+            yield
+            return
+        deferred[database] = references = set()
+        try:
+            yield
+        finally:
+            del deferred[database]
+        if references:
+            cls.propagateStatusBulk(references, database)
+
     def save(self, *args, **kwargs):
-        self.propagateStatus()
+        deferred = getattr(OperationPlan._deferred, "references", None)
+        references = None
+        if deferred:
+            references = deferred.get(
+                kwargs.get("using", None) or self._state.db or DEFAULT_DB_ALIAS
+            )
+        if references is None:
+            self.propagateStatus()
+        elif self.type != "STCK":
+            references.add(self.reference)
         # Call the real save() method
         super().save(*args, **kwargs)
 
+    def saveStatusOfChildren(self, update_fields, database):
+        """
+        Saves a status derived from the child operationplans, without passing
+        it back down to them.
+        """
+        self.propagateStatus(alignChildren=False)
+        super().save(update_fields=update_fields, using=database)
+
     @classmethod
     def getDeleteStatements(cls):
         stmts = []
@@ -45,12 +45,18 @@ from .models import (
 )
 
 
-@NotificationFactory.register(CalendarBucket, [CalendarBucket])
+@NotificationFactory.register(
+    CalendarBucket, [CalendarBucket], key=NotificationFactory.objectKey
+)
 def CalendarBucketNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(Calendar, [Calendar, CalendarBucket])
+@NotificationFactory.register(
+    Calendar,
+    [Calendar, CalendarBucket],
+    key=NotificationFactory.fieldKey(Calendar, "calendar_id"),
+)
 def CalendarNotification(flw, msg):
     if flw.content_type == msg.content_type:
         return flw.object_pk == msg.object_pk
@@ -61,8 +67,19 @@ def CalendarNotification(flw, msg):
         return msg.model_name() in args if args else True
 
 
+def LocationKey(msg):
+    if msg.content_type.model_class() == Location:
+        return (msg.object_pk,)
+    elif msg.content_type.model_class() == DistributionOrder:
+        return (msg.content_object.origin_id, msg.content_object.destination_id)
+    else:
+        return (msg.content_object.location_id,)
+
+
 @NotificationFactory.register(
-    Location, [Location, Demand, PurchaseOrder, ManufacturingOrder, DistributionOrder]
+    Location,
+    [Location, Demand, PurchaseOrder, ManufacturingOrder, DistributionOrder],
+    key=LocationKey,
 )
 def LocationNotification(flw, msg):
     if flw.content_type == msg.content_type:
@@ -89,7 +106,11 @@ def LocationNotification(flw, msg):
             return msg.model_name() in args if args else True
 
 
-@NotificationFactory.register(Customer, [Customer, Demand])
+@NotificationFactory.register(
+    Customer,
+    [Customer, Demand],
+    key=NotificationFactory.fieldKey(Customer, "customer_id"),
+)
 def CustomerNotification(flw, msg):
     if flw.content_type == msg.content_type:
         return flw.object_pk == msg.object_pk
@@ -100,7 +121,11 @@ def CustomerNotification(flw, msg):
         return msg.model_name() in args if args else True
 
 
-@NotificationFactory.register(Supplier, [Supplier, PurchaseOrder])
+@NotificationFactory.register(
+    Supplier,
+    [Supplier, PurchaseOrder],
+    key=NotificationFactory.fieldKey(Supplier, "supplier_id"),
+)
 def SupplierNotification(flw, msg):
     if flw.content_type == msg.content_type:
         return flw.object_pk == msg.object_pk
@@ -123,6 +148,7 @@ def SupplierNotification(flw, msg):
         ItemDistribution,
         Operation,
     ],
+    key=NotificationFactory.fieldKey(Item, "item_id"),
 )
 def ItemNotification(flw, msg):
     if flw.content_type == msg.content_type:
@@ -136,17 +162,30 @@ def ItemNotification(flw, msg):
         return msg.model_name() in args if args else True
 
 
-@NotificationFactory.register(ItemSupplier, [ItemSupplier])
+@NotificationFactory.register(
+    ItemSupplier, [ItemSupplier], key=NotificationFactory.objectKey
+)
 def ItemSupplierNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(ItemDistribution, [ItemDistribution])
+@NotificationFactory.register(
+    ItemDistribution, [ItemDistribution], key=NotificationFactory.objectKey
+)
 def ItemDistributionNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(Operation, [Operation, ManufacturingOrder])
+def OperationKey(msg):
+    if msg.content_type.model_class() == Operation:
+        return (msg.object_pk, msg.content_object.owner_id)
+    else:
+        return (msg.content_object.operation_id,)
+
+
+@NotificationFactory.register(
+    Operation, [Operation, ManufacturingOrder], key=OperationKey
+)
 def OperationNotification(flw, msg):
     if flw.content_type == msg.content_type:
         return (
@@ -160,22 +199,28 @@ def OperationNotification(flw, msg):
         return msg.model_name() in args if args else True
 
 
-@NotificationFactory.register(SubOperation, [SubOperation])
+@NotificationFactory.register(
+    SubOperation, [SubOperation], key=NotificationFactory.objectKey
+)
 def SubOperationNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(Buffer, [Buffer])
+@NotificationFactory.register(Buffer, [Buffer], key=NotificationFactory.objectKey)
 def BufferNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(SetupRule, [SetupRule])
+@NotificationFactory.register(SetupRule, [SetupRule], key=NotificationFactory.objectKey)
 def SetupRuleNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(SetupMatrix, [SetupMatrix, SetupRule])
+@NotificationFactory.register(
+    SetupMatrix,
+    [SetupMatrix, SetupRule],
+    key=NotificationFactory.fieldKey(SetupMatrix, "setupmatrix_id"),
+)
 def SetupMatrixNotification(flw, msg):
     if flw.content_type == msg.content_type:
         return flw.object_pk == msg.object_pk
@@ -186,7 +231,11 @@ def SetupMatrixNotification(flw, msg):
         return msg.model_name() in args if args else True
 
 
-@NotificationFactory.register(Skill, [Skill, ResourceSkill, OperationResource])
+@NotificationFactory.register(
+    Skill,
+    [Skill, ResourceSkill, OperationResource],
+    key=NotificationFactory.fieldKey(Skill, "skill_id"),
+)
 def SkillNotification(flw, msg):
     if flw.content_type == msg.content_type:
         return flw.object_pk == msg.object_pk
@@ -197,13 +246,26 @@ def SkillNotification(flw, msg):
         return msg.model_name() in args if args else True
 
 
-@NotificationFactory.register(ResourceSkill, [ResourceSkill])
+@NotificationFactory.register(
+    ResourceSkill, [ResourceSkill], key=NotificationFactory.objectKey
+)
 def ResourceSkillNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
+def ResourceKey(msg):
+    if msg.content_type.model_class() == Resource:
+        return (msg.object_pk,)
+    elif msg.content_type.model_class() == ManufacturingOrder:
+        return [x.resource_id for x in msg.content_object.resources.all()]
+    else:
+        return (msg.content_object.resource_id,)
+
+
 @NotificationFactory.register(
-    Resource, [Resource, ResourceSkill, OperationResource, ManufacturingOrder]
+    Resource,
+    [Resource, ResourceSkill, OperationResource, ManufacturingOrder],
+    key=ResourceKey,
 )
 def ResourceNotification(flw, msg):
     if flw.content_type == msg.content_type:
@@ -224,46 +286,62 @@ def ResourceNotification(flw, msg):
         return False
 
 
-@NotificationFactory.register(OperationMaterial, [OperationMaterial])
+@NotificationFactory.register(
+    OperationMaterial, [OperationMaterial], key=NotificationFactory.objectKey
+)
 def OperationMaterialNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(OperationResource, [OperationResource])
+@NotificationFactory.register(
+    OperationResource, [OperationResource], key=NotificationFactory.objectKey
+)
 def OperationResourceNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(ManufacturingOrder, [ManufacturingOrder])
+@NotificationFactory.register(
+    ManufacturingOrder, [ManufacturingOrder], key=NotificationFactory.objectKey
+)
 def ManufacturingOrderNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(DistributionOrder, [DistributionOrder])
+@NotificationFactory.register(
+    DistributionOrder, [DistributionOrder], key=NotificationFactory.objectKey
+)
 def DistributionOrderNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(PurchaseOrder, [PurchaseOrder])
+@NotificationFactory.register(
+    PurchaseOrder, [PurchaseOrder], key=NotificationFactory.objectKey
+)
 def PurchaseOrderNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(DeliveryOrder, [DeliveryOrder])
+@NotificationFactory.register(
+    DeliveryOrder, [DeliveryOrder], key=NotificationFactory.objectKey
+)
 def DeliveryOrderNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(Demand, [Demand])
+@NotificationFactory.register(Demand, [Demand], key=NotificationFactory.objectKey)
 def DemandNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(OperationPlanResource, [OperationPlanResource])
+@NotificationFactory.register(
+    OperationPlanResource, [OperationPlanResource], key=NotificationFactory.objectKey
+)
 def OperationPlanResourceNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
 
 
-@NotificationFactory.register(OperationPlanMaterial, [OperationPlanMaterial])
+@NotificationFactory.register(
+    OperationPlanMaterial, [OperationPlanMaterial], key=NotificationFactory.objectKey
+)
 def OperationPlanMaterialNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk
@@ -15,11 +15,18 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from contextlib import nullcontext
+from datetime import datetime, timedelta
 from itertools import chain
+import json
+import logging
 import os
+from openpyxl import load_workbook, Workbook
 import random
 from rest_framework.test import APIClient, APITestCase, APIRequestFactory
 import tempfile
+import tracemalloc
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth.models import Permission
@@ -29,7 +36,7 @@ from django.http.response import StreamingHttpResponse
 from django.test import TestCase, TransactionTestCase
 from django.utils import translation
 
-from freppledb.common.dataload import parseCSVdata
+from freppledb.common.dataload import _BulkLoader, parseCSVdata, parseExcelWorksheet
 from freppledb.common.models import (
     User,
     Bucket,
@@ -40,6 +47,7 @@ from freppledb.common.models import (
     Notification,
 )
 from freppledb.common.tests import checkResponse
+from freppledb.input.views.utils import SEARCH_COUNT_LIMIT, SEARCH_RESULT_LIMIT
 from freppledb.input.models import (
     Buffer,
     Calendar,
@@ -141,6 +149,198 @@ class DataLoadTest(TestCase):
             ],  # Test result is different in Enterprise Edition
         )
 
+    def test_csv_upload_bulk(self):
+        user = User.objects.get(username="admin")
+        errors = [
+            i
+            for i in parseCSVdata(
+                Demand,
+                [
+                    ["name", "item", "location", "customer", "quantity", "due"],
+                    [
+                        "bulk 1",
+                        "product",
+                        "factory 1",
+                        "Customer near factory 1",
+                        "5",
+                        "2021-01-01",
+                    ],
+                    [
+                        "bulk 2",
+                        "unknown item",
+                        "factory 1",
+                        "Customer near factory 1",
+                        "5",
+                        "2021-01-01",
+                    ],
+                    [
+                        "bulk 3",
+                        "product",
+                        "factory 1",
+                        "Customer near factory 1",
+                        "5",
+                        "not a date",
+                    ],
+                ],
+                user=user,
+                bulk=True,
+            )
+            if i[0] == logging.ERROR
+        ]
+        self.assertEqual([(i[1], i[2]) for i in errors], [(3, "item"), (4, "due")])
+        self.assertEqual(Demand.objects.filter(name__startswith="bulk").count(), 1)
+        self.assertEqual(Demand.objects.get(name="bulk 1").status, "open")
+
+        # Reload with a change
+        for _ in parseCSVdata(
+            Demand,
+            [["name", "quantity"], ["bulk 1", "10"]],
+            user=user,
+            bulk=True,
+        ):
+            pass
+        self.assertEqual(Demand.objects.get(name="bulk 1").quantity, 10)
+        self.assertEqual(
+            list(
+                Comment.objects.filter(object_pk="bulk 1")
+                .order_by("id")
+                .values_list("type", "comment")
+            ),
+            [("add", "Added"), ("change", "Changed quantity.")],
+        )
+
+    def test_csv_upload_comment_limit(self):
+        user = User.objects.get(username="admin")
+        Parameter.objects.update_or_create(
+            name="upload.comment_limit", defaults={"value": "2"}
+        )
+        for bulk in (False, True):
+            # A small upload records a comment per record
+            for _ in parseCSVdata(
+                Customer,
+                [["name"], ["%s 1" % bulk], ["%s 2" % bulk]],
+                user=user,
+                bulk=bulk,
+            ):
+                pass
+            self.assertEqual(
+                Comment.objects.filter(object_pk__startswith=str(bulk)).count(), 2
+            )
+
+            # A bigger upload records a single comment
+            for _ in parseCSVdata(
+                Customer,
+                [["name"], ["%s 3" % bulk], ["%s 4" % bulk], ["%s 5" % bulk]],
+                user=user,
+                bulk=bulk,
+            ):
+                pass
+            self.assertEqual(
+                Comment.objects.filter(object_pk__startswith=str(bulk)).count(), 2
+            )
+            self.assertEqual(
+                Comment.objects.filter(object_pk="all").order_by("-id")[0].comment,
+                "Bulk change: added 3.",
+            )
+
+    def test_csv_upload_bulk_interrupted(self):
+        # An interrupted bulk upload leaves no staging table behind
+        user = User.objects.get(username="admin")
+        with mock.patch.object(_BulkLoader, "batchsize", 1):
+            upload = parseCSVdata(
+                Customer,
+                [["name", "owner"], ["bulk 1", ""], ["bulk 2", "unknown"]],
+                user=user,
+                bulk=True,
+            )
+            self.assertEqual(next(upload)[0], logging.ERROR)
+            upload.close()
+        for _ in parseCSVdata(Customer, [["name"], ["bulk 3"]], user=user, bulk=True):
+            pass
+        self.assertEqual(Customer.objects.filter(name__startswith="bulk").count(), 2)
+        self.assertTrue(Comment.objects.filter(object_pk="bulk 3").exists())
+
+    def test_excel_upload_autofilter(self):
+        # Only the data in the auto-filter range is read, also from a
+        # read-only workbook
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "customer"
+        ws.append(["List of customers"])
+        ws.append([])
+        ws.append(["name", "category"])
+        ws.append(["filtered customer 1", "A"])
+        ws.append(["filtered customer 2", "B"])
+        ws.append(["not a customer"])
+        ws.auto_filter.ref = "A3:B5"
+        with tempfile.NamedTemporaryFile(suffix=".xlsx") as data:
+            wb.save(data.name)
+            for read_only in (True, False):
+                wb = load_workbook(filename=data.name, read_only=read_only)
+                errors = [
+                    i
+                    for i in parseExcelWorksheet(Customer, wb["customer"])
+                    if i[0] == logging.ERROR
+                ]
+                wb.close()
+                self.assertEqual(errors, [])
+                self.assertEqual(
+                    list(
+                        Customer.objects.filter(name__contains="customer")
+                        .order_by("name")
+                        .values_list("name", "category")
+                    ),
+                    [("filtered customer 1", "A"), ("filtered customer 2", "B")],
+                )
+
+    def test_excel_upload_memory(self):
+        # The memory use of a read-only workbook doesn't depend on its size
+        peaks = []
+        for size in (1000, 10000):
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("customer")
+            ws.append(["name", "category"])
+            for i in range(size):
+                ws.append(["customer %s %s" % (size, i), "category %s" % i])
+            with tempfile.NamedTemporaryFile(suffix=".xlsx") as data:
+                wb.save(data.name)
+                wb = load_workbook(filename=data.name, read_only=True, data_only=True)
+                tracemalloc.start()
+                with mock.patch.object(_BulkLoader, "batchsize", 500):
+                    for _ in parseExcelWorksheet(Customer, wb["customer"], bulk=True):
+                        pass
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+                wb.close()
+        self.assertEqual(
+            Customer.objects.filter(name__startswith="customer 10000 ").count(), 10000
+        )
+        self.assertLess(peaks[1], 2 * peaks[0])
+
+    def test_search(self):
+        response = self.client.get("/search/?term=factory")
+        self.assertEqual(response.status_code, 200)
+        values = [i["value"] for i in response.json() if i["value"]]
+        self.assertIn("factory 1", values)
+
+        # Short search terms only match the start
+        response = self.client.get("/search/?term=ct")
+        self.assertNotIn("factory 1", [i["value"] for i in response.json()])
+        response = self.client.get("/search/?term=fa")
+        self.assertIn("factory 1", [i["value"] for i in response.json()])
+
+        # The number of matches is capped
+        for i in range(SEARCH_COUNT_LIMIT + 5):
+            Customer.objects.create(name="search customer %s" % i)
+        response = self.client.get("/search/?term=search customer")
+        self.assertEqual(
+            [i["label"] for i in response.json() if i["value"] is None],
+            ["Customer - more than %s matches" % SEARCH_COUNT_LIMIT],
+        )
+        self.assertEqual(
+            len([i for i in response.json() if i["value"]]), SEARCH_RESULT_LIMIT
+        )
+
     def test_forms(self):
         item = Item.objects.all()[0].name
         loc1 = Location.objects.all()[0].name
@@ -215,6 +415,202 @@ class DataLoadTest(TestCase):
             1,
         )
 
+    def test_bulk_status(self):
+        oper = Operation.objects.all()[0]
+        future = datetime.now() + timedelta(days=10)
+        parent = ManufacturingOrder.objects.create(
+            reference="parent",
+            operation=oper,
+            quantity=1,
+            status="proposed",
+            startdate=future,
+            enddate=future,
+        )
+        for ref in ("child 1", "child 2"):
+            ManufacturingOrder.objects.create(
+                reference=ref,
+                operation=oper,
+                owner=parent,
+                quantity=1,
+                status="proposed",
+                startdate=future,
+                enddate=future,
+            )
+
+        # Saving the parent only propagates its status at the end of the block
+        with ManufacturingOrder.bulkUpdate():
+            parent.status = "completed"
+            parent.save()
+            self.assertEqual(
+                ManufacturingOrder.objects.filter(
+                    owner=parent, status="proposed"
+                ).count(),
+                2,
+            )
+        for mo in ManufacturingOrder.objects.filter(
+            reference__in=("parent", "child 1", "child 2")
+        ):
+            self.assertEqual(mo.status, "completed")
+            self.assertLess(mo.enddate, future)
+
+    def createRouting(self, prefix):
+        """
+        Creates a routing manufacturing order with 3 steps. The second step
+        consumes material that is supplied by a confirmed manufacturing order.
+        """
+        location = Location.objects.all()[0]
+        item = Item.objects.create(name="%s item" % prefix)
+        routing = Operation.objects.create(
+            name="%s routing" % prefix, type="routing", location=location
+        )
+        future = datetime.now() + timedelta(days=10)
+        mo = {
+            "routing": ManufacturingOrder.objects.create(
+                reference="%s routing" % prefix,
+                operation=routing,
+                quantity=10,
+                status="proposed",
+                startdate=future,
+                enddate=future,
+            )
+        }
+        for step in (1, 2, 3):
+            mo["step %s" % step] = ManufacturingOrder.objects.create(
+                reference="%s step %s" % (prefix, step),
+                operation=Operation.objects.create(
+                    name="%s step %s" % (prefix, step),
+                    owner=routing,
+                    priority=step,
+                    location=location,
+                ),
+                owner=mo["routing"],
+                quantity=10,
+                status="proposed",
+                startdate=future,
+                enddate=future,
+            )
+        mo["supply"] = ManufacturingOrder.objects.create(
+            reference="%s supply" % prefix,
+            operation=Operation.objects.create(
+                name="%s supply" % prefix, location=location
+            ),
+            quantity=10,
+            status="confirmed",
+            startdate=future,
+            enddate=future,
+        )
+        for ref, quantity in (("step 2", -10), ("supply", 10)):
+            OperationPlanMaterial.objects.create(
+                operationplan=mo[ref],
+                item=item,
+                location=location,
+                quantity=quantity,
+                flowdate=future,
+            )
+        return mo
+
+    def test_routing_status(self):
+        # Single saves and bulk saves of a routing step give the same result
+        results = []
+        for bulk in (False, True):
+            mo = self.createRouting("bulk" if bulk else "single")
+            with ManufacturingOrder.bulkUpdate() if bulk else nullcontext():
+                mo["step 2"].status = "completed"
+                mo["step 2"].save()
+            statuses = {
+                key: ManufacturingOrder.objects.get(pk=i.reference).status
+                for key, i in mo.items()
+            }
+            results.append(statuses)
+
+            # Previous steps get the same status, the routing is approved and
+            # doesn't pass its status on to the next steps
+            self.assertEqual(statuses["step 1"], "completed")
+            self.assertEqual(statuses["step 3"], "proposed")
+            self.assertEqual(statuses["routing"], "approved")
+            # The supply of the consumed material is completed as well
+            self.assertEqual(statuses["supply"], "completed")
+            self.assertLess(
+                ManufacturingOrder.objects.get(pk=mo["supply"].reference).enddate,
+                mo["supply"].enddate,
+            )
+
+            # Closing the last step closes the previous steps and the routing
+            step = ManufacturingOrder.objects.get(pk=mo["step 3"].reference)
+            with ManufacturingOrder.bulkUpdate() if bulk else nullcontext():
+                step.status = "closed"
+                step.save()
+            statuses = {
+                key: ManufacturingOrder.objects.get(pk=i.reference).status
+                for key, i in mo.items()
+            }
+            results.append(statuses)
+            self.assertEqual(statuses["step 1"], "closed")
+            self.assertEqual(statuses["step 2"], "closed")
+            self.assertEqual(statuses["routing"], "closed")
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[1], results[3])
+
+    def test_hierarchy(self):
+        def checkHierarchy():
+            items = {i.name: i for i in Item.objects.all()}
+            numbers = []
+            for i in items.values():
+                self.assertIsNotNone(i.lft)
+                numbers.extend([i.lft, i.rght])
+                if i.owner_id:
+                    owner = items[i.owner_id]
+                    self.assertTrue(owner.lft < i.lft and i.rght < owner.rght)
+                    self.assertEqual(i.lvl, owner.lvl + 1)
+                else:
+                    self.assertEqual(i.lvl, 0)
+            self.assertEqual(sorted(numbers), list(range(1, 2 * len(items) + 1)))
+
+        Item.rebuildHierarchy()
+        checkHierarchy()
+
+        # Editing an item doesn't require a rebuild
+        item = Item.objects.all()[0]
+        item.description = "new description"
+        item.save()
+        self.assertFalse(Item.objects.filter(lft__isnull=True).exists())
+
+        # Adding, moving and deleting items renumber the hierarchy
+        Item.objects.create(name="new parent")
+        Item.objects.create(name="new child", owner_id="new parent")
+        checkHierarchy()
+        for i in Item.objects.exclude(name__in=("new parent", "new child")):
+            if i.owner_id:
+                i.owner_id = "new child"
+                i.save()
+        checkHierarchy()
+        child = Item.objects.get(name="new child")
+        child.owner = None
+        child.save()
+        checkHierarchy()
+        Item.objects.get(name="new child").delete()
+        checkHierarchy()
+
+        # An upload rebuilds the hierarchy once at the end, rather than
+        # renumbering it for every record
+        with mock.patch.object(
+            Item, "_lockHierarchy", side_effect=AssertionError
+        ), mock.patch.object(
+            Item, "rebuildHierarchy", wraps=Item.rebuildHierarchy
+        ) as rebuild:
+            for _ in parseCSVdata(
+                Item,
+                [["name", "owner"], ["upload parent", ""]]
+                + [["upload child %s" % i, "upload parent"] for i in range(10)],
+                bulk=False,
+            ):
+                pass
+            with Item.bulkUpdate():
+                Item.objects.get(name="upload child 1").delete()
+        self.assertEqual(rebuild.call_count, 2)
+        checkHierarchy()
+        self.assertEqual(Item.objects.filter(owner_id="upload parent").count(), 9)
+
 
 class ExcelTest(TransactionTestCase):
 
@@ -687,6 +1083,47 @@ class freppleREST(APITestCase):
         self.assertEqual(response.status_code, 204)
         self.assertEqual(Customer.objects.filter(category="TEST DELETE").count(), 0)
 
+    def test_api_demand_bulk(self):
+        recordsnumber = Demand.objects.count()
+        data = "\n".join(
+            json.dumps(
+                {
+                    "name": "Order UFO %s" % i,
+                    "item": "product",
+                    "customer": "Customer near factory 1",
+                    "location": "factory 1",
+                    "due": "2013-12-01 00:00:00",
+                    "quantity": 10 * i,
+                }
+            )
+            for i in range(1, 101)
+        )
+        data += '\n{"name": "Order UFO 1", "quantity": 5}'
+        data += '\n{"name": "Order UFO 0", "item": "unknown item"}'
+        response = self.client.post(
+            "/api/input/demand/", data, content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, 200)
+        results = [
+            json.loads(i)
+            for i in b"".join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(results[0]["level"], "error")
+        self.assertEqual(results[0]["row"], 102)
+        self.assertTrue(results[-1]["errors"] > 0)
+        self.assertEqual(Demand.objects.count(), recordsnumber + 100)
+        self.assertEqual(Demand.objects.get(name="Order UFO 1").quantity, 5)
+
+        data = "name,quantity,item\nOrder UFO 2,7,product\nOrder UFO 3,8,unknown\n"
+        response = self.client.post("/api/input/demand/", data, content_type="text/csv")
+        results = [
+            json.loads(i)
+            for i in b"".join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(results[0]["row"], 3)
+        self.assertTrue(results[-1]["errors"] > 0)
+        self.assertEqual(Demand.objects.get(name="Order UFO 2").quantity, 7)
+
     def test_api_customer(self):
         response = self.client.get("/api/input/customer/")
         checkResponse(self, response)
@@ -865,6 +1302,111 @@ class NotificationTest(TransactionTestCase):
         #    print(x)
         self.assertEqual(Notification.objects.count(), 4)
 
+    def test_follow_related(self):
+        # Followers are notified of messages on related objects
+        loc1 = Location.objects.create(name="loc 1")
+        loc2 = Location.objects.create(name="loc 2")
+        item = Item.objects.create(name="test item")
+        customer = Customer.objects.create(name="test customer")
+        res1 = Resource.objects.create(name="res 1", location=loc1)
+        res2 = Resource.objects.create(name="res 2", location=loc1)
+        routing = Operation.objects.create(
+            name="test routing", type="routing", location=loc1
+        )
+        step = Operation.objects.create(
+            name="test step", owner=routing, priority=1, location=loc1
+        )
+        future = datetime.now() + timedelta(days=10)
+        mo = ManufacturingOrder.objects.create(
+            reference="MO 1",
+            operation=step,
+            quantity=1,
+            status="proposed",
+            startdate=future,
+            enddate=future,
+        )
+        OperationPlanResource.objects.create(
+            operationplan=mo,
+            resource=res1,
+            quantity=1,
+            startdate=future,
+            enddate=future,
+        )
+        do = DistributionOrder.objects.create(
+            reference="DO 1",
+            item=item,
+            origin=loc1,
+            destination=loc2,
+            quantity=1,
+            status="proposed",
+            startdate=future,
+            enddate=future,
+        )
+        demand = Demand.objects.create(
+            name="test demand",
+            item=item,
+            customer=customer,
+            location=loc1,
+            quantity=1,
+            due=future,
+        )
+
+        # Every user follows a single object
+        expected = set()
+        for username, obj, args, notified in (
+            ("resource", res1, {"sub": ["manufacturingorder"]}, [mo]),
+            ("resource without sub", res1, None, []),
+            ("other resource", res2, {"sub": ["manufacturingorder"]}, []),
+            ("owner", routing, None, [step]),
+            ("operation", step, None, [step, mo]),
+            ("destination", loc2, None, [do]),
+            ("customer", customer, None, [demand]),
+        ):
+            user = User.objects.create_user(
+                username=username,
+                email="%s@yourcompany.com" % username.replace(" ", "_"),
+                password="big_secret12345",
+            )
+            user.user_permissions.add(
+                *Permission.objects.filter(
+                    codename__in=(
+                        "view_manufacturingorder",
+                        "view_distributionorder",
+                        "view_operation",
+                        "view_demand",
+                    )
+                )
+            )
+            Follower(
+                user=user,
+                content_type=ContentType.objects.get_for_model(obj),
+                object_pk=obj.pk,
+                args=args,
+            ).save()
+            expected.update((username, o.pk) for o in notified)
+
+        for obj in (mo, step, do, demand):
+            Comment(
+                content_type=ContentType.objects.get_for_model(
+                    obj, for_concrete_model=False
+                ),
+                object_pk=obj.pk,
+                object_repr=str(obj)[:200],
+                user=User.objects.get(username="admin"),
+                comment="test comment",
+                type="comment",
+            ).save()
+
+        # Check what notifications we got
+        Notification.wait()
+        self.assertEqual(
+            {
+                (n.user.username, n.comment.object_pk)
+                for n in Notification.objects.select_related("user", "comment")
+            },
+            expected,
+        )
+
     def test_performance(self):
         # Admin user follows all items
         user = User.objects.get(username="admin")
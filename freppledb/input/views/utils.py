@@ -60,17 +60,28 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of matches counted and shown per model in the global search
+SEARCH_COUNT_LIMIT = 100
+SEARCH_RESULT_LIMIT = 10
+
 
 @staff_member_required
 def search(request):
-    term = request.GET.get("term").strip()
+    term = request.GET.get("term", "").strip()
     result = []
 
+    # The search uses the trigram indexes on the primary key and description.
+    # These can't speed up a contains search on less than 3 characters, so
+    # short search terms only match the start of the text.
+    lookup = "icontains" if len(term) >= 3 else "istartswith"
+
     # Loop over all models in the data_site
     # We are interested in models satisfying these criteria:
     #  - primary key is of type text
     #  - user has change permissions
     for cls, admn in data_site._registry.items():
+        if not term:
+            break
         if request.user.has_perm(
             "%s.view_%s" % (cls._meta.app_label, cls._meta.object_name.lower())
         ) and isinstance(cls._meta.pk, CharField):
@@ -79,7 +90,10 @@ def search(request):
                 cls._meta.get_field("description")
                 query = (
                     cls.objects.using(request.database)
-                    .filter(Q(pk__icontains=term) | Q(description__icontains=term))
+                    .filter(
+                        Q(**{"pk__%s" % lookup: term})
+                        | Q(**{"description__%s" % lookup: term})
+                    )
                     .order_by("pk")
                     .values_list("pk", "description")
                 )
@@ -87,12 +101,27 @@ def search(request):
                 descriptionExists = False
                 query = (
                     cls.objects.using(request.database)
-                    .filter(pk__icontains=term)
+                    .filter(**{"pk__%s" % lookup: term})
                     .order_by("pk")
                     .values_list("pk")
                 )
-            count = len(query)
-            if count > 0:
+            # Count the matches only up to a limit
+            matches = list(query[: SEARCH_COUNT_LIMIT + 1])
+            count = len(matches)
+            if count > SEARCH_COUNT_LIMIT:
+                result.append(
+                    {
+                        "value": None,
+                        "label": (
+                            _("%(name)s - more than %(count)d matches")
+                            % {
+                                "name": force_text(cls._meta.verbose_name),
+                                "count": SEARCH_COUNT_LIMIT,
+                            }
+                        ).capitalize(),
+                    }
+                )
+            elif count > 0:
                 result.append(
                     {
                         "value": None,
@@ -109,28 +138,25 @@ def search(request):
                         ).capitalize(),
                     }
                 )
-                result.extend(
-                    [
-                        {
-                            "url": (
-                                "/data/%s/%s/?noautofilter&parentreference="
-                                if issubclass(cls, OperationPlan)
-                                else "/detail/%s/%s/"
-                            )
-                            % (cls._meta.app_label, cls._meta.object_name.lower()),
-                            "removeTrailingSlash": True
+            result.extend(
+                [
+                    {
+                        "url": (
+                            "/data/%s/%s/?noautofilter&parentreference="
                             if issubclass(cls, OperationPlan)
-                            else False,
-                            "value": i[0],
-                            "display": "%s%s"
-                            % (
-                                i[0],
-                                " %s" % (i[1],) if descriptionExists and i[1] else "",
-                            ),
-                        }
-                        for i in query[:10]
-                    ]
-                )
+                            else "/detail/%s/%s/"
+                        )
+                        % (cls._meta.app_label, cls._meta.object_name.lower()),
+                        "removeTrailingSlash": True
+                        if issubclass(cls, OperationPlan)
+                        else False,
+                        "value": i[0],
+                        "display": "%s%s"
+                        % (i[0], " %s" % (i[1],) if descriptionExists and i[1] else ""),
+                    }
+                    for i in matches[: SEARCH_RESULT_LIMIT]
+                ]
+            )
     # Construct reply
     return HttpResponse(
         content_type="application/json; charset=%s" % settings.DEFAULT_CHARSET,
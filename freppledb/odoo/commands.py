@@ -15,11 +15,15 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 import base64
+from concurrent.futures import ThreadPoolExecutor
 import email
+import gzip
 import jwt
 import os
+import socket
 import time
 import logging
+from urllib.error import URLError
 from urllib.request import urlopen, HTTPError, Request
 from xml.sax.saxutils import quoteattr
 
@@ -37,6 +41,34 @@ from freppledb.common.commands import (
 logger = logging.getLogger(__name__)
 
 
+class ProgressReader:
+    """
+    Wraps a file-like object and logs the progress of reading it.
+    The XML parser reads the data in chunks from this object.
+    """
+
+    def __init__(self, f, size=None, interval=50 * 1024 * 1024):
+        self.f = f
+        self.size = size
+        self.interval = interval
+        self.read_bytes = 0
+        self.next_report = interval
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.read_bytes += len(data)
+        if self.read_bytes >= self.next_report or (not data and self.read_bytes):
+            if self.size:
+                logger.info(
+                    "Read %.1f MB of %.1f MB of odoo data"
+                    % (self.read_bytes / 1048576, self.size / 1048576)
+                )
+            else:
+                logger.info("Read %.1f MB of odoo data" % (self.read_bytes / 1048576))
+            self.next_report = self.read_bytes + self.interval
+        return data
+
+
 @PlanTaskRegistry.register
 class OdooReadData(PlanTask):
     """
@@ -146,13 +178,25 @@ class OdooReadData(PlanTask):
                 logger.error("Error connecting to odoo at %s: %s" % (url, e))
                 raise e
 
-            # Download and parse XML data
+            # Download and parse XML data.
+            # The parser reads the response in chunks while it is downloading.
             with urlopen(request) as f:
-                frepple.readXMLdata(f.read().decode("utf-8"), False, False, loglevel)
+                size = f.headers.get("Content-Length", None)
+                frepple.readXMLdata(
+                    ProgressReader(f, int(size) if size else None),
+                    False,
+                    False,
+                    loglevel,
+                )
         else:
-            # Download and parse XML data
-            with open(debugFile, encoding="utf-8") as f:
-                frepple.readXMLdata(f.read(), False, False, loglevel)
+            # Parse XML data
+            with open(debugFile, "rb") as f:
+                frepple.readXMLdata(
+                    ProgressReader(f, os.path.getsize(debugFile)),
+                    False,
+                    False,
+                    loglevel,
+                )
 
         # Hierarchy correction: Count how many items/locations/customers have no owner
         # If we find 2+ then we use All items/All customers/All locations as root
@@ -278,169 +322,283 @@ class OdooWritePlan(PlanTask):
         odoo_language = Parameter.getValue("odoo.language", database, "en_US")
         if not ok:
             raise Exception("Odoo connector not configured correctly")
-        boundary = email.generator._make_boundary()
+        try:
+            batchsize = int(Parameter.getValue("odoo.export_batchsize", database, "0"))
+        except Exception:
+            batchsize = 0
+        try:
+            retries = int(Parameter.getValue("odoo.export_retries", database, "3"))
+        except Exception:
+            retries = 3
+        compress = (
+            Parameter.getValue("odoo.export_compress", database, "false").lower()
+            == "true"
+        )
+        if not odoo_url.endswith("/"):
+            odoo_url += "/"
+        url = "%sfrepple/xml/" % odoo_url
+        encoded = base64.encodebytes(
+            ("%s:%s" % (odoo_user, odoo_password)).encode("utf-8")
+        )
+        authorization = "Basic %s" % encoded.decode("ascii")[:-1]
+
+        def getFields(batch, last):
+            # The webtoken is regenerated for every batch, to avoid it expires
+            # during a long upload.
+            fields = {
+                "webtoken": jwt.encode(
+                    {"exp": round(time.time()) + 600, "user": odoo_user},
+                    settings.DATABASES[database].get(
+                        "SECRET_WEBTOKEN_KEY", settings.SECRET_KEY
+                    ),
+                    algorithm="HS256",
+                ).decode("ascii"),
+                "database": odoo_db,
+                "language": odoo_language,
+                "company": odoo_company,
+            }
+            if batchsize > 0:
+                fields["batch"] = batch
+                fields["last"] = "true" if last else "false"
+            return fields
 
-        # Generator function
-        # We generate output in the multipart/form-data format.
-        # We send the connection parameters as well as a file with the planning
-        # results in XML-format.
         # TODO respect the parameters odoo.filter_export_purchase_order, odoo.filter_export_manufacturing_order, odoo.filter_export_distribution_order
         # these are python expressions - attack-sensitive evaluation!
-        def publishPlan(cls):
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: form-data; name="webtoken"\r'
-            yield "\r"
-            yield "%s\r" % jwt.encode(
-                {"exp": round(time.time()) + 600, "user": odoo_user},
-                settings.DATABASES[database].get(
-                    "SECRET_WEBTOKEN_KEY", settings.SECRET_KEY
-                ),
-                algorithm="HS256",
-            ).decode("ascii")
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: form-data; name="database"\r'
-            yield "\r"
-            yield "%s\r" % odoo_db
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: form-data; name="language"\r'
-            yield "\r"
-            yield "%s\r" % odoo_language
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: form-data; name="company"\r'
-            yield "\r"
-            yield "%s\r" % odoo_company
-            yield "--%s\r" % boundary
-            yield 'Content-Disposition: file; name="frePPLe plan"; filename="frepple_plan.xml"\r'
-            yield "Content-Type: application/xml\r"
-            yield "\r"
-            yield '<?xml version="1.0" encoding="UTF-8" ?>'
-            yield '<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
-            # Export relevant operationplans
-            yield "<operationplans>"
+        def getBatches():
+            batch = []
             for i in frepple.operationplans():
-                if i.ordertype == "PO":
-                    if (
-                        i.status not in ("proposed", "approved")
-                        or not i.item
-                        or not i.item.source
-                        or not i.item.subcategory
-                        or not i.location.subcategory
-                        or not i.item.source.startswith("odoo")
-                    ):
-                        continue
-                    cls.exported.append(i)
-                    yield '<operationplan reference="%s" ordertype="PO" item=%s location=%s supplier=%s start="%s" end="%s" quantity="%s" location_id=%s item_id=%s criticality="%d"/>' % (
-                        i.reference,
-                        quoteattr(i.item.name),
-                        quoteattr(i.location.name),
-                        quoteattr(i.supplier.name),
-                        i.start,
-                        i.end,
-                        i.quantity,
-                        quoteattr(i.location.subcategory),
-                        quoteattr(i.item.subcategory),
-                        int(i.criticality),
-                    )
-                elif i.ordertype == "DO":
-                    if (
-                        i.status not in ("proposed", "approved")
-                        or not i.item
-                        or not i.item.source
-                        or not i.item.subcategory
-                        or not i.operation.origin.location.subcategory
-                        or not i.operation.destination.location.subcategory
-                        or not i.item.source.startswith("odoo")
-                    ):
-                        continue
-                    cls.exported.append(i)
-                    yield '<operationplan status="%s" reference="%s" ordertype="DO" item=%s origin=%s destination=%s start="%s" end="%s" quantity="%s" origin_id=%s destination_id=%s item_id=%s criticality="%d"/>' % (
-                        i.status,
-                        i.reference,
-                        quoteattr(i.operation.destination.item.name),
-                        quoteattr(i.operation.origin.location.name),
-                        quoteattr(i.operation.destination.location.name),
-                        i.start,
-                        i.end,
-                        i.quantity,
-                        quoteattr(i.operation.origin.location.subcategory),
-                        quoteattr(i.operation.destination.location.subcategory),
-                        quoteattr(i.operation.destination.item.subcategory),
-                        int(i.criticality),
-                    )
-                elif i.ordertype == "MO":
-                    if (
-                        i.status not in ("proposed", "approved")
-                        or not i.operation
-                        or not i.operation.source
-                        or not i.operation.item
-                        or not i.operation.source.startswith("odoo")
-                        or not i.operation.item.subcategory
-                        or not i.operation.location.subcategory
-                    ):
-                        continue
-                    cls.exported.append(i)
-                    res = set()
-                    try:
-                        for j in i.loadplans:
-                            res.add(j.resource.name)
-                    except Exception:
-                        pass
-                    demand = {}
-                    demand_str = ""
-                    for d in i.pegging_demand:
-                        demand[d.demand] = d.quantity
-                        demand_str += "%s:%s, " % (d.demand, d.quantity)
-                    if demand_str:
-                        demand_str = demand_str[:-2]
-                    yield '<operationplan reference="%s" ordertype="MO" item=%s location=%s operation=%s start="%s" end="%s" quantity="%s" location_id=%s item_id=%s criticality="%d" resource=%s demand=%s/>' % (
-                        i.reference,
-                        quoteattr(i.operation.item.name),
-                        quoteattr(i.operation.location.name),
-                        quoteattr(i.operation.name),
-                        i.start,
-                        i.end,
-                        i.quantity,
-                        quoteattr(i.operation.location.subcategory),
-                        quoteattr(i.operation.item.subcategory),
-                        int(i.criticality),
-                        quoteattr(",".join(res)),
-                        quoteattr(demand_str),
+                xml = cls.serialize(i)
+                if xml:
+                    batch.append((i, xml))
+                    if batchsize > 0 and len(batch) >= batchsize:
+                        yield batch
+                        batch = []
+            # The last batch is always sent, also when it's empty
+            yield batch
+
+        # Connect to the odoo URL to POST data.
+        # A batch is uploaded in a separate thread while the next batch is
+        # being serialized. Only acknowledged batches are marked as approved.
+        # The status of an operationplan can't change while we're iterating
+        # over them, so this is done at the end.
+        approved = []
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                pending = None
+                count = 0
+                previous = None
+                for batch in getBatches():
+                    if previous is not None:
+                        count += 1
+                        if pending:
+                            approved.extend(cls.acknowledge(*pending))
+                        pending = (
+                            previous,
+                            executor.submit(
+                                cls.post,
+                                url,
+                                authorization,
+                                getFields(count, False),
+                                [i[1] for i in previous],
+                                compress,
+                                retries,
+                            ),
+                        )
+                    previous = batch
+                if pending:
+                    approved.extend(cls.acknowledge(*pending))
+                if previous is not None:
+                    approved.extend(
+                        cls.acknowledge(
+                            previous,
+                            executor.submit(
+                                cls.post,
+                                url,
+                                authorization,
+                                getFields(count + 1, True),
+                                [i[1] for i in previous],
+                                compress,
+                                retries,
+                            ),
+                        )
                     )
-            yield "</operationplans>"
-            yield "</plan>"
-            yield "--%s--\r" % boundary
-            yield "\r"
+        except HTTPError as e:
+            logger.error("Error connecting to odoo %s" % e.read())
+        finally:
+            for i in approved:
+                i.status = "approved"
 
-        # Connect to the odoo URL to POST data
-        try:
-            cls.exported = []
-            body = "\n".join(publishPlan(cls)).encode("utf-8")
-            size = len(body)
-            encoded = base64.encodebytes(
-                ("%s:%s" % (odoo_user, odoo_password)).encode("utf-8")
+    @staticmethod
+    def acknowledge(batch, future):
+        """
+        Waits for the upload of a batch, and returns its operationplans.
+        """
+        future.result()
+        return [i[0] for i in batch]
+
+    @staticmethod
+    def post(url, authorization, fields, records, compress=False, retries=3):
+        """
+        Posts a list of XML operationplan elements to odoo.
+        We generate output in the multipart/form-data format.
+        We send the connection parameters as well as a file with the planning
+        results in XML-format.
+        Failures to connect to odoo are retried with an increasing delay.
+        Other errors aren't retried: once the request is sent, odoo may already
+        have created the orders of the batch, and posting it again would create
+        them twice.
+        """
+        boundary = email.generator._make_boundary()
+        body = []
+        for key, value in fields.items():
+            body.append("--%s\r" % boundary)
+            body.append('Content-Disposition: form-data; name="%s"\r' % key)
+            body.append("\r")
+            body.append("%s\r" % value)
+        body.append("--%s\r" % boundary)
+        body.append(
+            'Content-Disposition: file; name="frePPLe plan"; filename="frepple_plan.xml"\r'
+        )
+        body.append("Content-Type: application/xml\r")
+        body.append("\r")
+        body.append('<?xml version="1.0" encoding="UTF-8" ?>')
+        body.append('<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">')
+        body.append("<operationplans>")
+        body.extend(records)
+        body.append("</operationplans>")
+        body.append("</plan>")
+        body.append("--%s--\r" % boundary)
+        body.append("\r")
+        data = "\n".join(body).encode("utf-8")
+        headers = {
+            "Authorization": authorization,
+            "Content-Type": "multipart/form-data; boundary=%s" % boundary,
+        }
+        if compress:
+            data = gzip.compress(data)
+            headers["Content-Encoding"] = "gzip"
+        headers["Content-length"] = len(data)
+
+        attempt = 0
+        while True:
+            try:
+                # Posting the data and displaying the server response
+                logger.info(
+                    "Uploading %d operationplans in %d bytes of planning results to odoo"
+                    % (len(records), len(data))
+                )
+                with urlopen(Request(url, data=data, headers=headers)) as f:
+                    msg = f.read()
+                    logger.info("Odoo response: %s" % msg.decode("utf-8"))
+                return msg
+            except URLError as e:
+                # Only errors raised before the request was sent are retried
+                if attempt >= retries or not isinstance(
+                    e.reason, (ConnectionRefusedError, socket.gaierror)
+                ):
+                    raise
+                attempt += 1
+                logger.warning("Retrying upload to odoo after error: %s" % e)
+                time.sleep(2**attempt)
+
+    @staticmethod
+    def serialize(i):
+        """
+        Returns the XML element to upload for an operationplan, or None if the
+        operationplan isn't exported to odoo.
+        """
+        if i.ordertype == "PO":
+            if (
+                i.status not in ("proposed", "approved")
+                or not i.item
+                or not i.item.source
+                or not i.item.subcategory
+                or not i.location.subcategory
+                or not i.item.source.startswith("odoo")
+            ):
+                return None
+            return (
+                '<operationplan reference="%s" ordertype="PO" item=%s location=%s supplier=%s start="%s" end="%s" quantity="%s" location_id=%s item_id=%s criticality="%d"/>'
+                % (
+                    i.reference,
+                    quoteattr(i.item.name),
+                    quoteattr(i.location.name),
+                    quoteattr(i.supplier.name),
+                    i.start,
+                    i.end,
+                    i.quantity,
+                    quoteattr(i.location.subcategory),
+                    quoteattr(i.item.subcategory),
+                    int(i.criticality),
+                )
+            )
+        elif i.ordertype == "DO":
+            if (
+                i.status not in ("proposed", "approved")
+                or not i.item
+                or not i.item.source
+                or not i.item.subcategory
+                or not i.operation.origin.location.subcategory
+                or not i.operation.destination.location.subcategory
+                or not i.item.source.startswith("odoo")
+            ):
+                return None
+            return (
+                '<operationplan status="%s" reference="%s" ordertype="DO" item=%s origin=%s destination=%s start="%s" end="%s" quantity="%s" origin_id=%s destination_id=%s item_id=%s criticality="%d"/>'
+                % (
+                    i.status,
+                    i.reference,
+                    quoteattr(i.operation.destination.item.name),
+                    quoteattr(i.operation.origin.location.name),
+                    quoteattr(i.operation.destination.location.name),
+                    i.start,
+                    i.end,
+                    i.quantity,
+                    quoteattr(i.operation.origin.location.subcategory),
+                    quoteattr(i.operation.destination.location.subcategory),
+                    quoteattr(i.operation.destination.item.subcategory),
+                    int(i.criticality),
+                )
             )
-            if not odoo_url.endswith("/"):
-                odoo_url += "/"
-            req = Request(
-                "%sfrepple/xml/" % odoo_url,
-                data=body,
-                headers={
-                    "Authorization": "Basic %s" % encoded.decode("ascii")[:-1],
-                    "Content-Type": "multipart/form-data; boundary=%s" % boundary,
-                    "Content-length": size,
-                },
+        elif i.ordertype == "MO":
+            if (
+                i.status not in ("proposed", "approved")
+                or not i.operation
+                or not i.operation.source
+                or not i.operation.item
+                or not i.operation.source.startswith("odoo")
+                or not i.operation.item.subcategory
+                or not i.operation.location.subcategory
+            ):
+                return None
+            res = set()
+            try:
+                for j in i.loadplans:
+                    res.add(j.resource.name)
+            except Exception:
+                pass
+            demand = {}
+            demand_str = ""
+            for d in i.pegging_demand:
+                demand[d.demand] = d.quantity
+                demand_str += "%s:%s, " % (d.demand, d.quantity)
+            if demand_str:
+                demand_str = demand_str[:-2]
+            return (
+                '<operationplan reference="%s" ordertype="MO" item=%s location=%s operation=%s start="%s" end="%s" quantity="%s" location_id=%s item_id=%s criticality="%d" resource=%s demand=%s/>'
+                % (
+                    i.reference,
+                    quoteattr(i.operation.item.name),
+                    quoteattr(i.operation.location.name),
+                    quoteattr(i.operation.name),
+                    i.start,
+                    i.end,
+                    i.quantity,
+                    quoteattr(i.operation.location.subcategory),
+                    quoteattr(i.operation.item.subcategory),
+                    int(i.criticality),
+                    quoteattr(",".join(res)),
+                    quoteattr(demand_str),
+                )
             )
-
-            # Posting the data and displaying the server response
-            logger.info("Uploading %d bytes of planning results to odoo" % size)
-            with urlopen(req) as f:
-                msg = f.read()
-                logger.info("Odoo response: %s" % msg.decode("utf-8"))
-
-            # Mark the exported operations as approved
-            for i in cls.exported:
-                i.status = "approved"
-            del cls.exported
-
-        except HTTPError as e:
-            logger.error("Error connecting to odoo %s" % e.read())
+        return None
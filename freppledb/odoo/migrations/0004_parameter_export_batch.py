@@ -0,0 +1,36 @@
+#
+# Copyright (C) 2021 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("odoo", "0003_parameter")]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            insert into common_parameter
+            (name, value, description, lastmodified)
+            values
+            ('odoo.export_batchsize','0','Odoo connector: Number of operationplans uploaded to odoo in a single request. Default is 0, which uploads all operationplans in one request.', now()),
+            ('odoo.export_compress','false','Odoo connector: Set to true to compress the uploaded plan with gzip. Default is false.', now()),
+            ('odoo.export_retries','3','Odoo connector: Number of times a failed upload of the plan is retried. Default is 3.', now())
+            on conflict(name) do nothing
+            """
+        )
+    ]
@@ -0,0 +1,118 @@
+#
+# Copyright (C) 2021 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import gzip
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from unittest import mock
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from django.test import SimpleTestCase
+
+from freppledb.odoo.commands import OdooWritePlan
+
+
+class OdooStandIn(BaseHTTPRequestHandler):
+    """
+    A stand-in for the odoo server, which fails the first requests.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.requests.append(body.decode("utf-8"))
+        if len(self.server.requests) <= self.server.failures:
+            self.send_response(self.server.failurecode)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b"OK")
+
+    def log_message(self, *args):
+        pass
+
+
+class OdooWritePlanTest(SimpleTestCase):
+    def setUp(self):
+        self.server = HTTPServer(("localhost", 0), OdooStandIn)
+        self.server.requests = []
+        self.server.failures = 0
+        self.server.failurecode = 503
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = "http://localhost:%s/frepple/xml/" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, **kwargs):
+        return OdooWritePlan.post(
+            self.url,
+            "Basic dummy",
+            {"database": "odoo", "batch": 1, "last": "true"},
+            ['<operationplan reference="1"/>', '<operationplan reference="2"/>'],
+            **kwargs
+        )
+
+    def test_post(self):
+        self.assertEqual(self.post(), b"OK")
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertIn('name="batch"', self.server.requests[0])
+        self.assertIn(
+            '<operationplans>\n<operationplan reference="1"/>\n<operationplan reference="2"/>\n</operationplans>',
+            self.server.requests[0],
+        )
+
+    def test_post_compressed(self):
+        self.assertEqual(self.post(compress=True), b"OK")
+        self.assertIn('<operationplan reference="2"/>', self.server.requests[0])
+
+    @mock.patch("freppledb.odoo.commands.time.sleep")
+    def test_post_retry(self, sleep):
+        # Failing to connect is retried
+        attempts = []
+
+        def connect(request):
+            attempts.append(request)
+            if len(attempts) <= 2:
+                raise URLError(ConnectionRefusedError())
+            return urlopen(request)
+
+        with mock.patch("freppledb.odoo.commands.urlopen", side_effect=connect):
+            self.assertEqual(self.post(retries=3), b"OK")
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(len(self.server.requests), 1)
+
+    @mock.patch("freppledb.odoo.commands.time.sleep")
+    def test_post_server_error(self, sleep):
+        # Odoo may have processed the request, so it isn't sent again
+        self.server.failures = 1
+        with self.assertRaises(HTTPError):
+            self.post(retries=3)
+        self.assertEqual(len(self.server.requests), 1)
+
+    @mock.patch("freppledb.odoo.commands.time.sleep")
+    def test_post_client_error(self, sleep):
+        self.server.failures = 1
+        self.server.failurecode = 403
+        with self.assertRaises(HTTPError):
+            self.post(retries=3)
+        self.assertEqual(len(self.server.requests), 1)
@@ -18,10 +18,12 @@
 from datetime import timedelta, datetime, date
 import json
 import logging
+from multiprocessing import Event
 import os
 from psycopg2.extensions import adapt
 from psycopg2.extras import execute_batch
 
+from django.conf import settings
 from django.db import connections, DEFAULT_DB_ALIAS, transaction
 
 from freppledb.common.commands import (
@@ -30,10 +32,78 @@ from freppledb.common.commands import (
     clean_value,
     CopyFromGenerator,
 )
+from freppledb.common.models import Parameter, ReportCache
 
 logger = logging.getLogger(__name__)
 
 
+def isDeltaExport(cluster=-1, database=DEFAULT_DB_ALIAS):
+    """
+    Returns true when the export only needs to save the differences with the
+    previously exported plan, rather than erasing and rewriting the complete plan.
+    This is only supported when exporting the complete model.
+    """
+    return (
+        cluster == -1
+        and Parameter.getValue("plan.export_delta", database, "false").lower()
+        == "true"
+    )
+
+
+def deltaMerge(cursor, table, staging, columns):
+    """
+    Synchronizes a plan table with the records in a staging table, by comparing
+    a hash of their content. The lastmodified field isn't part of the hash.
+    Records that didn't change are left untouched, obsolete records are deleted
+    and new records are inserted.
+    Identical records can appear multiple times, so we number them.
+    """
+    content = "md5(row(%s)::text)" % ",".join(
+        i for i in columns if i != "lastmodified"
+    )
+    cursor.execute(
+        """
+        with target as (
+          select id, %s as hash, row_number() over (partition by %s) as seq
+          from %s
+          ),
+        staged as (
+          select %s, %s as hash, row_number() over (partition by %s) as seq
+          from %s
+          ),
+        deleted as (
+          delete from %s
+          using target
+          where target.id = %s.id
+          and not exists (
+            select 1 from staged
+            where staged.hash = target.hash and staged.seq = target.seq
+            )
+          )
+        insert into %s (%s)
+        select %s from staged
+        where not exists (
+          select 1 from target
+          where target.hash = staged.hash and target.seq = staged.seq
+          )
+        """
+        % (
+            content,
+            content,
+            table,
+            ",".join(columns),
+            content,
+            content,
+            staging,
+            table,
+            table,
+            table,
+            ",".join(columns),
+            ",".join(columns),
+        )
+    )
+
+
 @PlanTaskRegistry.register
 class TruncatePlan(PlanTask):
 
@@ -52,8 +122,15 @@ class TruncatePlan(PlanTask):
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         import frepple
 
+        ExportOperationPlans.exported.clear()
         cursor = connections[database].cursor()
-        if cluster == -1:
+        if isDeltaExport(cluster, database):
+            # Complete export for the complete model, only saving the differences.
+            # The export tasks remove the obsolete operationplans.
+            cursor.execute(
+                "truncate table out_problem, out_resourceplan, out_constraint"
+            )
+        elif cluster == -1:
             # Complete export for the complete model
             cursor.execute(
                 "truncate table out_problem, out_resourceplan, out_constraint"
@@ -250,6 +327,28 @@ class ShowPlanStats(PlanTask):
             logger.info("Table %s: %d records" % (table, recs))
 
 
+@PlanTaskRegistry.register
+class ClearReportCache(PlanTask):
+    """
+    Discards the cached report pages, which were computed with the previous plan.
+    The reports recompute and cache them again when they are viewed.
+    """
+
+    description = "Clear report cache"
+    sequence = 404
+
+    @classmethod
+    def getWeight(cls, **kwargs):
+        if "supply" in os.environ:
+            return 0.01
+        else:
+            return -1
+
+    @staticmethod
+    def run(database=DEFAULT_DB_ALIAS, **kwargs):
+        ReportCache.invalidate(database)
+
+
 @PlanTaskRegistry.register
 class ExportProblems(PlanTask):
 
@@ -289,7 +388,9 @@ class ExportProblems(PlanTask):
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
         cursor.copy_from(
-            CopyFromGenerator(cls.getData(cluster)),
+            CopyFromGenerator(
+                cls.getData(cluster), chunksize=settings.EXPORT_CHUNKSIZE
+            ),
             "out_problem",
             columns=(
                 "entity",
@@ -300,7 +401,7 @@ class ExportProblems(PlanTask):
                 "enddate",
                 "weight",
             ),
-            size=1024,
+            size=65536,
             sep="\v",
         )
 
@@ -350,7 +451,9 @@ class ExportConstraints(PlanTask):
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
         cursor = connections[database].cursor()
         cursor.copy_from(
-            CopyFromGenerator(cls.getData(cluster=cluster)),
+            CopyFromGenerator(
+                cls.getData(cluster=cluster), chunksize=settings.EXPORT_CHUNKSIZE
+            ),
             "out_constraint",
             columns=(
                 "demand",
@@ -364,7 +467,7 @@ class ExportConstraints(PlanTask):
                 "enddate",
                 "weight",
             ),
-            size=1024,
+            size=65536,
             sep="\v",
         )
 
@@ -376,6 +479,11 @@ class ExportOperationPlans(PlanTask):
     sequence = (401, "export1", 1)
     export = True
 
+    # Set when all operationplans are saved in the database.
+    # The operationplan materials and resources are exported in parallel on
+    # other connections, but need to wait for this before they can be saved.
+    exported = Event()
+
     @classmethod
     def getWeight(cls, **kwargs):
         if "supply" in os.environ or kwargs.get("exportstatic", False):
@@ -667,6 +775,14 @@ class ExportOperationPlans(PlanTask):
 
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, **kwargs):
+        try:
+            cls.exportPlan(cluster=cluster, database=database)
+        finally:
+            # The materials and resources of the operationplans can now be saved
+            cls.exported.set()
+
+    @classmethod
+    def exportPlan(cls, cluster=-1, database=DEFAULT_DB_ALIAS):
         # Export operationplans to a temporary table
         cursor = connections[database].cursor()
         cursor.execute(
@@ -700,13 +816,18 @@ class ExportOperationPlans(PlanTask):
             """
         )
         cursor.copy_from(
-            CopyFromGenerator(cls.getData(cls.parent.timestamp, cluster=cluster)),
+            CopyFromGenerator(
+                cls.getData(cls.parent.timestamp, cluster=cluster),
+                chunksize=settings.EXPORT_CHUNKSIZE,
+            ),
             table="tmp_operationplan",
-            size=1024,
+            size=65536,
             sep="\v",
         )
 
-        # Merge temp table into the actual table
+        # Merge temp table into the actual table.
+        # In a delta export we only update the records that changed.
+        delta = isDeltaExport(cluster, database)
         cursor.execute(
             """
             update operationplan
@@ -719,8 +840,34 @@ class ExportOperationPlans(PlanTask):
                 location_id=tmp.location_id, supplier_id=tmp.supplier_id, demand_id=tmp.demand_id,
                 due=tmp.due, color=tmp.color, batch=tmp.batch, quantity_completed=tmp.quantity_completed
             from tmp_operationplan as tmp
-            where operationplan.reference = tmp.reference;
+            where operationplan.reference = tmp.reference
+            %s
             """
+            % (
+                """
+                and (
+                  operationplan.name, operationplan.type, operationplan.status,
+                  operationplan.quantity, operationplan.startdate, operationplan.enddate,
+                  operationplan.criticality, operationplan.delay, operationplan.plan,
+                  operationplan.source, operationplan.operation_id, operationplan.owner_id,
+                  operationplan.item_id, operationplan.destination_id, operationplan.origin_id,
+                  operationplan.location_id, operationplan.supplier_id, operationplan.demand_id,
+                  operationplan.due, operationplan.color, operationplan.batch,
+                  operationplan.quantity_completed
+                ) is distinct from (
+                  tmp.name, tmp.type, tmp.status,
+                  tmp.quantity, tmp.startdate, tmp.enddate,
+                  tmp.criticality, tmp.delay * interval '1 second', tmp.plan::jsonb,
+                  tmp.source, tmp.operation_id, tmp.owner_id,
+                  tmp.item_id, tmp.destination_id, tmp.origin_id,
+                  tmp.location_id, tmp.supplier_id, tmp.demand_id,
+                  tmp.due, tmp.color, tmp.batch,
+                  tmp.quantity_completed
+                )
+                """
+                if delta
+                else ""
+            )
         )
         cursor.execute(
             """
@@ -755,6 +902,48 @@ class ExportOperationPlans(PlanTask):
             """
         )
 
+        if delta:
+            # Remove the proposed operationplans that are no longer in the plan
+            cursor.execute(
+                """
+                create temporary table tmp_obsolete as
+                select reference
+                from operationplan
+                where ((status='proposed' or status is null) or type = 'STCK')
+                and not exists (
+                  select 1 from tmp_operationplan
+                  where tmp_operationplan.reference = operationplan.reference
+                  )
+                """
+            )
+            cursor.execute(
+                """
+                update operationplan
+                  set owner_id = null
+                  from tmp_obsolete
+                  where operationplan.owner_id = tmp_obsolete.reference
+                """
+            )
+            # Their materials and resources aren't merged yet, and they would
+            # violate the foreign key constraint at the end of the statement
+            for table in ("operationplanmaterial", "operationplanresource"):
+                cursor.execute(
+                    """
+                    delete from %s
+                    using tmp_obsolete
+                    where %s.operationplan_id = tmp_obsolete.reference
+                    """
+                    % (table, table)
+                )
+            cursor.execute(
+                """
+                delete from operationplan
+                using tmp_obsolete
+                where operationplan.reference = tmp_obsolete.reference
+                """
+            )
+            cursor.execute("drop table tmp_obsolete")
+
         # update demand table specific fields
         cursor.execute(
             """
@@ -797,7 +986,7 @@ class ExportOperationPlans(PlanTask):
 class ExportOperationPlanMaterials(PlanTask):
 
     description = ("Export plan", "Exporting operationplan materials")
-    sequence = (401, "export1", 2)
+    sequence = (401, "export3", 1)
     export = True
 
     @classmethod
@@ -844,40 +1033,64 @@ class ExportOperationPlanMaterials(PlanTask):
     @classmethod
     def run(cls, cluster=-1, database=DEFAULT_DB_ALIAS, timestamp=None, **kwargs):
         cursor = connections[database].cursor()
-        updates = []
-        cursor.copy_from(
-            CopyFromGenerator(
-                cls.getData(
-                    timestamp=timestamp or cls.parent.timestamp,
-                    cluster=cluster,
-                    **kwargs
-                )
+        data = CopyFromGenerator(
+            cls.getData(
+                timestamp=timestamp or cls.parent.timestamp, cluster=cluster, **kwargs
             ),
-            "operationplanmaterial",
-            columns=(
-                "operationplan_id",
-                "item_id",
-                "location_id",
-                "quantity",
-                "flowdate",
-                "onhand",
-                "minimum",
-                "periodofcover",
-                "status",
-                "lastmodified",
-            ),
-            size=1024,
-            sep="\v",
+            chunksize=settings.EXPORT_CHUNKSIZE,
         )
-        if len(updates) > 0:
-            cursor.execute("\n".join(updates))
+        columns = (
+            "operationplan_id",
+            "item_id",
+            "location_id",
+            "quantity",
+            "flowdate",
+            "onhand",
+            "minimum",
+            "periodofcover",
+            "status",
+            "lastmodified",
+        )
+        if timestamp or kwargs.get("buffers", None):
+            # Called outside of the plan export: the operationplans already exist
+            cursor.copy_from(
+                data, "operationplanmaterial", columns=columns, size=65536, sep="\v"
+            )
+            return
+
+        # Stage the records while the operationplans are being exported
+        cursor.execute(
+            """
+            create temporary table tmp_operationplanmaterial as
+            select %s from operationplanmaterial
+            with no data
+            """
+            % ",".join(columns)
+        )
+        cursor.copy_from(
+            data, "tmp_operationplanmaterial", columns=columns, size=65536, sep="\v"
+        )
+        ExportOperationPlans.exported.wait()
+        if isDeltaExport(cluster, database):
+            deltaMerge(
+                cursor, "operationplanmaterial", "tmp_operationplanmaterial", columns
+            )
+        else:
+            cursor.execute(
+                """
+                insert into operationplanmaterial (%s)
+                select %s from tmp_operationplanmaterial
+                """
+                % (",".join(columns), ",".join(columns))
+            )
+        cursor.execute("drop table tmp_operationplanmaterial")
 
 
 @PlanTaskRegistry.register
 class ComputePeriodOfCover(PlanTask):
 
     description = ("Export plan", "Compute period of cover")
-    sequence = (401, "export1", 5)
+    sequence = (401, "export3", 2)
     export = True
 
     @classmethod
@@ -950,7 +1163,7 @@ class ComputePeriodOfCover(PlanTask):
 class ExportOperationPlanResources(PlanTask):
 
     description = ("Export plan", "Exporting operationplan resources")
-    sequence = (401, "export1", 3)
+    sequence = (401, "export4", 1)
     export = True
 
     @classmethod
@@ -1002,29 +1215,58 @@ class ExportOperationPlanResources(PlanTask):
         **kwargs
     ):
         cursor = connections[database].cursor()
-        cursor.copy_from(
-            CopyFromGenerator(
-                cls.getData(
-                    timestamp=timestamp or cls.parent.timestamp,
-                    cluster=cluster,
-                    resources=resources,
-                    **kwargs
-                )
+        data = CopyFromGenerator(
+            cls.getData(
+                timestamp=timestamp or cls.parent.timestamp,
+                cluster=cluster,
+                resources=resources,
+                **kwargs
             ),
-            "operationplanresource",
-            columns=(
-                "operationplan_id",
-                "resource_id",
-                "quantity",
-                "startdate",
-                "enddate",
-                "setup",
-                "status",
-                "lastmodified",
-            ),
-            size=1024,
-            sep="\v",
+            chunksize=settings.EXPORT_CHUNKSIZE,
+        )
+        columns = (
+            "operationplan_id",
+            "resource_id",
+            "quantity",
+            "startdate",
+            "enddate",
+            "setup",
+            "status",
+            "lastmodified",
+        )
+        if timestamp or resources:
+            # Called outside of the plan export: the operationplans already exist
+            cursor.copy_from(
+                data, "operationplanresource", columns=columns, size=65536, sep="\v"
+            )
+            return
+
+        # Stage the records while the operationplans are being exported
+        cursor.execute(
+            """
+            create temporary table tmp_operationplanresource as
+            select %s from operationplanresource
+            with no data
+            """
+            % ",".join(columns)
+        )
+        cursor.copy_from(
+            data, "tmp_operationplanresource", columns=columns, size=65536, sep="\v"
         )
+        ExportOperationPlans.exported.wait()
+        if isDeltaExport(cluster, database):
+            deltaMerge(
+                cursor, "operationplanresource", "tmp_operationplanresource", columns
+            )
+        else:
+            cursor.execute(
+                """
+                insert into operationplanresource (%s)
+                select %s from tmp_operationplanresource
+                """
+                % (",".join(columns), ",".join(columns))
+            )
+        cursor.execute("drop table tmp_operationplanresource")
 
 
 @PlanTaskRegistry.register
@@ -1100,7 +1342,7 @@ class ExportResourcePlans(PlanTask):
                     )
 
         cursor.copy_from(
-            CopyFromGenerator(getData()),
+            CopyFromGenerator(getData(), chunksize=settings.EXPORT_CHUNKSIZE),
             "out_resourceplan",
             columns=(
                 "resource",
@@ -1111,7 +1353,7 @@ class ExportResourcePlans(PlanTask):
                 "load",
                 "free",
             ),
-            size=1024,
+            size=65536,
             sep="\v",
         )
 
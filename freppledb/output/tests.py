@@ -15,9 +15,15 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from django.test import TestCase
+import json
 
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from freppledb.common.dashboard import Dashboard
+from freppledb.common.models import ReportCache, User
 from freppledb.common.tests import checkResponse
+from freppledb.input.models import Resource
 
 
 class OutputTest(TestCase):
@@ -204,3 +210,100 @@ class OutputTest(TestCase):
                 "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             )
         )
+
+
+class ReportCacheTest(TransactionTestCase):
+
+    fixtures = ["demo"]
+
+    def setUp(self):
+        # Login
+        if not User.objects.filter(username="admin").count():
+            User.objects.create_superuser("admin", "your@company.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+    def test_output_resource_cache(self):
+        ReportCache.invalidate()
+        response = self.client.get("/resource/?format=json")
+        self.assertEqual(response.status_code, 200)
+        uncached = response.content
+        self.assertTrue(ReportCache.objects.exists())
+        response = self.client.get("/resource/?format=json")
+        self.assertEqual(response.content, uncached)
+        # Editing the data empties the cache
+        res = Resource.objects.all()[0]
+        res.description = "edited"
+        res.save()
+        self.assertFalse(ReportCache.objects.exists())
+
+    def test_output_widget_cache(self):
+        ReportCache.invalidate()
+        response = self.client.get("/widget/resource_utilization/?limit=5")
+        self.assertEqual(response.status_code, 200)
+        uncached = response.content
+        self.assertTrue(ReportCache.objects.exists())
+        response = self.client.get("/widget/resource_utilization/?limit=5")
+        self.assertEqual(response.content, uncached)
+        # Editing the data empties the cache
+        res = Resource.objects.all()[0]
+        res.description = "edited"
+        res.save()
+        self.assertFalse(ReportCache.objects.exists())
+        # Refreshing the cache renders the widgets of the dashboards again
+        Dashboard.refreshCache()
+        self.assertTrue(ReportCache.objects.exists())
+
+    def test_report_cache_transaction(self):
+        # The cache is emptied once, when the transaction is committed
+        ReportCache.store("test", [1], ReportCache.getVersion())
+        version = ReportCache.getVersion()
+        with transaction.atomic():
+            for res in Resource.objects.all()[:3]:
+                res.description = "edited"
+                res.save()
+            self.assertEqual(ReportCache.get("test"), [1])
+        self.assertEqual(ReportCache.getVersion(), version + 1)
+        self.assertIsNone(ReportCache.get("test"))
+
+        # Nothing happens when the transaction is rolled back
+        ReportCache.store("test", [2], ReportCache.getVersion())
+        try:
+            with transaction.atomic():
+                res.description = "rolled back"
+                res.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(ReportCache.get("test"), [2])
+
+    def test_report_cache_version(self):
+        # An entry computed before the cache was emptied isn't used
+        version = ReportCache.getVersion()
+        ReportCache.invalidate()
+        ReportCache.store("test", [1], version)
+        self.assertIsNone(ReportCache.get("test"))
+        ReportCache.store("test", [2], ReportCache.getVersion())
+        self.assertEqual(ReportCache.get("test"), [2])
+
+
+class WidgetTest(TransactionTestCase):
+
+    fixtures = ["demo"]
+
+    def setUp(self):
+        # Login
+        if not User.objects.filter(username="admin").count():
+            User.objects.create_superuser("admin", "your@company.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+    def test_output_widgets(self):
+        response = self.client.get("/widgets/")
+        self.assertEqual(response.status_code, 200)
+        widgets = json.loads(response.content)
+        self.assertTrue(widgets)
+        for w in widgets:
+            self.assertEqual(w["status"], 200, w["name"])
+            self.assertIn("%s;dur=" % w["name"], response["Server-Timing"])
+            # The separate request for the widget returns the same content
+            response2 = self.client.get(w["url"])
+            self.assertEqual(response2.content.decode("utf-8"), w["content"])
@@ -109,6 +109,7 @@ class OverviewReport(GridPivot):
     default_sort = (1, "asc", 2, "asc")
     permissions = (("view_inventory_report", "Can view inventory report"),)
     help_url = "user-interface/plan-analysis/inventory-report.html"
+    cacheable = True
 
     rows = (
         GridFieldText(
@@ -84,6 +84,7 @@ class OverviewReport(GridPivot):
         ("reasons", {"title": _("reasons"), "visible": False}),
     )
     help_url = "user-interface/plan-analysis/demand-report.html"
+    cacheable = True
 
     @classmethod
     def initialize(reportclass, request):
@@ -39,6 +39,7 @@ class OverviewReport(GridPivot):
     permissions = (("view_resource_report", "Can view resource report"),)
     editable = False
     help_url = "user-interface/plan-analysis/resource-report.html"
+    cacheable = True
 
     rows = (
         GridFieldText(
@@ -43,6 +43,7 @@ class LateOrdersWidget(Widget):
     tooltip = _("Shows orders that will be delivered after their due date")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
     url = "/problem/?noautofilter&entity=demand&name=late&sord=asc&sidx=startdate"
     exporturl = True
     limit = 20
@@ -121,6 +122,7 @@ class ShortOrdersWidget(Widget):
     tooltip = _("Shows orders that are not planned completely")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
     # Note the gte filter lets pass "short" and "unplanned", and filters out
     # "late" and "early".
     url = "/problem/?noautofilter&entity=demand&name__gte=short&sord=asc&sidx=startdate"
@@ -197,6 +199,7 @@ class ManufacturingOrderWidget(Widget):
     tooltip = _("Shows manufacturing orders by start date")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
     url = "/data/input/manufacturingorder/?noautofilter&sord=asc&sidx=startdate&status__in=proposed,confirmed,approved"
     exporturl = True
     fence1 = 7
@@ -466,6 +469,7 @@ class DistributionOrderWidget(Widget):
     tooltip = _("Shows distribution orders by start date")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
     url = "/data/input/distributionorder/?noautofilter&sord=asc&sidx=startdate&status__in=proposed,confirmed"
     exporturl = True
     fence1 = 7
@@ -732,6 +736,7 @@ class PurchaseOrderWidget(Widget):
     tooltip = _("Shows purchase orders by ordering date")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
     url = "/data/input/purchaseorder/?sord=asc&sidx=startdate&status__in=proposed,confirmed"
     exporturl = True
     fence1 = 7
@@ -1050,6 +1055,7 @@ class PurchaseQueueWidget(Widget):
     tooltip = _("Display a list of new purchase orders")
     permissions = (("view_purchaseorder", "Can view purchase orders"),)
     asynchronous = True
+    cacheable = True
     url = "/data/input/purchaseorder/?noautofilter&status=proposed&sidx=startdate&sord=asc"
     exporturl = True
     limit = 20
@@ -1106,6 +1112,7 @@ class DistributionQueueWidget(Widget):
     tooltip = _("Display a list of new distribution orders")
     permissions = (("view_distributionorder", "Can view distribution order"),)
     asynchronous = True
+    cacheable = True
     url = "/data/input/distributionorder/?noautofilter&status=proposed&sidx=startdate&sord=asc"
     exporturl = True
     limit = 20
@@ -1164,6 +1171,7 @@ class ShippingQueueWidget(Widget):
     tooltip = _("Display a list of new distribution orders")
     permissions = (("view_distributionorder", "Can view distribution order"),)
     asynchronous = True
+    cacheable = True
     url = "/data/input/distributionorder/?noautofilter&sidx=plandate&sord=asc"
     exporturl = True
     limit = 20
@@ -1222,6 +1230,7 @@ class ResourceQueueWidget(Widget):
     tooltip = _("Display planned activities for the resources")
     permissions = (("view_resource_report", "Can view resource report"),)
     asynchronous = True
+    cacheable = True
     url = "/data/input/operationplanresource/?sidx=startdate&sord=asc"
     exporturl = True
     limit = 20
@@ -1286,6 +1295,7 @@ class PurchaseAnalysisWidget(Widget):
     tooltip = _("Analyse the urgency of existing purchase orders")
     permissions = (("view_purchaseorder", "Can view purchase orders"),)
     asynchronous = True
+    cacheable = True
     url = "/data/input/purchaseorder/?noautofilter&status=confirmed&sidx=color&sord=asc"
     limit = 20
 
@@ -1339,6 +1349,7 @@ class AlertsWidget(Widget):
     tooltip = _("Overview of all alerts in the plan")
     permissions = (("view_problem_report", "Can view problem report"),)
     asynchronous = True
+    cacheable = True
     url = "/problem/"
     entities = "material,capacity,demand,operation"
 
@@ -1425,6 +1436,7 @@ class ResourceLoadWidget(Widget):
     tooltip = _("Shows the resources with the highest utilization")
     permissions = (("view_resource_report", "Can view resource report"),)
     asynchronous = True
+    cacheable = True
     url = "/resource/"
     exporturl = True
     limit = 5
@@ -1531,6 +1543,7 @@ class InventoryByLocationWidget(Widget):
     title = _("inventory by location")
     tooltip = _("Display the locations with the highest inventory value")
     asynchronous = True
+    cacheable = True
     limit = 5
 
     def args(self):
@@ -1622,6 +1635,7 @@ class InventoryByItemWidget(Widget):
     title = _("inventory by item")
     tooltip = _("Display the items with the highest inventory value")
     asynchronous = True
+    cacheable = True
     limit = 20
 
     def args(self):
@@ -1712,6 +1726,7 @@ class DeliveryPerformanceWidget(Widget):
         "Shows the percentage of demands that are planned to be shipped completely on time"
     )
     asynchronous = True
+    cacheable = True
     green = 90
     yellow = 80
 
@@ -483,6 +483,11 @@ class ReportManager(GridReport):
         else:
             return 0
 
+    @classmethod
+    def estimate_query(cls, request, *args, **kwargs):
+        # The report runs its own SQL statement rather than a queryset
+        return cls.count_query(request, *args, **kwargs)
+
     def rows(self, request, *args, **kwargs):
         cols = []
         if args:
@@ -250,6 +250,30 @@ DEFAULT_THEME = "earth"
 # The default number of records to pull from the server as a page
 DEFAULT_PAGESIZE = 100
 
+# Grids on unfiltered tables with more records than this number display the
+# estimated record count of the database statistics, while the exact count is
+# computed in the background.
+ESTIMATE_COUNT_THRESHOLD = 1000000
+
+# Number of seconds the scenario list, the scenario status and the user
+# preferences are cached between requests.
+# Changes made in the web server process are visible immediately. Changes by
+# other processes, such as the scenario status updated by a worker, are only
+# visible immediately when the CACHES setting configures a cache shared
+# between the processes.
+REQUEST_CACHE_TIMEOUT = 10
+
+# Number of records the plan export collects in a single buffer before
+# passing it to the database
+EXPORT_CHUNKSIZE = 10000
+
+# Parallel groups of the plan generation run as threads by default.
+# The groups listed here run as a separate process instead, so they don't
+# compete for the python interpreter lock. This is only available on
+# platforms that can fork processes, ie not on Windows.
+# Example: PLANTASK_PROCESSES = ["export1", "export2", "export3", "export4"]
+PLANTASK_PROCESSES = []
+
 # Configuration of the default dashboard
 DEFAULT_DASHBOARD = [
     {
@@ -9481,10 +9481,12 @@ class LoadPlanIterator : public PythonExtension<LoadPlanIterator> {
 PyObject* readXMLfile(PyObject*, PyObject*);
 
 /* This Python function is used for processing XML input data from a
- * string.
+ * string or a file-like object.
  *
  * The function takes up to three arguments:
- *   - XML data string to be processed
+ *   - XML data to be processed. This is a string, bytes or a file-like
+ *     object. The read() method of a file-like object is called repeatedly
+ *     and needs to return bytes. The data is then parsed while it is read.
  *   - Optional validate flag, defining whether or not the input data needs to
  * be validated against the XML schema definition. The validation is switched ON
  * by default. Switching it ON is recommended in situations where there is no
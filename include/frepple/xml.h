@@ -30,6 +30,7 @@
 #define XERCES_STATIC_LIBRARY
 #endif
 #include <xercesc/framework/LocalFileInputSource.hpp>
+#include <xercesc/util/BinInputStream.hpp>
 #include <xercesc/framework/MemBufInputSource.hpp>
 #include <xercesc/framework/StdInInputSource.hpp>
 #include <xercesc/framework/URLInputSource.hpp>
@@ -251,6 +252,24 @@ class XMLInputString : public XMLInput {
   const string data;
 };
 
+/* This class reads XML data from a Python file-like object.
+ *
+ * The data is read in chunks with the read() method of the object, which
+ * needs to return bytes. Only a single chunk of the data is kept in memory,
+ * and the parsing can start before all data is available.
+ */
+class XMLInputPython : public XMLInput {
+ public:
+  /* Constructor. The caller keeps a reference to the object while parsing. */
+  XMLInputPython(PyObject* o) : obj(o){};
+
+  /* Parse the data read from the object. */
+  void parse(Object* pRoot, bool v = false);
+
+ private:
+  PyObject* obj;
+};
+
 /* This class reads XML data from a file system.
  *
  * The filename argument can be the name of a file or a directory.
@@ -78,26 +78,48 @@ PyObject *readXMLfile(PyObject *self, PyObject *args) {
 
 PyObject *readXMLdata(PyObject *self, PyObject *args) {
   // Pick up arguments
-  char *data;
+  PyObject *data;
   int validate(1), validate_only(0), loglevel(0);
   PyObject *userexit = nullptr;
-  int ok = PyArg_ParseTuple(args, "s|iiiO:readXMLdata", &data, &validate,
+  int ok = PyArg_ParseTuple(args, "O|iiiO:readXMLdata", &data, &validate,
                             &validate_only, &loglevel, &userexit);
   if (!ok) return nullptr;
 
+  // The data is either a string, or a file-like object we read in chunks
+  const char *str = nullptr;
+  if (PyUnicode_Check(data)) {
+    str = PyUnicode_AsUTF8(data);
+    if (!str) return nullptr;
+  } else if (PyBytes_Check(data))
+    str = PyBytes_AsString(data);
+  else if (!PyObject_HasAttrString(data, "read")) {
+    PyErr_SetString(PythonDataException,
+                    "readXMLdata expects a string or a file-like object");
+    return nullptr;
+  }
+
   // Free Python interpreter for other threads
   Py_BEGIN_ALLOW_THREADS;
 
   // Execute and catch exceptions
   try {
-    if (!data) throw DataException("No input data");
-    XMLInputString p(data);
-    if (userexit) p.setUserExit(userexit);
-    if (loglevel) p.setLogLevel(1);
-    if (validate_only != 0)
-      p.parse(nullptr, true);
-    else
-      p.parse(&Plan::instance(), validate != 0);
+    if (str) {
+      XMLInputString p(str);
+      if (userexit) p.setUserExit(userexit);
+      if (loglevel) p.setLogLevel(1);
+      if (validate_only != 0)
+        p.parse(nullptr, true);
+      else
+        p.parse(&Plan::instance(), validate != 0);
+    } else {
+      XMLInputPython p(data);
+      if (userexit) p.setUserExit(userexit);
+      if (loglevel) p.setLogLevel(1);
+      if (validate_only != 0)
+        p.parse(nullptr, true);
+      else
+        p.parse(&Plan::instance(), validate != 0);
+    }
   } catch (...) {
     Py_BLOCK_THREADS;
     PythonType::evalException();
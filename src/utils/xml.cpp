@@ -734,6 +734,85 @@ void XMLInput::parse(xercesc::InputSource& in, Object* pRoot, bool validate) {
   parser = nullptr;
 }
 
+/* A Xerces input stream that reads from a Python file-like object. */
+class PythonBinInputStream : public xercesc::BinInputStream {
+ public:
+  PythonBinInputStream(PyObject* o) : obj(o) {}
+
+  XMLFilePos curPos() const { return pos; }
+
+  const XMLCh* getContentType() const { return nullptr; }
+
+  XMLSize_t readBytes(XMLByte* const toFill, const XMLSize_t maxToRead) {
+    // The parser runs without the Python interpreter lock
+    auto pythonstate = PyGILState_Ensure();
+    PyObject* result = PyObject_CallMethod(obj, "read", "n",
+                                           static_cast<Py_ssize_t>(maxToRead));
+    char* buffer;
+    Py_ssize_t len;
+    if (!result || PyBytes_AsStringAndSize(result, &buffer, &len) == -1) {
+      Py_XDECREF(result);
+      string msg = fetchError();
+      PyGILState_Release(pythonstate);
+      throw DataException("Error reading XML data from a Python object: " +
+                          msg);
+    }
+    if (len > static_cast<Py_ssize_t>(maxToRead)) {
+      Py_DECREF(result);
+      PyGILState_Release(pythonstate);
+      throw DataException(
+          "Error reading XML data from a Python object: read() returned more "
+          "data than requested");
+    }
+    memcpy(toFill, buffer, len);
+    Py_DECREF(result);
+    PyGILState_Release(pythonstate);
+    pos += len;
+    return len;
+  }
+
+ private:
+  PyObject* obj;
+  XMLFilePos pos = 0;
+
+  /* Returns the message of the current Python exception, and clears it. */
+  static string fetchError() {
+    PyObject *type, *value, *traceback;
+    PyErr_Fetch(&type, &value, &traceback);
+    PyErr_NormalizeException(&type, &value, &traceback);
+    string msg;
+    PyObject* str = value ? PyObject_Str(value) : nullptr;
+    if (str) {
+      const char* c = PyUnicode_AsUTF8(str);
+      if (c) msg = c;
+      Py_DECREF(str);
+    }
+    PyErr_Clear();
+    Py_XDECREF(type);
+    Py_XDECREF(value);
+    Py_XDECREF(traceback);
+    return msg;
+  }
+};
+
+/* A Xerces input source that reads from a Python file-like object. */
+class PythonInputSource : public xercesc::InputSource {
+ public:
+  PythonInputSource(PyObject* o) : obj(o) {}
+
+  xercesc::BinInputStream* makeStream() const {
+    return new PythonBinInputStream(obj);
+  }
+
+ private:
+  PyObject* obj;
+};
+
+void XMLInputPython::parse(Object* pRoot, bool validate) {
+  PythonInputSource in(obj);
+  XMLInput::parse(in, pRoot, validate);
+}
+
 void XMLSerializer::escape(const string& x) {
   for (const char* p = x.c_str(); *p; ++p) {
     switch (*p) {
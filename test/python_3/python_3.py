@@ -34,6 +34,7 @@ if 'FREPPLE_HOME' in os.environ:
 import frepple
 import datetime
 import inspect
+import io
 import types
 
 
@@ -247,6 +248,36 @@ frepple.readXMLdata('''<?xml version="1.0" encoding="UTF-8" ?>
 </plan>
 ''')
 
+###
+print("\nLoading XML data from a file-like object")
+frepple.readXMLdata(io.BytesIO('''<?xml version="1.0" encoding="UTF-8" ?>
+<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <customers>
+    <customer name="streamed customer" description="streamed"/>
+  </customers>
+</plan>
+'''.encode("utf-8")))
+print("Loaded customer:", frepple.customer(name="streamed customer").description)
+frepple.customer(name="streamed customer", action="R")
+
+class FailingFile:
+  def read(self, size):
+    raise IOError("disk failure")
+
+class OversizedFile:
+  def read(self, size):
+    return b" " * (size + 1)
+
+for f in (FailingFile(), OversizedFile()):
+  try:
+    frepple.readXMLdata(f)
+    raise AssertionError("Reading %s didn't fail" % f.__class__.__name__)
+  except AssertionError:
+    raise
+  except Exception as e:
+    print("Catching exception %s: %s" % (e.__class__.__name__, e))
+    assert "disk failure" in str(e) or "more data" in str(e)
+
 ###
 print("\nCreating operationplans")
 opplan = frepple.operationplan(